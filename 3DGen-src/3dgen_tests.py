@@ -1,6 +1,10 @@
 import os
+import re
+import time
+import hashlib
+import tempfile
 import subprocess
-from clean_response import clean_response, process_test_results, process_packet_results
+from clean_response import process_packet_results
 import json 
 import datetime
 import sys 
@@ -8,11 +12,12 @@ import argparse
 import logging
 import subprocess
 from colorlog import ColoredFormatter
-from llm_gen_tests import get_tests 
 from validate_with_tshark import *
 from combine_dats_to_pcap import generate_pcap
 import math 
-from validate_with_tshark import *
+from tracing import span
+from z3_testgen import generate_witnesses, witness_module, traces_file
+from packed_corpus import open_corpus, is_packed, pack, unpack
 
 module_names = {
     "Ethernet"  : ("_ETHERNET_FRAME"),
@@ -59,56 +64,179 @@ def logger_setup():
     log.addHandler(stream)
     return log
 
+## EverParse names its witnesses witness.<index>.<POS|NEG>.<module>.dat
+witness_name = re.compile(r"^witness\.(\d+)\.(POS|NEG)\.(.+)\.dat$")
+
+def z3_test(spec, filename, protocol, depth, witnesses, odir, timeout = None, workers = 1, transcript = None):
+    """
+    Run EverParse's Z3 test generation into odir. Returns False if it was stopped after timeout seconds.
+    With workers > 1 EverParse only saves the SMT2 encoding of the parser and the branch traces are
+    enumerated on that many Z3 processes, see z3_testgen.py.
+    """
+    if workers > 1:
+        start = time.time()
+        with tempfile.TemporaryDirectory() as encoding_dir:
+            transcript = os.path.join(encoding_dir, f"{filename}.smt2")
+            ## The cheapest run that still saves the complete encoding.
+            if not z3_test(spec, filename, protocol, 0, 1, encoding_dir, timeout, transcript=transcript):
+                return False
+            if timeout is not None:
+                timeout -= time.time() - start
+            _, finished = generate_witnesses(transcript, odir, witness_module(f"{filename}.{module_names[protocol]}"), depth, witnesses, workers, None, timeout)
+            return finished
+
+    save = f" --save_z3_transcript {transcript}" if transcript is not None else ""
+    call = f"bash everparse/everparse.sh {spec} --no_batch --z3_test {filename}.{module_names[protocol]} --z3_branch_depth {depth} --z3_witnesses {witnesses}{save}  --odir {odir}"
+    print(call)
+    with span("z3_test", protocol=protocol, depth=depth, witnesses=witnesses):
+        sp = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            _, err = sp.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            sp.kill()
+            sp.communicate()
+            print(f"Z3 test generation stopped after {timeout:.0f}s")
+            return False
+    if sp.returncode != 0:
+        raise Exception(f'Subprocess {call} failed with error code: {sp.returncode} and error message: {err}')
+    return True
+
+def witness_hashes(out):
+    """
+    Content hashes of the witnesses in out and the next free witness index
+    """
+    seen = set()
+    next_index = 0
+    with open_corpus(out) as corpus:
+        for f in corpus.names():
+            m = witness_name.match(f)
+            if m:
+                seen.add(corpus.sha256(f))
+                next_index = max(next_index, int(m.group(1)) + 1)
+    return seen, next_index
+
+def merge_witnesses(round_dir, out, seen, next_index):
+    """
+    Move the witnesses of a generation round into out, renumbered after the existing ones. Witnesses with the
+    same bytes as one already in out are dropped. Returns the number of new, duplicate and distinct witnesses of the
+    round, the number of branch traces none of the witnesses in out had (None if the round recorded no traces) and
+    the next index. The branch traces z3_testgen.py records are carried over.
+    """
+    new, duplicates = 0, 0
+    distinct = set()
+    round_traces = read_traces(round_dir)
+    traces = read_traces(out)
+    known = {trace_key(name, trace) for name, trace in traces.items()}
+    new_traces = set()
+    witnesses = [(witness_name.match(f), f) for f in os.listdir(round_dir)]
+    for m, f in sorted([(m, f) for m, f in witnesses if m], key=lambda w: int(w[0].group(1))):
+        if f in round_traces and trace_key(f, round_traces[f]) not in known:
+            new_traces.add(trace_key(f, round_traces[f]))
+        path = os.path.join(round_dir, f)
+        with open(path, 'rb') as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+        distinct.add(digest)
+        if digest in seen:
+            duplicates += 1
+            continue
+        seen.add(digest)
+        name = f"witness.{next_index}.{m.group(2)}.{m.group(3)}.dat"
+        os.replace(path, os.path.join(out, name))
+        if f in round_traces:
+            traces[name] = round_traces[f]
+        next_index += 1
+        new += 1
+    if traces:
+        with open(os.path.join(out, traces_file), 'w') as f:
+            json.dump(traces, f)
+    return new, duplicates, len(distinct), len(new_traces) if round_traces else None, next_index
+
+def trace_key(name, trace):
+    ## Positive and negative witnesses of the same branch trace are different cases.
+    return witness_name.match(name).group(2), json.dumps(trace)
+
+def read_traces(dir):
+    path = os.path.join(dir, traces_file)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
 def z3_gen(args):
     spec = ""
     out = os.path.join(args.out, "z3")
     out = os.path.abspath(out)
+    ## Witnesses of earlier runs may only be kept packed, generation rounds are merged into the directory.
+    if not os.path.exists(out) and is_packed(out):
+        unpack(out)
     if not os.path.exists(out):
         os.mkdir(out)
 
     filename = str(os.path.basename(args.spec))
     filename = filename.split('.3d')[0]  
     spec = args.spec  
-   
-    call = f"bash everparse/everparse.sh {spec} --no_batch --z3_test {filename}.{module_names[args.protocol]} --z3_branch_depth {args.z3_branch_depth} --z3_witnesses {args.z3_witnesses}  --odir {out}"
-    print(call)
-    sp = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    _, err = sp.communicate()
-    if sp.returncode != 0:
-        raise Exception(f'Subprocess {call} failed with error code: {sp.returncode} and error message: {err}')
-    
-    # list number of files in the directory
-    num_files = len([f for f in os.listdir(out) if os.path.isfile(os.path.join(out, f))])
-    if num_files <= 200:
-        print(f"Error: Not enough witnesses generated. Only {num_files} were generated")
-        #deleted the dir
-        call = f"rm -rf {out}/*"
-        subprocess.run(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        num_witnesses =  math.ceil(200 / (num_files))
-       
-        
-        call = f"bash everparse/everparse.sh {spec} --no_batch --z3_test {filename}.{module_names[args.protocol]} --z3_branch_depth {args.z3_branch_depth} --z3_witnesses {num_witnesses}  --odir {out}"
-        print(call)
-        sp = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        _, err = sp.communicate()
-        if sp.returncode != 0:
-            raise Exception(f'Subprocess {call} failed with error code: {sp.returncode} and error message: {err}')
+
+    ## Top up the witnesses in out (kept from earlier runs) until there are z3_target distinct ones. EverParse always
+    ## generates from scratch, so every round asks for more witnesses per branch trace and only the new ones are kept.
+    seen, next_index = witness_hashes(out)
+    num_witnesses = args.z3_witnesses
+    rounds, duplicates = 0, 0
+    start = time.time()
+    while len(seen) < args.z3_target and rounds < args.z3_max_rounds:
+        timeout = None
+        if args.z3_time_budget > 0:
+            timeout = args.z3_time_budget - (time.time() - start)
+            if timeout <= 0:
+                print(f"Time budget of {args.z3_time_budget}s exhausted")
+                break
+
+        with tempfile.TemporaryDirectory(dir=out) as round_dir:
+            finished = z3_test(spec, filename, args.protocol, args.z3_branch_depth, num_witnesses, round_dir, timeout, args.z3_workers)
+            new, dups, distinct, new_traces, next_index = merge_witnesses(round_dir, out, seen, next_index)
+        rounds += 1
+        duplicates += dups
+        print(f"Round {rounds}: {num_witnesses} witnesses per branch trace, {new} new, {dups} duplicates, {len(seen)} total")
+        if not finished:
+            break
+        if distinct == 0:
+            print("No witnesses generated, stopping")
+            break
+        if new_traces == 0:
+            ## New witnesses of known branch traces are only new bytes for the same cases, the branch traces are exhausted.
+            print("No new branch traces, stopping")
+            break
+        if new_traces is None and new == 0 and rounds > 1:
+            ## More witnesses per branch trace only repeat what we have, the branch traces are exhausted.
+            print("No new witnesses, stopping")
+            break
+        if len(seen) < args.z3_target:
+            ## Each witness per branch trace yielded distinct / num_witnesses packets, ask for enough to reach the target.
+            num_witnesses = max(num_witnesses + 1, math.ceil(args.z3_target * num_witnesses / distinct))
+
+    elapsed = time.time() - start
+    print(f"Generated {len(seen)} witnesses ({duplicates} duplicates dropped) in {rounds} rounds and {elapsed:.1f}s")
+    if len(seen) < args.z3_target:
+        print(f"Warning: only {len(seen)} of {args.z3_target} witnesses could be generated")
         
     
     # generate pcap from witnesses
     pcap_file_path = os.path.join(out, f"{filename}.z3.pcap")
     pcap_file_path = os.path.abspath(pcap_file_path)
     generate_pcap(out, args.protocol, pcap_file_path)
-    results, _  = validate_and_coverage(pcap_file_path, str(args.protocol).lower(), False, True)
+    results, _  = validate_and_coverage(pcap_file_path, str(args.protocol).lower(), False, True, coverage_db=args.coverage_db)
     print(results)
     
     
     with open(f"{out}/z3_packet_labels.json", 'w') as f:
         json.dump(results, f)      
     
-    stats = f"Branch depth {args.z3_branch_depth}, Witnesses {num_witnesses}"
+    stats = f"Branch depth {args.z3_branch_depth}, Witnesses {num_witnesses}, Rounds {rounds}, Unique {len(seen)}, Duplicates {duplicates}, Time {elapsed:.1f}s"
     with open(f"{out}/run_stats.txt", 'w') as f:
         json.dump(stats, f)
+
+    if args.pack:
+        count, size = pack(out)
+        print(f"Packed {count} witnesses ({size} bytes) into {out}.pack")
     
     return pcap_file_path
  
@@ -118,14 +246,21 @@ if __name__ == "__main__":
     parser.add_argument('--protocol', type=str, help='Protocol to test [ipv4|ipv6|tcp|udp|icmp|vxlan]', required=True)
     parser.add_argument('--out', type=str, help='output directory', required=False)
     parser.add_argument('--z3_branch_depth', type=int, help='Z3 branch depth', required=False, default=0)
-    parser.add_argument('--z3_witnesses', type=int, help='z3 number of witnesses to generate', required=False, default=10)
+    parser.add_argument('--z3_witnesses', type=int, help='z3 number of witnesses to generate per branch trace in the first round', required=False, default=10)
+    parser.add_argument('--z3_target', type=int, help='Number of distinct witnesses to top up to', required=False, default=200)
+    parser.add_argument('--z3_max_rounds', type=int, help='Maximum number of generation rounds', required=False, default=5)
+    parser.add_argument('--z3_workers', type=int, help='Enumerate branch traces on this many Z3 processes instead of in EverParse, see z3_testgen.py', required=False, default=1)
+    parser.add_argument('--z3_time_budget', type=float, help='Time budget for witness generation in seconds, 0 for none', required=False, default=0)
     parser.add_argument('--rfc', type=str, help='/absolute/or/relative/path/to/rfc file', required=False)
     parser.add_argument('--spec', type=str, required=True, help='spec to use for Z3 test generation')
+    parser.add_argument('--coverage_db', type=str, help='/path/to/coverage database the dissector coverage of the test set is stored in, see coverage_store.py', required=False, default='experiments/coverage.db')
+    parser.add_argument('--pack', action='store_true', help='Also store the test set as a packed corpus, see packed_corpus.py', required=False)
 
     args = parser.parse_args()
     log = logger_setup()
     
-    os.mkdir(args.out)
+    ## Witnesses already in args.out are kept and topped up.
+    os.makedirs(args.out, exist_ok=True)
 
     ## Generate tests using a spec
     print("*"*50)
@@ -1,4 +1,3 @@
-from dotenv import load_dotenv
 import os
 import argparse
 import json
@@ -6,9 +5,21 @@ import autogen
 from test_utils import evaluate_code
 import agents.RFC_agent.multi_agent_prompts as prompts
 import time
+import datetime
+from concurrent.futures import ProcessPoolExecutor
 from agents.RFC_agent.query_RFC import get_context
-from logger import MessageLogger
-from query_model import clean_RFC
+from logger import MessageLogger, AsyncMessageLogger
+from query_model import clean_RFC, clean_RFC_chunked
+from rfc_cache import cleaned_rfc
+from results_store import record
+from manual_index import PromptRetriever
+from chat_history import HistoryManager
+import llm_client
+import tracing
+from tracing import span
+
+## Attempts may run in their own workspace, resources shipped with the agent are found relative to the launch directory.
+root_dir = os.getcwd()
 
 def generate_config(args):
     with open("config.json", "r") as f:
@@ -30,21 +41,43 @@ def print_messages(recipient, messages, sender, config):
     logger.log_message(message)
     return False, None  # required to ensure the agent communication flow continues
 
+def limit_client(agent, history = None):
+    ## The agent's LLM calls go through llm_client.py, within the endpoint's quota and with rate limits and transient errors retried in
+    ## place, and send the compacted history (see chat_history.py). Wrapping the client keeps autogen's reply chain, and with it the
+    ## termination check and the refinement limit, unchanged. Each call is timed and its tokens counted.
+    create = agent.client.create
+
+    def limited_create(**params):
+        if history is not None and params.get("messages"):
+            ## The system message (the Developer prompt) is not part of the history.
+            system = len(agent._oai_system_message)
+            params["messages"] = params["messages"][:system] + history.compact(params["messages"][system:])
+        messages = params.get("messages") or []
+        with span("llm", agent=agent.name, n=len(messages)) as s:
+            response = llm_client.default_client().call(lambda: create(**params), llm_client.estimate_tokens(messages), llm_client.usage_tokens)
+            llm_client.set_usage(s, response)
+        return response
+    agent.client.create = limited_create
+
+def retrieval_reply(recipient, messages, sender, config):
+    ## Select the manual sections and examples for the RFC and the latest message (e.g. an EverParse error) before the Developer replies.
+    retriever = config["retriever"]
+    query = config["rfc"]
+    if len(messages) > 1:
+        query += "\n" + str(messages[-1].get("content") or "")
+    manual, example = retriever.select(query)
+    retriever.count(manual, example)
+    recipient.update_system_message(prompts.get_developer_prompt(manual, example))
+    return False, None
+
 def setup():
-    load_dotenv()
-    azure_api_key = str(os.getenv("OPENAI_API_KEY"))
-    base_url = str(os.getenv("OPENAI_API_BASE"))
-
-    return [
-        {
-            "model": model_version,
-            "api_key": azure_api_key,
-            "base_url": base_url,
-            "api_type": "azure",
-            "api_version": "2023-08-01-preview",
-        }
-        for model_version in ["gpt-4-32k"]
-    ]
+    ## The endpoint of llm_client.py, a local one (e.g. its stub server) takes precedence over Azure.
+    base_url, api_key, api_version = llm_client.endpoint()
+    config_list = [{"model": model_version, "api_key": str(api_key), "base_url": str(base_url)} for model_version in ["gpt-4-32k"]]
+    if api_version is not None:
+        for config in config_list:
+            config.update({"api_type": "azure", "api_version": api_version})
+    return config_list
 
 def parse_command_line_args():
     parser = argparse.ArgumentParser()
@@ -55,9 +88,22 @@ def parse_command_line_args():
     parser.add_argument("--n", type=int, required=False, help="Number of refinements loops allowed", default=15) 
     parser.add_argument("--temp", type=float, required=False, help="Main agent loop temperature", default=1.0)   
     parser.add_argument("--attempt", type=int, required=False, help="Number of attempts", default=5)  
+    parser.add_argument("--parallel", type=int, required=False, help="Number of attempts to run concurrently, each in its own workspace", default=1)
+    parser.add_argument("--rfc_cache", type=str, required=False, help="Directory of the fetched and cleaned RFC cache, 'none' to disable", default="rfc_cache")
+    parser.add_argument("--clean_chunks", type=int, required=False, help="Clean the RFC concurrently in chunks of at most this many characters, 0 cleans it in one request", default=0)
+    parser.add_argument("--offline", action="store_true", required=False, help="Only use RFCs from the cache, never fetch or clean them")
+    parser.add_argument("--results_db", type=str, required=False, help="Results store of all attempts, see results_store.py", default="experiments/results.db")
+    parser.add_argument("--async_log", action="store_true", required=False, help="Write the agent log from a background thread, gzip compressed and rotated by size")
+    parser.add_argument("--isolate", action="store_true", required=False, help="Run attempts in their own workspace even if they are not run concurrently")
+    parser.add_argument("--prompt_budget", type=int, required=False, help="Token budget of the manual sections and examples in the Developer prompt, selected per turn, see manual_index.py. 0 sends the whole manual", default=4000)
+    parser.add_argument("--history_budget", type=int, required=False, help="Token budget of the Developer's conversation history besides the task prompt, older turns are compacted, see chat_history.py. 0 sends the whole history", default=6000)
+    parser.add_argument("--llm_timeout", type=float, required=False, help="Timeout of a single LLM request in seconds, timed out requests are retried, see llm_client.py", default=120)
+    parser.add_argument("--trace", type=str, required=False, help="Write a trace of all pipeline stages to this file (.trace.json for Chrome trace-event format), see tracing.py")
     return parser.parse_args()
 
-def agent_config(llm_config, manual, example, n):
+def agent_config(llm_config, manual, example, n, retriever = None, rfc = "", history = None):
+    if retriever is not None:
+        manual, example = retriever.select(rfc)
     developer = autogen.AssistantAgent(
         name="Developer",
         llm_config=llm_config,
@@ -74,7 +120,13 @@ def agent_config(llm_config, manual, example, n):
     )
     
     executor.register_function(function_map={"evaluate_code": evaluate_code})
+    limit_client(developer, history)
     developer.register_reply([autogen.Agent, None], reply_func=print_messages, config={"callback": None},)
+    ## Also log the Developer's (LLM) messages, so that sessions can be replayed, see replay.py.
+    executor.register_reply([autogen.Agent, None], reply_func=print_messages, config={"callback": None},)
+    if retriever is not None:
+        ## In front of all other replies, the system message is updated before the LLM is called.
+        developer.register_reply([autogen.Agent, None], reply_func=retrieval_reply, config={"retriever": retriever, "rfc": rfc})
 
     return [developer, executor]
 
@@ -105,7 +157,9 @@ def get_agent_skills(config_list, args):
             }
         ],
         "config_list": config_list,
-        "timeout": 120,
+        "timeout": getattr(args, "llm_timeout", 120),
+        ## Retries are limit_client's, within the quota shared by all attempts.
+        "max_retries": 0,
         "cache_seed": None,
         "temperature": args.temp
     }
@@ -120,100 +174,221 @@ def agent_loop(config_list, args):
     
     llm_config = get_agent_skills(config_list, args)
 
-    if ".json" in rfc_path:
-        with open(rfc_path, "r") as f:
-            rfc = json.load(f)
-    else:
-        rfc = get_context(rfc_path)
-        rfc = clean_RFC(rfc)
+    with span("clean_RFC", protocol=proto):
+        if ".json" in rfc_path:
+            with open(rfc_path, "r") as f:
+                rfc = json.load(f)
+        elif args.rfc_cache != "none":
+            rfc = cleaned_rfc(rfc_path, args.rfc_cache, args.offline, chunk_chars=args.clean_chunks)
+        else:
+            rfc = get_context(rfc_path)
+            rfc = clean_RFC_chunked(rfc, args.clean_chunks) if args.clean_chunks > 0 else clean_RFC(rfc)
 
     if manual_path is not None:
         with open(manual_path, "r") as f:
             manual = f.read()
     else:
-        with open("3d_manuals/3d_syntax_check.txt", "r") as f:
+        with open(os.path.join(root_dir, "3d_manuals/3d_syntax_check.txt"), "r") as f:
             manual = f.read()
 
-    with open("examples/multi_agent_example.txt", "r") as f:
+    with open(os.path.join(root_dir, "examples/multi_agent_example.txt"), "r") as f:
         example = f.read()
 
-    agent_list = agent_config(llm_config, manual, example, n)
-    agent_list[1].initiate_chat(
-    agent_list[0],
-    message=prompts.get_task_prompt(rfc, proto)
-    )
+    retriever = PromptRetriever(manual, example, args.prompt_budget) if args.prompt_budget > 0 else None
+    history = HistoryManager(args.history_budget) if args.history_budget > 0 else None
+    agent_list = agent_config(llm_config, manual, example, n, retriever, str(rfc), history)
+    with span("agent_chat", protocol=proto) as s:
+        agent_list[1].initiate_chat(
+        agent_list[0],
+        message=prompts.get_task_prompt(rfc, proto)
+        )
+        report = {}
+        if retriever is not None:
+            report.update(retriever.report())
+            s.set("prompt_saved_tokens", report["prompt_saved_tokens"])
+            print(f"Prompt retrieval saved {report['prompt_saved_tokens']} of {report['prompt_full_tokens']} manual and example tokens ({report['prompt_saved_percent']:.1f}%) over {report['prompt_calls']} Developer calls")
+        if history is not None:
+            report.update(history.report())
+            s.set("history_max_tokens", report["history_max_tokens"])
+            print(f"History compaction sent {report['history_tokens_sent']} of {report['history_tokens_before']} history tokens over {report['history_calls']} Developer calls, at most {report['history_max_tokens']} per call")
+    return report
 
     
 
+def run_attempt(config_list, args, filename, attempt = 0):
+    """
+    Run one attempt of the agent loop. Its results are counted by the logger as messages arrive.
+    """
+    request_success = False
+    restarts = 0
+    while not request_success:
+        ## A retry starts the attempt over, so do its counters.
+        metrics = logger.start_attempt(args.proto, attempt)
+        try:
+            with span("attempt", protocol=args.proto, attempt=attempt) as s:
+                context_report = agent_loop(config_list, args)
+                s.set("messages", metrics.messages)
+                s.set("success", metrics.success)
+            request_success = True
+        except Exception as e:
+            ## LLM rate limits and transient errors are retried in place, this is for what escapes them.
+            delay = llm_client.retry_delay(e, restarts)
+            restarts += 1
+            print(f"Error: {e}")
+            print(f"Retrying in {delay:.0f}s......")
+            time.sleep(delay)
+            continue
+    metrics.finished = time.time()
+    logger.metrics = None
+    record(args.results_db, metrics, str(args))
+
+    results = metrics.results()
+    spec_file = results.pop("spec_file")
+    results = {"protocol": args.proto, "params" : f"{str(args)}", **results, **context_report}
+    print(results)
+    logger.log_record(results)
+        
+    experiment_dir = os.path.join(root_dir, "experiments/RFCs/")
+    problem_dir = os.path.join(experiment_dir, args.proto)
+    
+    if not os.path.exists(problem_dir):
+        os.makedirs(problem_dir)
+    for log_file in logger.files():
+        print(f"Copying {log_file} to {problem_dir}")
+        call = f"cp {log_file} {problem_dir}"
+        os.system(call)
+    print(f"Copying {spec_file} to {problem_dir}")
+    call = f"cp {spec_file} {problem_dir}"
+    os.system(call)
+
+    results["spec_file"] = spec_file
+    return results
+
+
+def isolate_paths(args):
+    """
+    Make all paths in args and config.json absolute, so that attempts can run from their own workspace
+    """
+    if ".json" in args.rfc and os.path.exists(args.rfc):
+        args.rfc = os.path.abspath(args.rfc)
+    if args.manual is not None:
+        args.manual = os.path.abspath(args.manual)
+    if args.rfc_cache != "none":
+        args.rfc_cache = os.path.abspath(args.rfc_cache)
+    args.results_db = os.path.abspath(args.results_db)
+    if "none" not in args.tests:
+        args.tests = os.path.abspath(args.tests)
+
+    with open("config.json", "r") as f:
+        config = json.load(f)
+    config["everparse_path"] = os.path.abspath(config["everparse_path"])
+    config["tests"] = args.tests
+    ## The compile cache is safe to share between concurrent attempts.
+    compile_cache = config.get("compile_cache", "everparse_files/.cache")
+    if compile_cache:
+        config["compile_cache"] = os.path.abspath(compile_cache)
+    ## So are the memoized packet verdicts.
+    verdict_cache = config.get("verdict_cache", "everparse_files/.cache/verdicts.db")
+    if verdict_cache:
+        config["verdict_cache"] = os.path.abspath(verdict_cache)
+    return config
+
+
+def attempt_worker(config_list, args, config, workspace, filename, attempt):
+    """
+    Run one attempt in its own workspace (config.json, everparse_files/) and with its own log
+    """
+    global logger
+    os.makedirs(workspace)
+    os.chdir(workspace)
+    with open("config.json", "w") as f:
+        json.dump(config, f)
+
+    logger = AsyncMessageLogger(filename) if args.async_log else MessageLogger(filename)
+    results = run_attempt(config_list, args, filename, attempt)
+    results["workspace"] = workspace
+    with open("results.json", "w") as f:
+        json.dump(results, f)
+    logger.close()
+    ## Pool workers exit without running atexit handlers.
+    tracing.write()
+    return results
+
+
+def summarize_attempts(proto, attempts):
+    successes = [r for r in attempts if r["success"]]
+    return {
+        "protocol": proto,
+        "attempts": len(attempts),
+        "successes": len(successes),
+        "success_rate": len(successes) / len(attempts) if attempts else 0,
+        "avg_syntax_refinements": sum(r["syntax_refinements"] for r in attempts) / len(attempts) if attempts else 0,
+        "avg_packet_refinements": sum(r["packet_refinements"] for r in attempts) / len(attempts) if attempts else 0,
+        "spec_files": [r["spec_file"] for r in successes],
+        "results": attempts,
+    }
+
+
+def run_parallel(config_list, args, log_dir):
+    """
+    Run all attempts concurrently, at most args.parallel at a time, each in its own workspace under everparse_files/runs/
+    """
+    config = isolate_paths(args)
+    run_id = f"{args.proto}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{os.getpid()}"
+    run_dir = os.path.abspath(os.path.join("everparse_files", "runs", run_id))
+    log_dir = os.path.abspath(log_dir)
+    print(f"Running {args.attempt} attempts, {args.parallel} at a time, in {run_dir}")
+
+    with ProcessPoolExecutor(max_workers=args.parallel) as pool:
+        futures = [
+            pool.submit(attempt_worker, config_list, args, config, os.path.join(run_dir, f"attempt_{i+1}"), os.path.join(log_dir, f"{run_id}_attempt_{i+1}.jsonl"), i)
+            for i in range(args.attempt)
+        ]
+        attempts = [future.result() for future in futures]
+
+    summary = summarize_attempts(args.proto, attempts)
+    problem_dir = os.path.join(root_dir, "experiments/RFCs/", args.proto)
+    if not os.path.exists(problem_dir):
+        os.makedirs(problem_dir)
+    summary_file = os.path.join(problem_dir, f"{run_id}_summary.json")
+    with open(summary_file, "w") as f:
+        json.dump(summary, f, indent=4)
+
+    print("*"*50)
+    print(f"{args.proto}: {summary['successes']}/{summary['attempts']} attempts succeeded, avg syntax refinements {summary['avg_syntax_refinements']:.1f}, avg packet refinements {summary['avg_packet_refinements']:.1f}")
+    print(f"Summary written to {summary_file}")
+    return summary
+
+
 if __name__ == "__main__":
     args = parse_command_line_args()
-    generate_config(args)
+    if args.trace is not None:
+        tracing.enable(args.trace)
+    isolated = args.parallel > 1 or args.isolate
+    ## Isolated attempts get their own config.json, the shared one is only read.
+    if not isolated:
+        generate_config(args)
     config_list = setup()
     
     log_dir = "agents/RFC_agent/agent_log"
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
-    filename = os.path.join(log_dir, f"{args.proto}_{int(time.time())}.jsonl")
 
-    logger = MessageLogger(filename)
-    print("*"*50)
-    print(f"Running with the following configuration: \n{args}")
-    print(f"Logging internal agent messages to {filename}")
-    
-    for i in range(args.attempt):
-        print("*"*50)
-        print(f"Attempt {i+1}")
+    if isolated:
         print("*"*50)
+        print(f"Running with the following configuration: \n{args}")
+        run_parallel(config_list, args, log_dir)
+    else:
+        filename = os.path.join(log_dir, f"{args.proto}_{int(time.time())}.jsonl")
 
-        request_success = False
-        while not request_success:
-            try:
-                agent_loop(config_list, args)
-                request_success = True
-            except Exception as e:
-                print(f"Error: {e}")
-                print("Retrying......")
-                time.sleep(60)
-                continue
-        
-        success = False
-        syntax_refinements = 0
-        packet_refinements = 0
-        spec_file =""
-        with open(filename, "r") as f:
-            for line in f:
-                if "All packets accepted" in line:
-                    success = True
-                    spec_file = line.split("everparse_files/")[-1].split(".3d")[0]
-                    spec_file = "everparse_files/" + spec_file + ".3d"
-                    spec_file = os.path.abspath(spec_file)
-                else:
-                    success = False
-                if "Processing files: everparse_files/" in line or "syntax error" in line:
-                    syntax_refinements += 1
-                if "Packet failed" in line:
-                    packet_refinements += 1  
-        
-        results = {"protocol": args.proto, "params" : f"{str(args)}", "success": success, "filename": filename, "syntax_refinements": syntax_refinements, "packet_refinements": packet_refinements}
-        print(results)
-        with open(filename, "a") as f:
-            json.dump(results, f)
-            
-        experiment_dir = os.path.abspath("experiments/RFCs/")
-        problem_dir = os.path.join(experiment_dir, args.proto)
-        
-        if not os.path.exists(problem_dir):
-            os.mkdir(problem_dir)
-        if not os.path.exists(experiment_dir):
-            os.mkdir(experiment_dir)
-        print(f"Copying {filename} to {problem_dir}")
-        call = f"cp {filename} {problem_dir}"
-        os.system(call)
-        print(f"Copying {spec_file} to {problem_dir}")
-        call = f"cp {spec_file} {problem_dir}"
-        os.system(call)
-   
+        logger = AsyncMessageLogger(filename) if args.async_log else MessageLogger(filename)
+        print("*"*50)
+        print(f"Running with the following configuration: \n{args}")
+        print(f"Logging internal agent messages to {filename}")
         
-       
-    
-    
+        for i in range(args.attempt):
+            print("*"*50)
+            print(f"Attempt {i+1}")
+            print("*"*50)
+
+            run_attempt(config_list, args, filename, i)
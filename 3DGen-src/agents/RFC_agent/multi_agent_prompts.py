@@ -5,7 +5,7 @@ def get_task_prompt(rfc, message):
                     We are only interested in translating the RFC specifications of the each header message format into 3D.\
                     Generate only code needed to specify {message}.\
                     Make sure you add all constraints to the  fields in each message type.\
-                    Here is the RFC, only use relevant parts for the header format specification: \n\n {rfc} \n\n Please reflect on your code to make sure it is correct and make sure you give it your best shot! Execute code with the supplied function only."                    "
+                    Here is the RFC, only use relevant parts for the header format specification: \n\n {rfc} \n\n Please reflect on your code to make sure it is correct and make sure you give it your best shot! Execute code with the supplied function only."
     return task_prompt
 
 
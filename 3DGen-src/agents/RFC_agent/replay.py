@@ -0,0 +1,184 @@
+import os
+import re
+import json
+import time
+import argparse
+import autogen
+import agents.RFC_agent.multi_agent_collab as collab
+from logger import MessageLogger, read_log
+from test_utils import evaluate_code
+
+"""
+Deterministic, offline replay of agent sessions.
+
+A session is read from an agent log written by MessageLogger (one JSON record per message,
+see multi_agent_collab.print_messages). The Developer agent is built exactly like in
+multi_agent_collab.agent_config, but instead of querying the LLM it answers with the recorded
+Developer messages, in order. The Executor runs the real evaluate_code function calls, so
+EverParse, packet checking and the orchestration overhead can be timed end to end without
+network access. Whenever the replayed Executor answer differs from the recorded one (e.g.
+because the toolchain or the test set changed), the divergence is counted and reported. The
+recorded responses take the place of the LLM reply behind autogen's termination check, so a
+replay that ends earlier or later than the recorded session is a divergence too.
+
+Only logs that record the Developer's messages can be replayed. These are logged since
+multi_agent_collab also hooks print_messages into the Executor; older logs only contain the
+messages received by the Developer.
+"""
+
+
+def load_sessions(log_file):
+    """
+    Split a log into sessions (attempts). A session starts with the task message (n == 1).
+    """
+    sessions = []
+    for record in read_log(log_file):
+        if "sender" not in record:
+            continue
+        if record["n"] == "1" or not sessions:
+            sessions.append([])
+        sessions[-1].append(record)
+    return sessions
+
+
+def normalize(message):
+    ## Submissions are written to Tmp_<timestamp>.3d, which differs between the recording and the replay.
+    content = message.get("content", "") if isinstance(message, dict) else message
+    return re.sub(r"Tmp_\d+", "Tmp_*", content or "")
+
+
+class Replay:
+    """
+    Serve the recorded Developer messages of a session and compare the Executor's answers with the recorded ones
+    """
+    def __init__(self, session):
+        self.task = session[0]["content"]
+        self.responses = [r["content"] for r in session if r["sender"] == "Developer"]
+        self.expected = [r["content"] for r in session[1:] if r["sender"] == "Executor"]
+        self.turn = 0
+        self.compared = 0
+        self.divergences = []
+
+    def compare(self, messages):
+        ## messages[-1] is the Executor's answer to the previous recorded response.
+        if 0 < self.turn <= len(self.expected) and self.compared < self.turn:
+            self.compared = self.turn
+            actual = normalize(messages[-1])
+            expected = normalize(self.expected[self.turn - 1])
+            if actual != expected:
+                self.divergences.append({"turn": self.turn, "expected": expected, "actual": actual})
+
+    def reply(self, recipient, messages, sender, config):
+        self.compare(messages)
+        if self.turn >= len(self.responses):
+            ## The recorded session ended here, the replayed one would have gone on.
+            self.divergences.append({"turn": self.turn, "expected": "(session ended)", "actual": "(session continued)"})
+            return True, None
+        response = self.responses[self.turn]
+        self.turn += 1
+        ## autogen expects the reply as a message dict without the role, which is set by the receiver.
+        if isinstance(response, dict):
+            response = {k: v for k, v in response.items() if k in ["content", "function_call", "tool_calls"]}
+        return True, response
+
+    def finish(self, messages):
+        """
+        Compare the answer the replayed session ended on, and whether it ended where the recorded one did
+        """
+        self.compare(messages)
+        if self.turn < len(self.responses):
+            self.divergences.append({"turn": self.turn, "expected": "(session continued)", "actual": "(session ended)"})
+
+
+def behind_termination(agent):
+    ## Replies in front of check_termination_and_human_reply would skip is_termination_msg and max_consecutive_auto_reply.
+    replies = [entry["reply_func"] for entry in agent._reply_func_list]
+    return replies.index(autogen.ConversableAgent.check_termination_and_human_reply) + 1
+
+
+def timed(function, timings):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings.append(time.perf_counter() - start)
+    wrapper.__name__ = function.__name__
+    return wrapper
+
+
+def replay_session(session, args, log_file):
+    """
+    Replay one session and return a report with timings and divergences
+    """
+    replay = Replay(session)
+    ## The LLM is never queried, the endpoint is a placeholder.
+    config_list = [{"model": "replay", "api_key": "replay"}]
+    llm_config = collab.get_agent_skills(config_list, args)
+
+    collab.logger = MessageLogger(log_file)
+    developer, executor = collab.agent_config(llm_config, "", "", args.n)
+    ## In place of the LLM reply, behind the termination check, so a replay ends where the recorded session should have.
+    developer.register_reply([autogen.Agent, None], reply_func=replay.reply, position=behind_termination(developer))
+
+    timings = []
+    executor.register_function(function_map={"evaluate_code": timed(evaluate_code, timings)})
+
+    task = replay.task.get("content", "") if isinstance(replay.task, dict) else replay.task
+    start = time.perf_counter()
+    executor.initiate_chat(developer, message=task)
+    wall = time.perf_counter() - start
+    replay.finish(developer.chat_messages[executor])
+
+    return {
+        "turns": replay.turn,
+        "recorded_turns": len(replay.responses),
+        "wall_time": wall,
+        "evaluate_code_calls": len(timings),
+        "evaluate_code_time": sum(timings),
+        "orchestration_time": wall - sum(timings),
+        "divergences": replay.divergences,
+    }
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", type=str, required=True, help="Agent log (.jsonl) to replay")
+    parser.add_argument("--session", type=int, required=False, help="Index of the session (attempt) in the log, all sessions if not given")
+    parser.add_argument("--tests", type=str, required=False, help="path to tests", default="none")
+    parser.add_argument("--n", type=int, required=False, help="Number of refinements loops allowed", default=15)
+    parser.add_argument("--temp", type=float, required=False, help="Main agent loop temperature", default=1.0)
+    parser.add_argument("--out", type=str, required=False, help="Write the replay report to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_command_line_args()
+    ## evaluate_code reads the test set from config.json.
+    with open("config.json", "r") as f:
+        config = json.load(f)
+    config["tests"] = args.tests
+    with open("config.json", "w") as f:
+        json.dump(config, f)
+
+    sessions = load_sessions(args.log)
+    indices = range(len(sessions)) if args.session is None else [args.session]
+    log_dir = "agents/RFC_agent/agent_log"
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    reports = []
+    for i in indices:
+        print("*"*50)
+        print(f"Replaying session {i} of {args.log}")
+        print("*"*50)
+        report = replay_session(sessions[i], args, os.path.join(log_dir, f"replay_{int(time.time())}_{i}.jsonl"))
+        report["session"] = i
+        reports.append(report)
+        print(f"Session {i}: {report['turns']}/{report['recorded_turns']} turns, wall {report['wall_time']:.2f}s, "
+              f"evaluate_code {report['evaluate_code_time']:.2f}s in {report['evaluate_code_calls']} calls, "
+              f"orchestration {report['orchestration_time']:.2f}s, {len(report['divergences'])} divergences")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(reports, f, indent=4)
@@ -0,0 +1,253 @@
+import os
+import re
+import glob
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from tracing import span
+
+"""
+Batch packet checker for EverParse generated validators.
+
+EverParse's --test_checker builds a test.exe that validates exactly one packet per
+invocation, so checking a directory of witnesses costs one process (and one shell)
+per .dat file. Instead, we recompile the generated C sources once into a long-lived
+checker process: the generated test driver's main() is renamed with -Dmain=... and a
+small driver loop calls it once for every packet path read from stdin. After each
+packet the driver prints a sentinel line, which lets us split stdout/stderr into the
+same per-packet (output_err, output_dump) pairs that test.exe would have produced.
+"""
+
+SENTINEL = "@@3DGEN_BATCH_CHECKER_DONE@@"
+## A definition of main(), not a call of e.g. everparse_test_main( or a mention in a comment.
+main_definition = re.compile(r"^\s*int\s+main\s*\(", re.MULTILINE)
+
+driver_source = r"""
+#undef main
+#include <stdio.h>
+#include <string.h>
+
+int everparse_test_main(int argc, char **argv);
+
+int main(void) {
+  static char path[8192];
+  while (fgets(path, sizeof path, stdin)) {
+    path[strcspn(path, "\r\n")] = 0;
+    char *argv[] = { "test.exe", path, NULL };
+    int rc = everparse_test_main(2, argv);
+    fflush(stderr);
+    printf("\n%s %d\n", "__SENTINEL__", rc);
+    fflush(stdout);
+  }
+  return 0;
+}
+"""
+
+
+def find_sources(exe_dir, module_file=None):
+    """
+    Collect the C sources of the test checker in exe_dir. The odir is shared by every
+    submission of a module, so if module_file (e.g. Tmp_20240319174520) is given we only
+    pick that module's sources plus the most recent file defining main().
+    """
+    sources = []
+    if module_file is not None:
+        for name in [f"{module_file}.c", f"{module_file}Wrapper.c"]:
+            path = os.path.join(exe_dir, name)
+            if os.path.exists(path):
+                sources.append(path)
+    else:
+        sources = [c for c in glob.glob(os.path.join(exe_dir, "*.c")) if not c.endswith("batch_driver.c")]
+
+    mains = []
+    for c in glob.glob(os.path.join(exe_dir, "*.c")):
+        if c.endswith("batch_driver.c"):
+            continue
+        with open(c, "r", errors="ignore") as f:
+            if main_definition.search(f.read()):
+                mains.append(c)
+    if not mains:
+        return []
+    test_main = max(mains, key=os.path.getmtime)
+    if test_main not in sources:
+        sources.append(test_main)
+    return sources
+
+
+def build_checker(exe_dir, module_file=None):
+    """
+    Compile the batch checker next to test.exe. Returns the path of the executable or None
+    if the generated sources could not be found or compiled.
+    """
+    exe_dir = os.path.abspath(exe_dir)
+    sources = find_sources(exe_dir, module_file)
+    if not sources:
+        print(f"Batch checker: no test checker sources found in {exe_dir}")
+        return None
+
+    driver = os.path.join(exe_dir, "batch_driver.c")
+    with open(driver, "w") as f:
+        f.write(driver_source.replace("__SENTINEL__", SENTINEL))
+
+    exe = os.path.join(exe_dir, "batch_test.exe")
+    cc = os.environ.get("CC", "cc")
+    call = f"{cc} -O2 -Dmain=everparse_test_main -I{exe_dir} {' '.join(sources)} {driver} -o {exe}"
+    with span("build_checker", sources=len(sources)):
+        sp = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = sp.communicate()
+    if sp.returncode != 0:
+        print(f"Batch checker: {call} failed with error code: {sp.returncode} and error message: {err.decode('utf-8')}")
+        return None
+    return exe
+
+
+class BatchChecker:
+    """
+    Long-lived checker process that validates many packets
+    """
+    def __init__(self, exe):
+        self.exe = exe
+        self.proc = None
+        self.err_file = None
+        self.err_offset = 0
+
+    def start(self):
+        self.err_file = tempfile.TemporaryFile()
+        self.err_offset = 0
+        self.proc = subprocess.Popen([self.exe], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.err_file, text=True, bufsize=1)
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+            self.proc.wait()
+            self.proc = None
+        if self.err_file is not None:
+            self.err_file.close()
+            self.err_file = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read_err(self):
+        self.err_file.seek(self.err_offset)
+        err = self.err_file.read()
+        self.err_offset += len(err)
+        return err.decode("utf-8", errors="replace")
+
+    def check(self, packet_path):
+        """
+        Validate a single packet, returns (output_err, output_dump) like a test.exe call.
+        If the checker process dies on a packet, it is restarted for the next one.
+        """
+        if self.proc is None:
+            self.start()
+        out = []
+        try:
+            self.proc.stdin.write(packet_path + "\n")
+            self.proc.stdin.flush()
+            for line in self.proc.stdout:
+                if line.startswith(SENTINEL):
+                    ## Drop the newline the driver emits in front of the sentinel.
+                    if out and out[-1] == "\n":
+                        out.pop()
+                    return self.read_err(), "".join(out)
+                out.append(line)
+        except BrokenPipeError:
+            pass
+        ## The driver exited (e.g. the test main called exit()), what we read so far is the verdict.
+        self.proc.wait()
+        err = self.read_err()
+        self.proc = None
+        self.err_file.close()
+        self.err_file = None
+        return err, "".join(out)
+
+    def check_all(self, packet_paths):
+        return {os.path.basename(path): self.check(path) for path in packet_paths}
+
+
+def run_single(exe_dir, packet_path):
+    call = f"{exe_dir}/test.exe {packet_path}"
+    print(call)
+    with span("test.exe"):
+        output = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output_dump = output.stdout.read().decode("utf-8")
+        output_err = output.stderr.read().decode("utf-8")
+        output.wait()
+    return output_err, output_dump
+
+
+class PacketChecker:
+    """
+    Validates packets one at a time, in the caller's order, so checking can stop at the first mismatch.
+    The batch checker is built on the first packet, test.exe is the fallback.
+    """
+    def __init__(self, exe_dir, module_file=None, batch=True):
+        self.exe_dir = exe_dir
+        self.module_file = module_file
+        self.batch = batch
+        self.checker = None
+
+    def check(self, packet_path):
+        if self.batch and self.checker is None:
+            exe = build_checker(self.exe_dir, self.module_file)
+            if exe is None:
+                print("Batch checker unavailable, falling back to test.exe")
+                self.batch = False
+            else:
+                self.checker = BatchChecker(exe)
+        if self.checker is not None:
+            return self.checker.check(packet_path)
+        return run_single(self.exe_dir, packet_path)
+
+    def close(self):
+        if self.checker is not None:
+            self.checker.close()
+            self.checker = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def check_dir(dir, exe_dir, module_file=None, packets=None, workers=1, stage=None):
+    """
+    Validate all .dat files in dir with a single checker process. Returns a map
+    {packet: (output_err, output_dump)} to be passed to process_packet_results.
+    With workers > 1 the packets are sharded over that many checker processes.
+    Falls back to one test.exe call per packet if the batch checker can't be built.
+    stage maps a packet name to the path of a file with the packet (of the same name), for packed corpora.
+    """
+    if packets is None:
+        packets = [p for p in os.listdir(dir) if p.endswith(".dat")]
+    paths = [stage(p) if stage is not None else os.path.join(dir, p) for p in packets]
+    workers = max(1, min(workers, len(paths)))
+
+    exe = build_checker(exe_dir, module_file)
+    if exe is None:
+        print("Batch checker unavailable, falling back to test.exe")
+        with ThreadPoolExecutor(workers) as pool:
+            return dict(zip(packets, pool.map(lambda path: run_single(exe_dir, path), paths)))
+
+    def run_shard(shard):
+        with span("batch_checker", packets=len(shard)), BatchChecker(exe) as checker:
+            return checker.check_all(shard)
+
+    if workers == 1:
+        return run_shard(paths)
+
+    ## Each thread drives its own checker process, the validation itself runs in parallel.
+    verdicts = {}
+    with ThreadPoolExecutor(workers) as pool:
+        for shard_verdicts in pool.map(run_shard, [paths[i::workers] for i in range(workers)]):
+            verdicts.update(shard_verdicts)
+    return verdicts
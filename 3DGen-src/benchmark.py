@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import time
+import glob
+import shutil
+import zipfile
+import platform
+import resource
+import argparse
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+import importlib.util
+import multiprocessing
+from manual_index import example_blocks
+from lint_3d import read_specs, lint
+
+"""
+Benchmarks of the pipeline stages on the shipped corpora.
+
+The fixtures are the test sets in packets.zip (packets/tests/100_n/<PROTOCOL>*/z3: witnesses, their
+labels and the .z3.pcap generated from them) and the .3d specs in experiments.zip, or, where it has
+none for a protocol, the specs of the Developer prompt's examples (examples/multi_agent_example.txt).
+Per protocol, the stages are
+    lint                  -- lint_3d.lint of the protocol's spec
+    generate_pcap         -- the .dat files to a .pcap (scapy)
+    validate              -- tshark labels of the .z3.pcap
+    validate_and_coverage -- the same with the dissector coverage (gcov)
+    evaluate_code         -- EverParse on the spec, without compile cache
+    check_packets         -- the test set against the validator evaluate_code built, without verdict cache
+Each stage runs warmup times, then repeat timed times and once more under tracemalloc, in a forked
+process of its own so the memory high-water marks (maxrss of the process and of the tools it ran) are
+per stage. Stages whose tools (scapy, tshark, everparse) are missing are skipped.
+
+Results are written as JSON and compared against a baseline: a stage regresses if its median latency
+or its Python memory peak grew by more than the threshold, and the run then exits with 1.
+
+    python benchmark.py run --out experiments/benchmarks/latest.json --baseline experiments/benchmarks/baseline.json
+    python benchmark.py run --protocols TCP,UDP --stages lint,validate --save_baseline experiments/benchmarks/baseline.json
+    python benchmark.py compare experiments/benchmarks/latest.json experiments/benchmarks/baseline.json
+"""
+
+stages = ["lint", "generate_pcap", "validate", "validate_and_coverage", "evaluate_code", "check_packets"]
+tests_root = "packets/tests/100_n"
+## Protocols whose specs' entrypoints are named differently from their test sets.
+spec_names = {"ETH": "ETHERNET"}
+
+
+def protocol_name(test_set):
+    ## Test sets are named <PROTOCOL> or <PROTOCOL>_batch_tests_<date>.
+    return os.path.basename(test_set).split("_")[0].upper()
+
+
+def extract_fixtures(packets_zip, dir):
+    """
+    {protocol: test set folder (containing z3/)} of the test sets in packets.zip, extracted to dir
+    """
+    with zipfile.ZipFile(packets_zip) as z:
+        z.extractall(dir, [name for name in z.namelist() if name.startswith(tests_root) and "__MACOSX" not in name])
+    root = os.path.join(dir, tests_root)
+    return {protocol_name(name): os.path.join(root, name) for name in sorted(os.listdir(root)) if os.path.isdir(os.path.join(root, name, "z3"))}
+
+
+def entrypoint(spec):
+    match = re.search(r"entrypoint\s+typedef\s+struct\s+(\w+)", spec)
+    return match.group(1) if match else None
+
+
+def example_specs(example):
+    with open(example, "r") as f:
+        blocks = example_blocks(f.read())
+    for i, block in enumerate(blocks):
+        match = re.search(r"(?:final 3d code|output 3d code):\s*\n(.*?)\nModule name:\s*\n\s*(\w+)", block, re.DOTALL | re.IGNORECASE)
+        if match:
+            yield f"{example}:{i}", match.group(1)
+
+
+def spec_fixtures(paths, example, protocols):
+    """
+    {protocol: (name, spec, module name)}, the first spec whose entrypoint names the protocol
+    """
+    fixtures = {}
+    specs = list(read_specs([p for p in paths if os.path.exists(p)]))
+    if example is not None and os.path.exists(example):
+        specs += list(example_specs(example))
+    for name, spec in specs:
+        module = entrypoint(spec)
+        if module is None:
+            continue
+        ## The longest protocol name in the entrypoint, IPV6 rather than IP.
+        matches = [p for p in protocols if re.search(rf"(^|_){spec_names.get(p, p)}(_|$)", module.upper())]
+        if matches:
+            protocol = max(matches, key=len)
+            fixtures.setdefault(protocol, (name, spec, module))
+    return fixtures
+
+
+def missing(stage, config):
+    """
+    Why the stage can't run here, None if it can
+    """
+    if stage == "generate_pcap" and not all(importlib.util.find_spec(m) for m in ["scapy", "pyshark"]):
+        return "scapy or pyshark not installed"
+    if stage in ["validate", "validate_and_coverage"] and (shutil.which("tshark") is None or importlib.util.find_spec("pyshark") is None):
+        return "tshark or pyshark not installed"
+    if stage in ["evaluate_code", "check_packets"] and not os.path.exists(config.get("everparse_path", "")):
+        return "everparse not found, set everparse_path in config.json"
+    return None
+
+
+def measure(run, warmup, repeat):
+    """
+    Latency, throughput and memory of run(), which returns the number of items (packets, specs) it processed
+    """
+    for _ in range(warmup):
+        run()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = run()
+        times.append(time.perf_counter() - start)
+    ## The memory run is not timed, tracemalloc slows Python down.
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    median = statistics.median(times)
+    return {
+        "items": items,
+        "repeat": repeat,
+        "latency_s": {"min": min(times), "median": median, "mean": statistics.mean(times), "max": max(times),
+                      "stdev": statistics.stdev(times) if len(times) > 1 else 0.0},
+        "latency_per_item_ms": 1000 * median / max(items, 1),
+        "throughput": items / median if median > 0 else 0.0,
+        "py_peak_kb": peak // 1024,
+        "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children_maxrss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def isolated(function, cwd = None, verbose = False):
+    """
+    function() in a forked process, with its stdout silenced unless verbose
+    """
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(False)
+
+    def target():
+        if not verbose:
+            sys.stdout.flush()
+            os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+        if cwd is not None:
+            os.chdir(cwd)
+        try:
+            result = function()
+        except BaseException as e:
+            result = {"error": repr(e)}
+        sys.stdout.flush()
+        sender.send(result)
+
+    sys.stdout.flush()
+    process = context.Process(target=target)
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": "benchmark process died"}
+    process.join()
+    return result
+
+
+def stage_run(stage, protocol, test_set, spec, workspace):
+    """
+    The function running the stage once for the protocol's fixtures
+    """
+    z3_dir = os.path.join(test_set, "z3")
+    pcaps = sorted(glob.glob(os.path.join(z3_dir, "*.z3.pcap")))
+    if stage == "lint":
+        return lambda: (lint(spec[1], spec[2]), 1)[1]
+    if stage == "generate_pcap":
+        from combine_dats_to_pcap import generate_pcap
+        pcap = os.path.join(workspace, f"{protocol}.bench.pcap")
+        packets = len(glob.glob(os.path.join(z3_dir, "*.dat")))
+        return lambda: (generate_pcap(z3_dir, protocol.lower(), pcap), packets)[1]
+    if stage == "validate":
+        from validate_with_tshark import validate, proto_alias
+        return lambda: len(validate(pcaps[0], proto_alias[protocol.lower()])[0])
+    if stage == "validate_and_coverage":
+        from validate_with_tshark import validate_and_coverage
+        return lambda: len(validate_and_coverage(pcaps[0], protocol.lower())[0])
+    if stage == "evaluate_code":
+        import test_utils
+        output = {}
+        def evaluate():
+            output["accepted"] = "EverParse succeeded" in test_utils.evaluate_code(spec[1], spec[2], protocol)[1]
+            return 1
+        evaluate.output = output
+        return evaluate
+    if stage == "check_packets":
+        import test_utils
+        exe_dir = os.path.join(workspace, "everparse_files", spec[2])
+        module_file = os.path.basename(max(glob.glob(os.path.join(exe_dir, "Tmp_*.3d")), key=os.path.getmtime))[:-len(".3d")]
+        packets = len(glob.glob(os.path.join(z3_dir, "*.dat")))
+        output = {}
+        def check():
+            ## A mismatch stops check_packets early, a throughput is only comparable for the same verdicts.
+            output["all_accepted"] = test_utils.check_packets(test_set, exe_dir, module_file) == "All packets accepted"
+            return packets
+        check.output = output
+        return check
+
+
+def prerequisite(stage, protocol, test_set, spec, results):
+    """
+    Why the stage can't run for the protocol's fixtures, None if it can
+    """
+    if stage in ["lint", "evaluate_code", "check_packets"] and spec is None:
+        return "no spec for the protocol"
+    if stage in ["validate", "validate_and_coverage"] and not glob.glob(os.path.join(test_set, "z3", "*.z3.pcap")):
+        return "no .z3.pcap in the test set"
+    if stage == "check_packets" and not results.get(f"evaluate_code/{protocol}", {}).get("accepted"):
+        return "evaluate_code did not build a validator"
+    return None
+
+
+def run(args):
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config, "r") as f:
+            config = json.load(f)
+    selected = args.stages.split(",") if args.stages else stages
+    results, skipped = {}, {}
+    with tempfile.TemporaryDirectory() as fixtures_dir:
+        test_sets = extract_fixtures(args.packets, fixtures_dir)
+        if args.protocols:
+            test_sets = {p: t for p, t in test_sets.items() if p in args.protocols.upper().split(",")}
+        specs = spec_fixtures(args.specs, args.example, list(test_sets))
+
+        ## evaluate_code works in everparse_files/ of the working directory and reads config.json there.
+        workspace = os.path.join(fixtures_dir, "workspace")
+        os.makedirs(workspace)
+        if "everparse_path" in config:
+            config["everparse_path"] = os.path.abspath(config["everparse_path"])
+        config.update({"tests": "none", "compile_cache": "", "verdict_cache": ""})
+        with open(os.path.join(workspace, "config.json"), "w") as f:
+            json.dump(config, f)
+
+        for stage in selected:
+            reason = missing(stage, config)
+            if reason is not None:
+                skipped[stage] = reason
+                print(f"Skipping {stage}: {reason}")
+                continue
+            for protocol, test_set in test_sets.items():
+                key = f"{stage}/{protocol}"
+                spec = specs.get(protocol)
+                reason = prerequisite(stage, protocol, test_set, spec, results)
+                if reason is not None:
+                    skipped[key] = reason
+                    continue
+
+                def benchmark_stage():
+                    stage_function = stage_run(stage, protocol, test_set, spec, workspace)
+                    result = measure(stage_function, args.warmup, args.repeat)
+                    ## Whether the spec was accepted (check_packets needs its validator) and the packets matched their labels.
+                    result.update(getattr(stage_function, "output", {}))
+                    return result
+                result = isolated(benchmark_stage, workspace, args.verbose)
+                if "error" in result:
+                    skipped[key] = result["error"]
+                    print(f"{key:<40} failed: {result['error']}")
+                    continue
+                if spec is not None and stage in ["lint", "evaluate_code", "check_packets"]:
+                    result["spec"] = spec[0]
+                results[key] = result
+                print(f"{key:<40}{1000 * result['latency_s']['median']:>10.2f}ms{result['throughput']:>12.1f}/s{result['py_peak_kb']:>10}kB{result['children_maxrss_kb']:>10}kB")
+
+    report = {
+        "version": 1,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "commit": git_commit(),
+        "warmup": args.warmup,
+        "repeat": args.repeat,
+        "results": results,
+        "skipped": skipped,
+    }
+    if os.path.dirname(args.out):
+        os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"{len(results)} benchmarks, {len(skipped)} skipped, written to {args.out}")
+    if args.save_baseline:
+        shutil.copy(args.out, args.save_baseline)
+        print(f"Saved as baseline {args.save_baseline}")
+    return report
+
+
+def git_commit():
+    sp = subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    out, _ = sp.communicate()
+    return out.decode("utf-8").strip() or None
+
+
+def compare(report, baseline, threshold):
+    """
+    Benchmarks in both reports whose median latency or Python memory peak grew by more than threshold
+    """
+    regressions = []
+    print(f"{'benchmark':<40}{'median':>12}{'baseline':>12}{'change':>9}{'py peak':>12}{'baseline':>12}")
+    for key, result in sorted(report["results"].items()):
+        if key not in baseline["results"]:
+            continue
+        base = baseline["results"][key]
+        now, before = result["latency_s"]["median"], base["latency_s"]["median"]
+        change = now / before - 1 if before > 0 else 0.0
+        memory = result["py_peak_kb"] / base["py_peak_kb"] - 1 if base["py_peak_kb"] > 0 else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append((key, "latency", change))
+            flag = "  SLOWER"
+        if memory > threshold:
+            regressions.append((key, "memory", memory))
+            flag += "  MORE MEMORY"
+        print(f"{key:<40}{1000 * now:>10.2f}ms{1000 * before:>10.2f}ms{100 * change:>+8.1f}%{result['py_peak_kb']:>10}kB{base['py_peak_kb']:>10}kB{flag}")
+    for key in sorted(set(baseline["results"]) - set(report["results"])):
+        reason = report["skipped"].get(key) or report["skipped"].get(key.split("/")[0]) or "not selected"
+        print(f"{key:<40} not run ({reason})")
+    if regressions:
+        print(f"{len(regressions)} regressions beyond {100 * threshold:.0f}%")
+    else:
+        print(f"No regressions beyond {100 * threshold:.0f}%")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['run', 'compare'], help='run: run the benchmarks, compare: compare two result files')
+    parser.add_argument('files', nargs='*', help='compare: results and baseline JSON')
+    parser.add_argument('--packets', type=str, help='/path/to/packets.zip with the test sets', default='packets.zip')
+    parser.add_argument('--specs', type=str, nargs='*', help='.3d specs: files, directories or zips', default=['experiments.zip'])
+    parser.add_argument('--example', type=str, help='Examples of the Developer prompt, specs for protocols without one in --specs', default='examples/multi_agent_example.txt')
+    parser.add_argument('--config', type=str, help='config.json with the everparse_path', default='config.json')
+    parser.add_argument('--protocols', type=str, help='Comma separated protocols, all test sets by default', required=False)
+    parser.add_argument('--stages', type=str, help=f'Comma separated stages of {",".join(stages)}, all by default', required=False)
+    parser.add_argument('--warmup', type=int, help='Untimed runs before measuring', default=1)
+    parser.add_argument('--repeat', type=int, help='Timed runs', default=5)
+    parser.add_argument('--out', type=str, help='Results JSON', default='experiments/benchmarks/latest.json')
+    parser.add_argument('--baseline', type=str, help='Baseline results JSON to compare against', required=False)
+    parser.add_argument('--save_baseline', type=str, help='Also save the results as this baseline', required=False)
+    parser.add_argument('--threshold', type=float, help='Allowed relative slowdown (and memory growth) before failing', default=0.2)
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the stages', required=False)
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        if len(args.files) != 2:
+            parser.error("compare takes the results and the baseline JSON")
+        report_file, baseline_file = args.files
+    else:
+        report = run(args)
+        if args.baseline is None:
+            return 0
+        report_file, baseline_file = args.out, args.baseline
+    with open(report_file, "r") as f:
+        report = json.load(f)
+    if not os.path.exists(baseline_file):
+        print(f"No baseline {baseline_file}")
+        return 0
+    with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+    return 1 if compare(report, baseline, args.threshold) else 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import subprocess
+from multiprocessing import Process
+
+"""
+This script schedules a campaign, i.e., the protocol matrix of multi_agent_collab.py and
+3dgen_tests.py runs, on a pool of worker processes.
+
+A campaign is described by a JSON file:
+
+{
+    "protocols": ["TCP", "UDP"],
+    "rfcs": {"TCP": ["https://www.rfc-editor.org/rfc/rfc9293.txt"], "UDP": ["rfc768.json"]},
+    "tests": {"TCP": ["packets/tests/100_n/TCP"], "UDP": ["none"]},
+    "attempts": 5,
+    "agent_args": ["--n", "15"],
+    "testgen": {"TCP": {"spec": "specs/TCP.3d", "out": "tests/TCP", "z3_branch_depth": 100, "z3_witnesses": 10}}
+}
+
+Every protocol x RFC source x test directory x attempt becomes one agent job, and every entry of
+"testgen" one 3dgen_tests.py job. Agent jobs whose test directory is the output of a testgen job
+depend on it. Jobs are stored in a SQLite database that acts as the job queue:
+- `init` adds the jobs of a campaign file to the queue; jobs that are already known are kept as is,
+  so a campaign can be extended or re-initialized without redoing finished work.
+- `run` starts a pool of local worker processes, `worker` a single worker. Workers on other hosts
+  can pull from the same queue by pointing `--db` at a database on a shared file system.
+- `status` prints the state of the queue.
+
+Workers claim jobs in a transaction and keep a heartbeat while the job runs. Jobs of workers that
+died (no heartbeat for --lease seconds) are handed out again, so an interrupted campaign resumes
+where it stopped. To keep the makespan short, ready jobs are claimed in order of their bottom level,
+i.e., their estimated duration plus that of the longest chain of jobs waiting for them. Durations are
+estimated from the finished jobs of the same kind and protocol.
+"""
+
+## Jobs run from the 3DGen-src folder, like multi_agent_collab.py and 3dgen_tests.py expect.
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+## Duration estimates (seconds) for jobs without history.
+default_durations = {"testgen": 600, "agent": 1800}
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    protocol TEXT NOT NULL,
+    argv TEXT NOT NULL,
+    deps TEXT NOT NULL,
+    output TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    heartbeat REAL,
+    started REAL,
+    finished REAL,
+    returncode INTEGER,
+    tries INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+def connect(db):
+    conn = sqlite3.connect(db, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute(schema)
+    return conn
+
+
+def campaign_jobs(campaign):
+    """
+    Expand a campaign description into jobs
+    """
+    jobs = []
+    testgen_outputs = {}
+    for protocol, testgen in campaign.get("testgen", {}).items():
+        out = os.path.abspath(testgen["out"])
+        job_id = f"testgen:{protocol}:{testgen['out']}"
+        argv = [sys.executable, "3dgen_tests.py", "--protocol", protocol, "--out", out, "--spec", os.path.abspath(testgen["spec"]),
+                "--z3_branch_depth", str(testgen.get("z3_branch_depth", 0)), "--z3_witnesses", str(testgen.get("z3_witnesses", 10))]
+        jobs.append({"id": job_id, "kind": "testgen", "protocol": protocol, "argv": argv, "deps": [], "output": out})
+        testgen_outputs[out] = job_id
+
+    for protocol in campaign["protocols"]:
+        for rfc in campaign["rfcs"][protocol]:
+            for tests in campaign.get("tests", {}).get(protocol, ["none"]):
+                tests_path = tests if tests == "none" else os.path.abspath(tests)
+                deps = [testgen_outputs[tests_path]] if tests_path in testgen_outputs else []
+                for attempt in range(campaign.get("attempts", 1)):
+                    argv = [sys.executable, "-m", "agents.RFC_agent.multi_agent_collab", "--rfc", os.path.abspath(rfc) if os.path.exists(rfc) else rfc, "--proto", protocol,
+                            "--tests", tests_path, "--attempt", "1", "--isolate"] + campaign.get("agent_args", [])
+                    jobs.append({"id": f"agent:{protocol}:{rfc}:{tests}:{attempt+1}", "kind": "agent", "protocol": protocol, "argv": argv, "deps": deps, "output": None})
+    return jobs
+
+
+def init(db, campaign_file):
+    with open(campaign_file, "r") as f:
+        campaign = json.load(f)
+    jobs = campaign_jobs(campaign)
+    conn = connect(db)
+    added = 0
+    for job in jobs:
+        cur = conn.execute("INSERT OR IGNORE INTO jobs (id, kind, protocol, argv, deps, output) VALUES (?, ?, ?, ?, ?, ?)",
+                           (job["id"], job["kind"], job["protocol"], json.dumps(job["argv"]), json.dumps(job["deps"]), job["output"]))
+        added += cur.rowcount
+    print(f"Added {added} of {len(jobs)} jobs to {db}")
+    conn.close()
+
+
+def estimates(conn):
+    """
+    Average duration of finished jobs per (kind, protocol), falling back to the kind's default
+    """
+    history = {}
+    for row in conn.execute("SELECT kind, protocol, AVG(finished - started) AS duration FROM jobs WHERE state = 'done' GROUP BY kind, protocol"):
+        history[(row["kind"], row["protocol"])] = row["duration"]
+    return lambda job: history.get((job["kind"], job["protocol"]), default_durations[job["kind"]])
+
+
+def bottom_levels(jobs, estimate):
+    dependents = {job["id"]: [] for job in jobs}
+    for job in jobs:
+        for dep in json.loads(job["deps"]):
+            if dep in dependents:
+                dependents[dep].append(job["id"])
+    by_id = {job["id"]: job for job in jobs}
+    levels = {}
+
+    def level(job_id):
+        if job_id not in levels:
+            levels[job_id] = estimate(by_id[job_id]) + max([level(d) for d in dependents[job_id]], default=0)
+        return levels[job_id]
+
+    for job in jobs:
+        level(job["id"])
+    return levels
+
+
+def reclaim(conn, lease):
+    ## Jobs of workers that stopped sending heartbeats are handed out again.
+    cur = conn.execute("UPDATE jobs SET state = 'pending', worker = NULL WHERE state = 'running' AND heartbeat < ?", (time.time() - lease,))
+    if cur.rowcount:
+        print(f"Reclaimed {cur.rowcount} jobs of dead workers")
+
+
+def claim(conn, worker, lease, max_tries):
+    """
+    Atomically claim the ready job with the highest bottom level. Returns None if no job is ready.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        reclaim(conn, lease)
+        jobs = conn.execute("SELECT * FROM jobs WHERE state IN ('pending', 'running')").fetchall()
+        done = {row["id"] for row in conn.execute("SELECT id FROM jobs WHERE state = 'done'")}
+        ready = [job for job in jobs if job["state"] == "pending" and job["tries"] < max_tries and all(dep in done for dep in json.loads(job["deps"]))]
+        if not ready:
+            conn.execute("COMMIT")
+            return None
+        levels = bottom_levels(jobs, estimates(conn))
+        job = max(ready, key=lambda job: levels[job["id"]])
+        now = time.time()
+        conn.execute("UPDATE jobs SET state = 'running', worker = ?, heartbeat = ?, started = ?, tries = tries + 1 WHERE id = ?", (worker, now, now, job["id"]))
+        conn.execute("COMMIT")
+        return job
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def heartbeat(db, job_id, worker, stop, interval):
+    conn = connect(db)
+    while not stop.wait(interval):
+        conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ?", (time.time(), job_id, worker))
+    conn.close()
+
+
+def run_job(job, log_dir):
+    ## A testgen job that was interrupted leaves its output directory behind. The retry tops up the witnesses kept
+    ## there, 3dgen_tests.py only ever moves complete witnesses into it.
+    if job["output"] is not None and os.path.exists(job["output"]):
+        print(f"Topping up the output of interrupted job {job['id']} in {job['output']}")
+
+    log_file = os.path.join(log_dir, job["id"].replace("/", "_").replace(":", "_") + ".log")
+    with open(log_file, "a") as log:
+        sp = subprocess.Popen(json.loads(job["argv"]), stdout=log, stderr=subprocess.STDOUT, cwd=src_dir)
+        return sp.wait()
+
+
+def worker(db, log_dir, lease = 600, max_tries = 3, poll = 10):
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    os.makedirs(log_dir, exist_ok=True)
+    conn = connect(db)
+    while True:
+        job = claim(conn, name, lease, max_tries)
+        if job is None:
+            open_jobs = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'running' OR (state = 'pending' AND tries < ?)", (max_tries,)).fetchone()[0]
+            if open_jobs == 0:
+                break
+            ## Wait for running jobs to unblock their dependents, or to be reclaimed.
+            time.sleep(poll)
+            continue
+
+        print(f"[{name}] Running {job['id']}")
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat, args=(db, job["id"], name, stop, lease / 4), daemon=True)
+        beat.start()
+        returncode = run_job(job, log_dir)
+        stop.set()
+        beat.join()
+
+        state = "done" if returncode == 0 else "pending"
+        conn.execute("UPDATE jobs SET state = ?, finished = ?, returncode = ?, worker = NULL WHERE id = ? AND worker = ?", (state, time.time(), returncode, job["id"], name))
+        print(f"[{name}] Finished {job['id']} with return code {returncode}")
+    conn.close()
+
+
+def run(db, log_dir, workers, lease = 600, max_tries = 3):
+    pool = [Process(target=worker, args=(db, log_dir, lease, max_tries)) for _ in range(workers)]
+    for p in pool:
+        p.start()
+    for p in pool:
+        p.join()
+    status(db, max_tries)
+
+
+def status(db, max_tries = 3):
+    conn = connect(db)
+    print(f"{'state':<10}{'kind':<10}{'jobs':>6}")
+    for row in conn.execute("SELECT state, kind, COUNT(*) AS n FROM jobs GROUP BY state, kind ORDER BY state, kind"):
+        print(f"{row['state']:<10}{row['kind']:<10}{row['n']:>6}")
+    failed = conn.execute("SELECT id, returncode FROM jobs WHERE state = 'pending' AND tries >= ?", (max_tries,)).fetchall()
+    for row in failed:
+        print(f"Gave up on {row['id']} (return code {row['returncode']})")
+    span = conn.execute("SELECT MIN(started) AS first, MAX(finished) AS last FROM jobs WHERE state = 'done'").fetchone()
+    if span["first"] is not None:
+        print(f"Makespan so far: {span['last'] - span['first']:.0f}s")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['init', 'run', 'worker', 'status'], help='init: add the jobs of a campaign to the queue, run: run the queue with local workers, worker: run a single worker, status: print the queue')
+    parser.add_argument('--campaign', type=str, help='/path/to/campaign.json (init)', required=False)
+    parser.add_argument('--db', type=str, help='/path/to/job queue database', default='campaign.db')
+    parser.add_argument('--workers', type=int, help='Number of local worker processes (run)', default=os.cpu_count())
+    parser.add_argument('--logs', type=str, help='Directory for job logs', default='campaign_logs')
+    parser.add_argument('--lease', type=int, help='Seconds without heartbeat after which a running job is handed out again', default=600)
+    parser.add_argument('--max_tries', type=int, help='Number of times a failing job is retried', default=3)
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        if args.campaign is None:
+            parser.error("init requires --campaign")
+        init(args.db, args.campaign)
+    elif args.command == 'run':
+        run(args.db, args.logs, args.workers, args.lease, args.max_tries)
+    elif args.command == 'worker':
+        worker(args.db, args.logs, args.lease, args.max_tries)
+    else:
+        status(args.db, args.max_tries)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import ast
+import json
+import tempfile
+from manual_index import count_tokens
+
+"""
+Bounded conversation history for the Developer agent.
+
+Every evaluate_code result goes back into the chat whole: EverParse's stdout and stderr, or the
+packet feedback of check_packets with the raw packet bytes and label hints. Over n refinement loops
+the Developer's history grows with every turn. HistoryManager.compact builds the messages sent to
+the LLM from the full history, within a token budget:
+    - the task prompt (the RFC) is kept as is,
+    - only the latest spec is kept, earlier ones are replaced by a placeholder,
+    - packet dumps are shown as hex and truncated, long tool output is cut in the middle,
+    - a result repeating a later one is replaced by a reference to it,
+    - the latest turns are kept, older turns are summarized in one message (their first error line each).
+The history autogen keeps and logs is not changed, only what is sent to the LLM.
+
+    python chat_history.py    -- checks the packet dumps of a real check_packets result, as autogen sends it
+"""
+
+## repr() of the packet bytes in check_packets' feedback, see test_utils.packet_feedback.
+packet_dump = re.compile(r"""b'(?:[^'\\]|\\.)*'|b"(?:[^"\\]|\\.)*\"""")
+code_block = re.compile(r"```.*?```", re.DOTALL)
+error_line = re.compile(r"error|incorrect|failed|fails|passes|not accepted", re.IGNORECASE)
+superseded = "(earlier version of the spec, superseded by a later one)"
+
+
+def hex_dump(match, max_bytes):
+    try:
+        data = ast.literal_eval(match.group(0))
+    except (ValueError, SyntaxError):
+        return match.group(0)
+    dump = data[:max_bytes].hex(" ")
+    if len(data) > max_bytes:
+        dump += f" ... ({len(data)} bytes)"
+    return f"[hex] {dump}"
+
+
+def tuple_parts(text):
+    ## evaluate_code's (stderr, stdout) result arrives as str() of the tuple, which escapes the packet literals in it once more.
+    if not text.startswith("("):
+        return None
+    try:
+        parts = ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    if isinstance(parts, tuple) and all(isinstance(part, str) for part in parts):
+        return parts
+    return None
+
+
+def cut(text, max_tokens):
+    ## Keep the head and the tail, EverParse reports the file it processes first and the errors last.
+    if count_tokens(text) <= max_tokens:
+        return text
+    chars = max_tokens * 2
+    return f"{text[:chars]}\n... ({len(text) - 2 * chars} characters omitted) ...\n{text[-chars:]}"
+
+
+def first_error(text):
+    ## evaluate_code's (stderr, stdout) result arrives as the repr of the tuple, with escaped newlines.
+    lines = [line.strip() for line in str(text).replace("\\n", "\n").splitlines() if line.strip()]
+    line = next((line for line in lines if error_line.search(line)), lines[0] if lines else "")
+    return line[:200]
+
+
+class HistoryManager:
+    """
+    Compacts the Developer's history to budget tokens, not counting the task prompt
+    """
+    def __init__(self, budget, keep_turns = 3, feedback_tokens = 1000, packet_bytes = 64, summary_turns = 10):
+        self.budget = budget
+        self.keep_turns = keep_turns
+        self.feedback_tokens = feedback_tokens
+        self.packet_bytes = packet_bytes
+        self.summary_turns = summary_turns
+        self.calls = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.max_tokens = 0
+
+    def compact_feedback(self, text):
+        parts = tuple_parts(text)
+        if parts is not None:
+            ## The packet literals are rewritten in the unescaped parts, the result keeps the shape of the tuple.
+            text = str(tuple(packet_dump.sub(lambda m: hex_dump(m, self.packet_bytes), part) for part in parts))
+        else:
+            text = packet_dump.sub(lambda m: hex_dump(m, self.packet_bytes), text)
+        return cut(text, self.feedback_tokens)
+
+    def drop_spec(self, message):
+        ## Function call arguments carry the code, plain replies may quote it in code blocks.
+        message = dict(message)
+        if message.get("function_call"):
+            call = dict(message["function_call"])
+            try:
+                arguments = json.loads(call.get("arguments") or "{}")
+                if "code" in arguments:
+                    arguments["code"] = superseded
+                    call["arguments"] = json.dumps(arguments)
+            except ValueError:
+                call["arguments"] = json.dumps({"code": superseded})
+            message["function_call"] = call
+        if message.get("content"):
+            message["content"] = code_block.sub(superseded, message["content"])
+        return message
+
+    def turns(self, messages):
+        ## A turn is a Developer (assistant) message and the Executor's answers to it.
+        turns = []
+        for message in messages:
+            if message.get("role") == "assistant" or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        return turns
+
+    def compact(self, messages):
+        """
+        The messages to send to the LLM in place of messages
+        """
+        if not messages:
+            return messages
+        task, turns = messages[0], self.turns(messages[1:])
+
+        ## Only the latest spec, the Developer refines it as a whole.
+        latest = max((i for i, turn in enumerate(turns) if turn[0].get("role") == "assistant" and (turn[0].get("function_call") or code_block.search(turn[0].get("content") or ""))), default=None)
+        compacted, seen = [], {}
+        for i, turn in enumerate(turns):
+            turn = [self.drop_spec(m) if m.get("role") == "assistant" and i != latest else dict(m) for m in turn]
+            for message in turn:
+                if message.get("role") != "assistant" and isinstance(message.get("content"), str):
+                    message["content"] = self.compact_feedback(message["content"])
+            compacted.append(turn)
+        summaries = [[f"Turn {i + 1}: {first_error(m['content'])}" for m in turn[1:] if isinstance(m.get("content"), str)] for i, turn in enumerate(compacted)]
+        ## A result repeated later is only kept in its latest turn.
+        for i in reversed(range(len(compacted))):
+            for message in compacted[i]:
+                content = message.get("content")
+                if message.get("role") == "assistant" or not isinstance(content, str):
+                    continue
+                if content in seen:
+                    message["content"] = f"(same result as in turn {seen[content] + 1})"
+                else:
+                    seen[content] = i
+
+        keep = min(self.keep_turns, len(compacted))
+        while True:
+            result = [task]
+            older = summaries[:len(compacted) - keep]
+            if older:
+                lines = [line for turn in older for line in turn]
+                omitted = len(lines) - self.summary_turns
+                lines = ([f"({omitted} earlier results omitted)"] if omitted > 0 else []) + lines[-self.summary_turns:]
+                result.append({"role": "user", "content": "Summary of the earlier refinements, their specs were superseded:\n" + "\n".join(lines)})
+            for turn in compacted[len(compacted) - keep:]:
+                result += turn
+            if keep <= 1 or self.tokens(result[1:]) <= self.budget:
+                break
+            keep -= 1
+
+        before, after = self.tokens(messages), self.tokens(result)
+        self.calls += 1
+        self.tokens_before += before
+        self.tokens_after += after
+        self.max_tokens = max(self.max_tokens, after)
+        return result
+
+    def tokens(self, messages):
+        return sum(count_tokens(str(m.get("content") or "")) + count_tokens(json.dumps(m.get("function_call") or "")) for m in messages)
+
+    def report(self):
+        return {
+            "history_budget": self.budget,
+            "history_calls": self.calls,
+            "history_tokens_before": self.tokens_before,
+            "history_tokens_sent": self.tokens_after,
+            "history_max_tokens": self.max_tokens,
+        }
+
+
+def check():
+    """
+    Compact check_packets' feedback on a packet, as is and as str() of evaluate_code's tuple, and check the bytes shown
+    """
+    from test_utils import packet_feedback
+    from packed_corpus import DirCorpus
+    name = "witness.0.NEG.TCP.dat"
+    packet = bytes.fromhex("4500001c0000") + b"'\"\\"
+    with tempfile.TemporaryDirectory() as dir:
+        with open(os.path.join(dir, name), "wb") as f:
+            f.write(packet)
+        feedback = packet_feedback(DirCorpus(dir), name, "Packet failed", {name: [False, "hint"]})
+    for content in [str(("", feedback)), feedback]:
+        compacted = HistoryManager(6000).compact_feedback(content)
+        assert f"[hex] {packet.hex(' ')}" in compacted, compacted
+    print("Packet dumps compacted correctly")
+
+
+if __name__ == "__main__":
+    check()
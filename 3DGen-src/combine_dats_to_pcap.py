@@ -5,6 +5,9 @@ import tempfile
 import argparse
 import pyshark
 from scapy.all import *
+from pcapng_writer import PcapngWriter, exported_pdu, LINKTYPE_ETHERNET
+from tracing import span
+from packed_corpus import open_corpus
 
 """
 This script combines a set of .dat files into a single tshark (wireshark) pcap file.
@@ -25,7 +28,7 @@ on tshark's export pdu feature, which is a special, generic encapsulation layer
 contains the name of the payload layer. Unfortunately, in some cases, we still have to 
 add encapsulation and leaf layers when we assemble the packet from the .dat files because 
 of inconsistencies with tshark's dissectors. To assemble encapsulation and leaf layers, 
-we use text2pcap features and scapy.
+we use scapy and the encapsulation that text2pcap would add for the arguments in tshark_instructions.
 
 As output, it generates a single .pcap file with N assembled packets where N is the number 
 of .dat files. Each packet has a tshark frame comment that corresponds to the .dat file 
@@ -37,8 +40,11 @@ a) Diagnosing malformed packets with tshark (wireshark) is easier with a single
 b) tshark supports packet flows such as TCP handshakes, retransmissions. However, all the 
    packets of that handshake have to be in one .pcap file.
 
-This script expects text2pcap, editcap, and mergecap, as well as od to be installed on the 
-system. These are part of the wireshark package except for od, which is part of the coreutils 
+By default, the packets are streamed into the .pcap (pcapng) file in a single pass with 
+pcapng_writer.py, which writes the export pdu header and the frame comments itself. 
+The original pipeline is still available with --text2pcap. It spawns od | text2pcap and 
+editcap per .dat file and a final mergecap, and expects text2pcap, editcap, and mergecap, 
+as well as od to be installed on the system. These are part of the wireshark package except for od, which is part of the coreutils 
 package. DO NOT replace od with hexdump, as hexdump has subtle differences in its output that 
 can interfere with text2pcap. Moreover, text2pcap specifically mentions od in its documentation.
 """
@@ -75,11 +81,67 @@ tshark_instructions = {
     "tftp" : ("-u 69,69",                 _),
 }
 
+def encapsulation(arguments):
+    """
+    Translate the text2pcap arguments of tshark_instructions into the pcapng link type and a
+    function that adds the encapsulation text2pcap would add to a packet.
+    """
+    args = arguments.split()
+    linktype = LINKTYPE_ETHERNET
+    encapsulate = _
+    if "-l" in args:
+        linktype = int(args[args.index("-l") + 1])
+    if "-P" in args:
+        dissector = args[args.index("-P") + 1]
+        encapsulate = lambda data : exported_pdu(dissector, data)
+    if "-u" in args:
+        ## Dummy Ethernet/IPv4/UDP headers with text2pcap's default addresses.
+        sport, dport = [int(port) for port in args[args.index("-u") + 1].split(",")]
+        encapsulate = lambda data : bytes(Ether(src="0a:01:01:01:01:01", dst="0a:02:02:02:02:02") / IP(src="1.1.1.1", dst="2.2.2.2") / UDP(sport=sport, dport=dport) / Raw(load=data))
+    return linktype, encapsulate
+
+
 def generate_pcap(dat_folder_path, protocol, pcap_file_path):
     if not os.path.isabs(pcap_file_path):
         print(f"The pcap_file_path has to be absolute: {pcap_file_path}")
         sys.exit(-1)
 
+    ## Ensure that the tshark dissector name is lowercase.
+    protocol = protocol.lower()
+    linktype, encapsulate = encapsulation(tshark_instructions[protocol][0])
+
+    ## Sort input files lexicopgraphically to ensure some order in the .pcap file.
+    ## The test set may be a directory of .dat files or the packed corpus of one, see packed_corpus.py.
+    corpus = open_corpus(dat_folder_path)
+    dat_file_names = corpus.names()
+
+    # 1) Assemble the packets from the .dat files with scapy
+    # 2) Add the encapsulation text2pcap would add and stream the packet, with the .dat file name as frame comment, into the .pcap file
+    with span("generate_pcap", protocol=protocol, packets=len(dat_file_names)), PcapngWriter(pcap_file_path, linktype) as writer, corpus:
+        for dat_file_name in dat_file_names:
+            dat_file_path = os.path.join(dat_folder_path, dat_file_name)
+
+            # 1) Assemble the packets from the .dat files with scapy
+            without_nested_layers = bytes(corpus.read(dat_file_name))
+
+            ### This might fail for negative (NEG) packets, in which case we skip assembling additional layers.
+            try:
+                pkt = tshark_instructions[protocol][1](without_nested_layers)
+                with_nested_layers = bytes(pkt)
+            except Exception as e:
+                print(e)
+                print(f"Skipping the assembly of nested layers due to malformed input {dat_file_path}.")
+                with_nested_layers = without_nested_layers
+
+            # 2) Stream the packet into the .pcap file.
+            writer.write(encapsulate(with_nested_layers), dat_file_name)
+
+
+def generate_pcap_text2pcap(dat_folder_path, protocol, pcap_file_path):
+    if not os.path.isabs(pcap_file_path):
+        print(f"The pcap_file_path has to be absolute: {pcap_file_path}")
+        sys.exit(-1)
+
     # if pcap file does not exist, create it
     if not os.path.exists(pcap_file_path):
         open(pcap_file_path, 'w').close()
@@ -137,16 +199,18 @@ def generate_pcap(dat_folder_path, protocol, pcap_file_path):
             # 2) Generate a .pcap file for each .dat file with text2pcap.
             pcap_temp_path = os.path.join(temp_dir, dat_file_name + ".pcap")
             call = (f"od -Ax -tx1 -v {dat_temp_file} | text2pcap -q {tshark_instructions[protocol][0]} - {pcap_temp_path}")
-            sp = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=temp_dir)
-            _, err = sp.communicate()
+            with span("text2pcap"):
+                sp = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=temp_dir)
+                _, err = sp.communicate()
             if sp.returncode != 0:
                 raise Exception(f'Subprocess {call} failed with error code: {sp.returncode} and error message: {err}') 
 
             ## 3) Set the frame comment of the packet in the .pcap file to the .dat file name with editcap.
             ## editcap is one-based, so the first frame is frame #1.
             call = (f"editcap -a \"1:{dat_file_name}\" {pcap_temp_path} {pcap_temp_path}")
-            sp = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=temp_dir)
-            _, err = sp.communicate()
+            with span("editcap"):
+                sp = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=temp_dir)
+                _, err = sp.communicate()
             if sp.returncode != 0:
                 raise Exception(f'Subprocess {call} failed with error code: {sp.returncode} and error message: {err}')
             
@@ -155,8 +219,9 @@ def generate_pcap(dat_folder_path, protocol, pcap_file_path):
 
         # 4) Merge the .pcap files into a single .pcap file with mergecap.
         call = (f"mergecap -w {pcap_file_path} {temp_dir}/*.pcap")
-        sp = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=temp_dir)
-        _, err = sp.communicate()
+        with span("mergecap", packets=N):
+            sp = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=temp_dir)
+            _, err = sp.communicate()
         if sp.returncode != 0:
             raise Exception(f'Subprocess {call} failed with error code: {sp.returncode} and error message: {err}') 
 
@@ -176,9 +241,13 @@ def main():
     parser.add_argument('--protocol', type=str, help='Protocol to test [ipv4|ipv6|tcp|udp|icmp|vxlan|...]', required=True)
     parser.add_argument('--input', type=str, help='/absolute/or/relative/path/to/folder/with/.dat files', required=True)
     parser.add_argument('--output', type=str, help='/absolute/path/to/generated/.pcap file', required=True)
+    parser.add_argument('--text2pcap', action='store_true', help='Generate the .pcap file with text2pcap, editcap, and mergecap', required=False)
     args = parser.parse_args()
 
-    generate_pcap(args.input, args.protocol, args.output)
+    if args.text2pcap:
+        generate_pcap_text2pcap(args.input, args.protocol, args.output)
+    else:
+        generate_pcap(args.input, args.protocol, args.output)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+"""
+Content-addressed cache for EverParse builds.
+
+The Developer agent frequently resubmits a spec that is identical, or identical up to
+whitespace, to one it already tried. Every entry of the cache is keyed by the hash of the
+normalized 3D source, the entrypoint module name and the EverParse version, and holds the
+files EverParse generated (C sources, headers, test.exe) together with its stdout/stderr.
+
+Layout of the cache directory:
+    <cache_dir>/<key>/meta.json     -- EverParse output and the generated module file name
+    <cache_dir>/<key>/files/...     -- the generated artifacts
+    <cache_dir>/.lock               -- serializes eviction between concurrent runs
+
+Entries are written into a temporary directory and renamed into place, so concurrent runs
+never see a partial entry. Entry mtimes are bumped on every hit and the least recently used
+entries are evicted once the cache grows beyond max_bytes.
+"""
+
+everparse_versions = {}
+
+
+def everparse_version(everparse_path):
+    """
+    Version string of the EverParse installation, computed once per process.
+    """
+    if everparse_path not in everparse_versions:
+        sp = subprocess.Popen(f"bash {everparse_path} --version", shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, _ = sp.communicate()
+        version = out.decode("utf-8").strip()
+        if sp.returncode != 0 or not version:
+            ## Fall back to the identity of the installation.
+            version = f"{os.path.abspath(everparse_path)}:{os.path.getmtime(everparse_path) if os.path.exists(everparse_path) else 0}"
+        everparse_versions[everparse_path] = version
+    return everparse_versions[everparse_path]
+
+
+def normalize_source(code):
+    ## Whitespace is insignificant in 3D except as a separator and for ending // comments, so keep line structure.
+    lines = [" ".join(line.split()) for line in code.splitlines()]
+    return "\n".join(line for line in lines if line)
+
+
+def spec_key(code, module_name, version):
+    """
+    Identity of a spec: its normalized source, entrypoint module and the EverParse version building it
+    """
+    h = hashlib.sha256()
+    for part in [normalize_source(code), module_name, version]:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class CompileCache:
+    """
+    On-disk LRU cache of EverParse builds
+    """
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, code, module_name, version):
+        return spec_key(code, module_name, version)
+
+    def get(self, key, odir):
+        """
+        Restore the artifacts of a cached build into odir.
+        Returns (output_err, output_dump, module_file) or None on a miss.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry, "meta.json"), "r") as f:
+                meta = json.load(f)
+            files = os.path.join(entry, "files")
+            os.makedirs(odir, exist_ok=True)
+            ## Restored files get the current mtime, a restored artifact must not look older than the build it replaces.
+            for name in os.listdir(files):
+                shutil.copy(os.path.join(files, name), os.path.join(odir, name))
+            os.utime(entry)
+        except (OSError, ValueError):
+            ## Missing, or evicted by a concurrent run while we were reading it.
+            return None
+        return meta["output_err"], meta["output_dump"], meta["module_file"]
+
+    def put(self, key, odir, artifacts, output_err, output_dump, module_file):
+        """
+        Store the files in artifacts (names relative to odir) and the EverParse output under key.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry):
+            return
+        tmp = tempfile.mkdtemp(prefix=".tmp_", dir=self.cache_dir)
+        try:
+            os.makedirs(os.path.join(tmp, "files"))
+            for name in artifacts:
+                shutil.copy2(os.path.join(odir, name), os.path.join(tmp, "files", name))
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump({"output_err": output_err, "output_dump": output_dump, "module_file": module_file, "created": time.time()}, f)
+            os.rename(tmp, entry)
+        except OSError:
+            ## Another run stored the same key first.
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if name.startswith(".") or not os.path.isdir(path):
+                    continue
+                size = dir_size(path)
+                total += size
+                entries.append((os.path.getmtime(path), size, path))
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+def snapshot(odir):
+    """
+    {name: (mtime, size)} of the files in odir
+    """
+    if not os.path.exists(odir):
+        return {}
+    files = {}
+    for name in os.listdir(odir):
+        path = os.path.join(odir, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            files[name] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def changed_files(before, after):
+    ## A file rewritten within the mtime granularity is caught by its size.
+    return [name for name, state in after.items() if before.get(name) != state]
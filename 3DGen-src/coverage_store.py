@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Structured, mergeable store of tshark dissector coverage.
+
+validate_with_tshark.validate_and_coverage runs tshark under gcov and parses gcov's JSON report
+of packet-<dissector>.c into a coverage record:
+    {"dissector", "functions": {name: {"start_line", "count", "blocks", "blocks_executed"}},
+     "lines": {line: count}, "branches": {(line, index): count}}
+Records are persisted per run (a pcap validated at some time, optionally as part of a campaign)
+in a SQLite database, so coverage can be compared between runs and merged across pcaps, protocols
+and campaigns without rerunning tshark. Hit counts merge by summing. 'ingest' measures several
+pcaps concurrently, each tshark process with its own GCOV_PREFIX, and stores one run per pcap.
+
+    python coverage_store.py ingest --protocol TCP tests/TCP/z3/*.pcap --workers 8
+    python coverage_store.py summary --protocol TCP
+    python coverage_store.py functions --dissector tcp --uncovered
+    python coverage_store.py diff 3 7
+    python coverage_store.py merge other/coverage.db
+"""
+
+schema = [
+    """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        protocol TEXT NOT NULL,
+        dissector TEXT NOT NULL,
+        pcap TEXT,
+        campaign TEXT,
+        time REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS runs_dissector ON runs (dissector)",
+    "CREATE TABLE IF NOT EXISTS lines (run_id INTEGER NOT NULL REFERENCES runs (id), line INTEGER NOT NULL, count INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS lines_run ON lines (run_id)",
+    "CREATE TABLE IF NOT EXISTS branches (run_id INTEGER NOT NULL REFERENCES runs (id), line INTEGER NOT NULL, branch INTEGER NOT NULL, count INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS branches_run ON branches (run_id)",
+    "CREATE TABLE IF NOT EXISTS functions (run_id INTEGER NOT NULL REFERENCES runs (id), name TEXT NOT NULL, start_line INTEGER, count INTEGER NOT NULL, blocks INTEGER, blocks_executed INTEGER)",
+    "CREATE INDEX IF NOT EXISTS functions_run ON functions (run_id)",
+]
+
+
+def coverage_record(gcov_record, dissector):
+    """
+    Coverage record of gcov's JSON record of a source file, see validate_with_tshark.gcov_json
+    """
+    record = {"dissector": dissector, "functions": {}, "lines": {}, "branches": {}}
+    for function in gcov_record.get("functions", []):
+        record["functions"][function["name"]] = {
+            "start_line": function["start_line"],
+            "count": function["execution_count"],
+            "blocks": function["blocks"],
+            "blocks_executed": function["blocks_executed"],
+        }
+    for line in gcov_record.get("lines", []):
+        ## A line can be listed once per function (e.g. inlined code), its counts add up.
+        number = line["line_number"]
+        record["lines"][number] = record["lines"].get(number, 0) + line["count"]
+        for i, branch in enumerate(line.get("branches", [])):
+            record["branches"][(number, i)] = record["branches"].get((number, i), 0) + branch["count"]
+    return record
+
+
+def merge_records(records):
+    """
+    Sum the hit counts of coverage records of the same dissector, e.g. of several pcaps
+    """
+    merged = {"dissector": records[0]["dissector"] if records else None, "functions": {}, "lines": {}, "branches": {}}
+    for record in records:
+        for name, function in record["functions"].items():
+            if name in merged["functions"]:
+                m = merged["functions"][name]
+                m["count"] += function["count"]
+                ## Executed blocks don't add up, the union is at least the maximum.
+                m["blocks_executed"] = max(m["blocks_executed"], function["blocks_executed"])
+            else:
+                merged["functions"][name] = dict(function)
+        for key in ["lines", "branches"]:
+            for k, count in record[key].items():
+                merged[key][k] = merged[key].get(k, 0) + count
+    return merged
+
+
+def summarize(record):
+    lines = record["lines"].values()
+    branches = record["branches"].values()
+    functions = [f["count"] for f in record["functions"].values()]
+    return {
+        "dissector": record["dissector"],
+        "lines": len(lines),
+        "lines_covered": sum(1 for c in lines if c > 0),
+        "branches": len(branches),
+        "branches_covered": sum(1 for c in branches if c > 0),
+        "functions": len(functions),
+        "functions_covered": sum(1 for c in functions if c > 0),
+    }
+
+
+def connect(db):
+    if os.path.dirname(db):
+        os.makedirs(os.path.dirname(db), exist_ok=True)
+    conn = sqlite3.connect(db, timeout=60)
+    conn.row_factory = sqlite3.Row
+    for statement in schema:
+        conn.execute(statement)
+    return conn
+
+
+def store(db, record, protocol, pcap = None, campaign = None):
+    """
+    Persist the coverage record of a run, returns its run id
+    """
+    conn = connect(db)
+    with conn:
+        run_id = conn.execute("INSERT INTO runs (protocol, dissector, pcap, campaign, time) VALUES (?, ?, ?, ?, ?)",
+                              (protocol, record["dissector"], pcap, campaign, time.time())).lastrowid
+        conn.executemany("INSERT INTO lines (run_id, line, count) VALUES (?, ?, ?)", [(run_id, line, count) for line, count in record["lines"].items()])
+        conn.executemany("INSERT INTO branches (run_id, line, branch, count) VALUES (?, ?, ?, ?)",
+                         [(run_id, line, branch, count) for (line, branch), count in record["branches"].items()])
+        conn.executemany("INSERT INTO functions (run_id, name, start_line, count, blocks, blocks_executed) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(run_id, name, f["start_line"], f["count"], f["blocks"], f["blocks_executed"]) for name, f in record["functions"].items()])
+    conn.close()
+    return run_id
+
+
+def run_filter(protocol = None, dissector = None, campaign = None, runs = None):
+    conditions, params = [], []
+    for column, value in [("protocol", protocol), ("dissector", dissector), ("campaign", campaign)]:
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    if runs:
+        conditions.append(f"id IN ({', '.join('?' * len(runs))})")
+        params += list(runs)
+    return ("WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+
+def load(db, protocol = None, dissector = None, campaign = None, runs = None):
+    """
+    Merged coverage records of the selected runs, one per dissector. Counts are summed in SQL.
+    """
+    where, params = run_filter(protocol, dissector, campaign, runs)
+    conn = connect(db)
+    records = {}
+    for row in conn.execute(f"SELECT DISTINCT dissector FROM runs {where}", params):
+        records[row["dissector"]] = {"dissector": row["dissector"], "functions": {}, "lines": {}, "branches": {}}
+    selected = f"SELECT id FROM runs {where}"
+    for row in conn.execute(f"SELECT r.dissector, l.line, SUM(l.count) AS count FROM lines l JOIN runs r ON r.id = l.run_id WHERE r.id IN ({selected}) GROUP BY r.dissector, l.line", params):
+        records[row["dissector"]]["lines"][row["line"]] = row["count"]
+    for row in conn.execute(f"SELECT r.dissector, b.line, b.branch, SUM(b.count) AS count FROM branches b JOIN runs r ON r.id = b.run_id WHERE r.id IN ({selected}) GROUP BY r.dissector, b.line, b.branch", params):
+        records[row["dissector"]]["branches"][(row["line"], row["branch"])] = row["count"]
+    for row in conn.execute(f"""SELECT r.dissector, f.name, MIN(f.start_line) AS start_line, SUM(f.count) AS count, MAX(f.blocks) AS blocks, MAX(f.blocks_executed) AS blocks_executed
+                                FROM functions f JOIN runs r ON r.id = f.run_id WHERE r.id IN ({selected}) GROUP BY r.dissector, f.name""", params):
+        records[row["dissector"]]["functions"][row["name"]] = {k: row[k] for k in ["start_line", "count", "blocks", "blocks_executed"]}
+    conn.close()
+    return records
+
+
+def list_runs(db, protocol = None, dissector = None, campaign = None):
+    where, params = run_filter(protocol, dissector, campaign)
+    conn = connect(db)
+    rows = [dict(row) for row in conn.execute(f"""SELECT r.*, (SELECT COUNT(*) FROM lines l WHERE l.run_id = r.id) AS lines,
+                                                  (SELECT COUNT(*) FROM lines l WHERE l.run_id = r.id AND l.count > 0) AS lines_covered
+                                                  FROM runs r {where} ORDER BY r.id""", params)]
+    conn.close()
+    return rows
+
+
+def diff(db, run_a, run_b):
+    """
+    Lines and branches covered by one run but not the other
+    """
+    a = next(iter(load(db, runs=[run_a]).values()))
+    b = next(iter(load(db, runs=[run_b]).values()))
+    covered = lambda record, key: {k for k, count in record[key].items() if count > 0}
+    return {
+        "lines_only_a": sorted(covered(a, "lines") - covered(b, "lines")),
+        "lines_only_b": sorted(covered(b, "lines") - covered(a, "lines")),
+        "branches_only_a": sorted(covered(a, "branches") - covered(b, "branches")),
+        "branches_only_b": sorted(covered(b, "branches") - covered(a, "branches")),
+    }
+
+
+def merge_db(db, other):
+    """
+    Copy all runs of another store (e.g. of another machine or campaign) into db. Returns the number of runs copied.
+    """
+    conn = connect(db)
+    connect(other).close()
+    conn.execute("ATTACH DATABASE ? AS other", (other,))
+    runs = conn.execute("SELECT * FROM other.runs ORDER BY id").fetchall()
+    with conn:
+        for run in runs:
+            run_id = conn.execute("INSERT INTO runs (protocol, dissector, pcap, campaign, time) VALUES (?, ?, ?, ?, ?)",
+                                  (run["protocol"], run["dissector"], run["pcap"], run["campaign"], run["time"])).lastrowid
+            conn.execute("INSERT INTO lines SELECT ?, line, count FROM other.lines WHERE run_id = ?", (run_id, run["id"]))
+            conn.execute("INSERT INTO branches SELECT ?, line, branch, count FROM other.branches WHERE run_id = ?", (run_id, run["id"]))
+            conn.execute("INSERT INTO functions SELECT ?, name, start_line, count, blocks, blocks_executed FROM other.functions WHERE run_id = ?", (run_id, run["id"]))
+    conn.execute("DETACH DATABASE other")
+    conn.close()
+    return len(runs)
+
+
+def ingest(db, pcaps, protocol, campaign = None, workers = 1):
+    """
+    Measure the coverage of pcaps in concurrent tshark shards and store one run per pcap
+    """
+    from validate_with_tshark import dissector_coverage
+
+    with ThreadPoolExecutor(workers) as pool:
+        records = list(pool.map(lambda pcap: dissector_coverage(pcap, protocol), pcaps))
+    return [store(db, record, protocol, os.path.abspath(pcap), campaign) for pcap, record in zip(pcaps, records)]
+
+
+def print_summary(record):
+    s = summarize(record)
+    percent = lambda covered, total: 100.0 * covered / total if total else 0.0
+    print(f"{s['dissector']:<12}lines {s['lines_covered']}/{s['lines']} ({percent(s['lines_covered'], s['lines']):.2f}%), "
+          f"branches {s['branches_covered']}/{s['branches']} ({percent(s['branches_covered'], s['branches']):.2f}%), "
+          f"functions {s['functions_covered']}/{s['functions']}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['ingest', 'summary', 'runs', 'functions', 'diff', 'merge'],
+                        help='ingest: measure pcaps, summary: merged coverage, runs: list runs, functions: per function coverage, diff: compare two runs, merge: import other stores')
+    parser.add_argument('inputs', nargs='*', help='pcaps (ingest), two run ids (diff) or coverage databases (merge)')
+    parser.add_argument('--db', type=str, help='/path/to/coverage database', default='experiments/coverage.db')
+    parser.add_argument('--protocol', type=str, help='Only this protocol', required=False)
+    parser.add_argument('--dissector', type=str, help='Only this dissector', required=False)
+    parser.add_argument('--campaign', type=str, help='Only this campaign (ingest: record the runs as part of it)', required=False)
+    parser.add_argument('--runs', type=int, nargs='*', help='Only these runs', required=False)
+    parser.add_argument('--uncovered', action='store_true', help='Only list functions that were never executed', required=False)
+    parser.add_argument('--workers', type=int, help='Number of concurrent tshark shards (ingest)', default=1)
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        run_ids = ingest(args.db, args.inputs, args.protocol, args.campaign, args.workers)
+        print(f"Stored runs {run_ids}")
+    elif args.command == 'summary':
+        for record in load(args.db, args.protocol, args.dissector, args.campaign, args.runs).values():
+            print_summary(record)
+    elif args.command == 'runs':
+        for run in list_runs(args.db, args.protocol, args.dissector, args.campaign):
+            print(f"{run['id']:>6} {run['protocol']:<8}{run['dissector']:<10}{run['campaign'] or '':<16}{run['lines_covered']:>6}/{run['lines']:<6} {run['pcap']}")
+    elif args.command == 'functions':
+        for record in load(args.db, args.protocol, args.dissector, args.campaign, args.runs).values():
+            for name, f in sorted(record["functions"].items(), key=lambda item: item[1]["start_line"]):
+                if args.uncovered and f["count"] > 0:
+                    continue
+                print(f"{record['dissector']:<10}{name:<48}line {f['start_line']:<7}calls {f['count']:<10}blocks {f['blocks_executed']}/{f['blocks']}")
+    elif args.command == 'diff':
+        result = diff(args.db, int(args.inputs[0]), int(args.inputs[1]))
+        for key, values in result.items():
+            print(f"{key}: {values}")
+    else:
+        for other in args.inputs:
+            print(f"{other}: {merge_db(args.db, other)} runs merged")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import time
+import zipfile
+import argparse
+import subprocess
+
+"""
+Fast local pre-checker for 3D specifications.
+
+Most early refinement rounds fail on rules get_developer_prompt already lists (UINT24/UINT4 base types,
+'.' field access, 'type' as an identifier, unnamed structs, misplaced consume-all, ...), and each of them
+still pays for a full everparse.sh run. lint() parses the spec with a small recursive descent parser for
+the declarations 3D specs are made of (typedef struct, casetype, enum, typedef, #define) and returns
+diagnostics in EverParse's style
+
+    everparse_files/TCP/Tmp_20240318220419.3d:(4,9): (Error) Unknown base type UINT24, use UINT8, UINT16BE, UINT32BE or UINT64BE (with bitfields for other widths)
+
+in milliseconds. evaluate_code only runs EverParse on specs without errors, and errors are only reported
+for the rules of the Developer prompt's checklist. Everything else the parser finds (syntax errors, unknown
+types and unbound names) is a warning, as are hints like little endian multi-byte types (valid 3D but rarely
+right for network protocols): the parser doesn't know all of 3D, and a false error must never keep a valid
+spec from EverParse. Constructs the parser doesn't know are skipped rather than reported.
+
+    python lint_3d.py spec.3d --module _TCP_HEADER
+    python lint_3d.py experiments.zip everparse_files/ --benchmark [--everparse everparse/everparse.sh]
+    python lint_3d.py --check
+"""
+
+base_types = {"UINT8", "UINT16", "UINT32", "UINT64", "UINT8BE", "UINT16BE", "UINT32BE", "UINT64BE"}
+type_bits = {t: int(re.sub(r"\D", "", t)) for t in base_types}
+builtin_types = base_types | {"unit", "all_bytes", "all_zeros", "Bool", "BOOLEAN", "PUINT8", "PUINT16", "PUINT32", "PUINT64", "PUINT8BE", "PUINT16BE", "PUINT32BE", "PUINT64BE", "void"}
+builtin_names = {"true", "false", "this", "sizeof", "field_pos", "field_pos_32", "field_pos_64", "field_ptr", "field_ptr_after", "is_range_okay", "return", "abort",
+                 "MAX_UINT8", "MAX_UINT16", "MAX_UINT32", "MAX_UINT64"}
+## F* keywords EverParse can't use as names, 'type' is the one models keep trying.
+reserved = {"type", "val", "let", "match", "module", "open", "fun", "function", "rec"}
+array_kinds = {":byte-size", ":byte-size-single-element-array", ":byte-size-single-element-array-at-most", ":zeroterm", ":zeroterm-byte-size-at-most", ":consume-all"}
+
+token_re = re.compile(r"""
+    (?P<space>[ \t\r\f\v]+|\n)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<directive>\#[^\n]*)
+  | (?P<arraykind>\[:[a-z][a-z-]*)
+  | (?P<action>\{:[a-z][a-z-]*)
+  | (?P<number>0[xX][0-9a-fA-F]+[a-zA-Z]*|\d+[a-zA-Z]*)
+  | (?P<ident>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>==|!=|<=|>=|&&|\|\||<<|>>|->|[-+*/%<>!=~&|^?{}()\[\];,:.])
+""", re.VERBOSE | re.DOTALL)
+
+
+class Token:
+    def __init__(self, kind, text, line, col):
+        self.kind = kind
+        self.text = text
+        self.line = line
+        self.col = col
+
+
+def tokenize(spec):
+    tokens, problems = [], []
+    line, start, pos = 1, 0, 0
+    while pos < len(spec):
+        m = token_re.match(spec, pos)
+        if m is None:
+            problems.append((line, pos - start + 1, f"Syntax error: unexpected character {spec[pos]!r}"))
+            pos += 1
+            continue
+        kind, text = m.lastgroup, m.group()
+        if kind not in ["space", "comment"]:
+            tokens.append(Token(kind, text, line, pos - start + 1))
+        newlines = text.count("\n")
+        if newlines:
+            line += newlines
+            start = pos + text.rindex("\n") + 1
+        pos = m.end()
+    tokens.append(Token("eof", "end of file", line, pos - start + 1))
+    return tokens, problems
+
+
+class SyntaxError3D(Exception):
+    pass
+
+
+class Linter:
+    def __init__(self, spec):
+        self.tokens, self.warnings = tokenize(spec)
+        self.errors = []
+        self.pos = 0
+        self.start = 0
+        self.types = set(builtin_types)
+        self.constants = set(builtin_names)
+
+    ## Tokens
+
+    def peek(self, offset = 0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.peek()
+        self.pos = min(self.pos + 1, len(self.tokens) - 1)
+        return token
+
+    def accept(self, text):
+        if self.peek().text == text:
+            return self.next()
+        return None
+
+    def expect(self, text, what = None):
+        token = self.peek()
+        if token.text != text:
+            self.fail(token, f"Syntax error: expected '{text}'{' ' + what if what else ''}, found '{token.text}'")
+        return self.next()
+
+    def ident(self, what):
+        token = self.peek()
+        if token.kind != "ident":
+            self.fail(token, f"Syntax error: expected {what}, found '{token.text}'")
+        return self.next()
+
+    def error(self, token, message):
+        ## Only for the rules of the Developer prompt's checklist, errors keep the spec from EverParse.
+        self.errors.append((token.line, token.col, message))
+
+    def warning(self, token, message):
+        self.warnings.append((token.line, token.col, message))
+
+    def fail(self, token, message, rule = False):
+        ## Syntax errors may be the parser's, they are warnings unless a rule is broken.
+        if rule:
+            self.error(token, message)
+        else:
+            self.warning(token, message)
+        raise SyntaxError3D()
+
+    def skip_balanced(self, close):
+        ## Skip to the token closing the one just consumed.
+        pairs = {"{": "}", "(": ")", "[": "]"}
+        depth = 1
+        while depth > 0:
+            token = self.next()
+            if token.kind == "eof":
+                self.fail(token, f"Syntax error: missing '{close}'")
+            if token.text in pairs or token.kind in ["arraykind", "action"]:
+                depth += 1
+            elif token.text in pairs.values():
+                depth -= 1
+
+    def recover(self):
+        ## Skip the rest of a broken declaration, up to the ';' after its outermost braces.
+        depth = 0
+        for token in self.tokens[self.start:self.pos]:
+            if token.text in ["{", "("] or token.kind in ["arraykind", "action"]:
+                depth += 1
+            elif token.text in ["}", ")", "]"]:
+                depth = max(depth - 1, 0)
+        while self.peek().kind != "eof":
+            token = self.next()
+            if token.text in ["{", "("] or token.kind in ["arraykind", "action"]:
+                depth += 1
+            elif token.text in ["}", ")", "]"]:
+                depth = max(depth - 1, 0)
+            elif token.text == ";" and depth == 0:
+                return
+
+    ## Names and types
+
+    def name(self, token, what):
+        if token.text in reserved:
+            self.error(token, f"'{token.text}' is a reserved keyword and cannot be used as {what} name")
+        return token.text
+
+    def base_type(self, token, warn = True):
+        ## Unknown base types (UINT24, UINT4, UINT1, INT8, UINT16LE, ...) are the most frequent mistake.
+        if token.text in self.types:
+            if warn and token.text in ["UINT16", "UINT32", "UINT64"]:
+                self.warning(token, f"{token.text} is little endian, network protocols use {token.text}BE")
+            return True
+        if re.fullmatch(r"U?INT\d+(BE|LE)?", token.text):
+            self.error(token, f"Unknown base type {token.text}, use UINT8, UINT16BE, UINT32BE or UINT64BE (with bitfields for other widths)")
+        else:
+            self.warning(token, f"Type {token.text} not found, types must be defined before they are used")
+        return False
+
+    ## Expressions
+
+    def expression(self, scope, close):
+        """
+        Check the expression up to the closing token (consumed), which may refer to names in scope
+        """
+        depth = 0
+        previous = None
+        while True:
+            token = self.next()
+            if token.kind == "eof":
+                self.fail(token, f"Syntax error: missing '{close}'")
+            if token.text in ["(", "["]:
+                depth += 1
+            elif token.text in [")", "]"] and depth > 0:
+                depth -= 1
+            elif token.text == close and depth == 0:
+                return
+            elif token.text in ["{", "}", ";"]:
+                self.fail(token, f"Syntax error: unexpected '{token.text}' in expression, missing '{close}'")
+            elif token.text == "." and previous is not None and previous.kind == "ident":
+                self.error(token, f"Field access {previous.text}.{self.peek().text} is not supported in 3D, refer to fields by their name")
+            elif token.kind == "ident" and (previous is None or previous.text != "."):
+                if token.text not in scope and token.text not in self.constants and token.text not in self.types and self.peek().text != "(":
+                    self.warning(token, f"Unbound variable {token.text}, constraints may only refer to preceding fields and parameters")
+            previous = token
+
+    ## Declarations
+
+    def params(self):
+        ## (TYPE name, mutable TYPE *name, ...)
+        names = set()
+        if not self.accept("("):
+            return names
+        while not self.accept(")"):
+            self.accept("mutable")
+            type_token = self.ident("a parameter type")
+            self.base_type(type_token, False)
+            while self.accept("*"):
+                pass
+            names.add(self.name(self.ident("a parameter name"), "a parameter"))
+            if not self.accept(","):
+                self.expect(")", "after the parameters")
+                break
+        return names
+
+    def field(self, scope, fields):
+        """
+        One field of a struct or case, returns whether it is a [:consume-all] array
+        """
+        start = self.peek()
+        if self.accept("struct") or self.accept("casetype"):
+            self.expect("{")
+            self.fields(set(scope))
+            self.expect("}")
+            if self.peek().kind != "ident":
+                self.fail(self.peek(), "Unnamed struct: all structs must have names, e.g. struct { ... } name;", True)
+            name_token = self.next()
+            self.field_name(name_token, scope, fields)
+            self.expect(";", "after the field")
+            return False
+
+        if start.text == "switch":
+            self.fail(start, "switch is only allowed in a casetype, define one and use it as the type of a field", True)
+        type_token = self.ident("a field type")
+        known = self.base_type(type_token)
+        if self.accept("("):
+            self.expression(scope, ")")
+        while self.accept("*"):
+            pass
+        name_token = self.ident("a field name")
+        self.field_name(name_token, scope, fields)
+
+        consume_all = False
+        array = False
+        if self.accept(":"):
+            width_token = self.next()
+            if width_token.kind != "number":
+                self.fail(width_token, "Syntax error: expected the width of the bitfield")
+            width = int(re.match(r"0[xX][0-9a-fA-F]+|\d+", width_token.text).group(), 0)
+            if known and type_token.text in type_bits and width > type_bits[type_token.text]:
+                self.error(width_token, f"Bitfield {name_token.text} of {width} bits does not fit in {type_token.text}")
+        if self.peek().kind == "arraykind":
+            kind = self.next()
+            array = True
+            if kind.text[1:] not in array_kinds:
+                self.warning(kind, f"Unknown array kind [{kind.text[1:]}, use [:byte-size n], [:consume-all], [:zeroterm] or [:byte-size-single-element-array n]")
+            consume_all = kind.text == "[:consume-all"
+            if consume_all:
+                self.expect("]")
+            else:
+                self.expression(scope, "]")
+        elif self.accept("["):
+            array = True
+            self.expression(scope, "]")
+        if self.peek().text == "{":
+            brace = self.next()
+            if array:
+                self.error(brace, f"Constraints can only be specified on scalar fields, not on the array {name_token.text}. Constrain the scalar fields it depends on instead")
+            self.expression(scope, "}")
+        while self.peek().kind == "action":
+            self.next()
+            self.skip_balanced("}")
+        self.expect(";", f"after the field {name_token.text}")
+        return consume_all
+
+    def field_name(self, token, scope, fields):
+        name = self.name(token, "a field")
+        if name in fields:
+            self.warning(token, f"Duplicate field {name}")
+        fields.add(name)
+        scope.add(name)
+
+    def fields(self, scope):
+        fields = set()
+        consume_all = None
+        while self.peek().text not in ["}", "eof"] and self.peek().kind != "eof":
+            token = self.peek()
+            if consume_all is not None:
+                self.error(consume_all, "A [:consume-all] field must be the last field of its struct")
+                consume_all = None
+            if self.field(scope, fields):
+                consume_all = token
+
+    def struct(self):
+        tag = self.ident("a struct name") if self.peek().kind == "ident" else None
+        scope = self.params()
+        ## where <expression> { ... }, the expression needs no parentheses.
+        if self.accept("where"):
+            self.expression(scope, "{")
+        else:
+            self.expect("{", "to open the struct")
+        self.fields(set(scope))
+        self.expect("}", "to close the struct")
+        self.typedef_names(tag)
+
+    def casetype(self):
+        tag = self.ident("a casetype name")
+        scope = self.params()
+        self.expect("{", "to open the casetype")
+        self.expect("switch", "in the casetype")
+        self.expect("(")
+        self.expression(scope, ")")
+        self.expect("{", "to open the switch")
+        while not self.accept("}"):
+            if self.accept("default"):
+                self.expect(":", "after default")
+            else:
+                self.expect("case", "or default in the switch")
+                self.expression(scope, ":")
+            ## Every case has its own field, they may share its name.
+            self.field(set(scope), set())
+        self.expect("}", "to close the casetype")
+        self.typedef_names(tag)
+
+    def typedef_names(self, tag):
+        ## } NAME, *PNAME;
+        if tag is not None:
+            self.types.add(tag.text)
+        if self.peek().kind != "ident":
+            example = tag.text if tag is not None else "_name"
+            self.fail(self.peek(), f"Unnamed struct: all structs must have names, e.g. typedef struct {example} {{ ... }} {example.lstrip('_')};", True)
+        while True:
+            self.accept("*")
+            name = self.ident("a type name")
+            self.name(name, "a type")
+            self.types.add(name.text)
+            if not self.accept(","):
+                break
+        self.expect(";", "after the type name")
+
+    def enum(self, entrypoint, support):
+        if entrypoint:
+            self.warning(support, "Enum types cannot be marked entrypoint")
+        self.base_type(support, False)
+        self.expect("enum")
+        name = self.ident("an enum name")
+        self.name(name, "an enum")
+        self.expect("{", "to open the enum")
+        while not self.accept("}"):
+            label = self.ident("an enum label")
+            self.name(label, "an enum label")
+            self.constants.add(label.text)
+            if self.accept("="):
+                self.next()
+            if not self.accept(","):
+                self.expect("}", "to close the enum")
+                break
+        self.expect(";", "after the enum")
+        self.types.add(name.text)
+
+    def declaration(self):
+        self.start = self.pos
+        token = self.peek()
+        if token.kind == "directive":
+            self.next()
+            m = re.match(r"#define\s+(\w+)", token.text)
+            if m:
+                self.constants.add(m.group(1))
+            return
+        entrypoint = False
+        while self.peek().text in ["entrypoint", "export", "aligned"]:
+            entrypoint |= self.next().text == "entrypoint"
+        token = self.peek()
+        if token.text == "typedef":
+            self.next()
+            if self.accept("struct"):
+                self.struct()
+            elif self.peek().text == "union":
+                self.fail(self.peek(), "3D has no unions, use a casetype for values whose type depends on a tag", True)
+            else:
+                self.base_type(self.ident("a type"))
+                while self.accept("*"):
+                    pass
+                name = self.ident("a type name")
+                self.name(name, "a type")
+                self.types.add(name.text)
+                self.expect(";", "after the typedef")
+        elif token.text == "casetype":
+            self.next()
+            self.casetype()
+        elif token.kind == "ident" and self.peek(1).text == "enum":
+            self.enum(entrypoint, self.next())
+        elif token.text == "struct":
+            self.fail(token, "Structs must be declared with typedef, e.g. typedef struct _name { ... } name;", True)
+        elif token.text in ["output", "extern", "refining", "specialize", "mutable"]:
+            ## Declarations this checker doesn't model are left to EverParse, the names they declare are known from then on.
+            self.recover()
+            self.declare_skipped()
+        else:
+            self.fail(token, f"Syntax error: unexpected '{token.text}', expected a declaration")
+
+    def declare_skipped(self):
+        ## The names outside braces and parentheses, e.g. _O, O and PO of output typedef struct _O { ... } O, *PO; or the
+        ## function of an extern, may be used as types or in expressions later.
+        depth = 0
+        for token in self.tokens[self.start:self.pos]:
+            if token.text in ["{", "(", "["] or token.kind in ["arraykind", "action"]:
+                depth += 1
+            elif token.text in ["}", ")", "]"]:
+                depth = max(depth - 1, 0)
+            elif token.kind == "ident" and depth == 0:
+                self.types.add(token.text)
+                self.constants.add(token.text)
+
+    def lint(self):
+        while self.peek().kind != "eof":
+            try:
+                self.declaration()
+            except SyntaxError3D:
+                self.recover()
+        return self.errors, self.warnings
+
+
+def lint(spec, module_name = None):
+    """
+    (errors, warnings) of the spec, as lists of (line, column, message). If module_name is given, it must be a declared type.
+    """
+    linter = Linter(spec)
+    errors, warnings = linter.lint()
+    if module_name is not None and not errors and module_name not in linter.types:
+        warnings.append((1, 1, f"Module name {module_name} is not defined, it must be the name of the entrypoint type"))
+    return sorted(errors), sorted(warnings)
+
+
+def format_diagnostics(filename, errors, warnings = []):
+    lines = [f"{filename}:({line},{col}): (Error) {message}" for line, col, message in errors]
+    lines += [f"{filename}:({line},{col}): (Warning) {message}" for line, col, message in warnings]
+    return "\n".join(lines)
+
+
+def read_specs(paths):
+    """
+    (name, spec) of the .3d files in paths: files, directories and zip archives
+    """
+    for path in paths:
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                for name in sorted(archive.namelist()):
+                    if name.endswith(".3d") and "__MACOSX" not in name:
+                        yield f"{path}:{name}", archive.read(name).decode("utf-8", errors="replace")
+        elif os.path.isdir(path):
+            for root, _, files in sorted(os.walk(path)):
+                for name in sorted(files):
+                    if name.endswith(".3d"):
+                        with open(os.path.join(root, name), "r") as f:
+                            yield os.path.join(root, name), f.read()
+        else:
+            with open(path, "r") as f:
+                yield path, f.read()
+
+
+def everparse_accepts(spec_path, everparse):
+    sp = subprocess.Popen(["bash", everparse, spec_path, "--odir", os.path.join(os.path.dirname(spec_path) or ".", ".lint_benchmark")],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = sp.communicate()
+    return "EverParse succeeded" in out.decode("utf-8", errors="replace")
+
+
+def benchmark(paths, everparse = None):
+    """
+    Lint every spec and, with everparse, run EverParse on it too and compare verdicts and time
+    """
+    specs = list(read_specs(paths))
+    lint_time, everparse_time = 0.0, 0.0
+    rejected, agree, false_errors = 0, 0, []
+    for name, spec in specs:
+        start = time.perf_counter()
+        errors, _ = lint(spec)
+        lint_time += time.perf_counter() - start
+        rejected += bool(errors)
+        if everparse is not None and os.path.exists(name):
+            start = time.perf_counter()
+            accepted = everparse_accepts(name, everparse)
+            everparse_time += time.perf_counter() - start
+            agree += accepted != bool(errors)
+            if accepted and errors:
+                false_errors.append(name)
+    print(f"{len(specs)} specs, {rejected} rejected by the pre-checker in {1000 * lint_time:.1f}ms ({1000 * lint_time / max(len(specs), 1):.2f}ms per spec)")
+    if everparse is not None:
+        print(f"EverParse took {everparse_time:.1f}s, verdicts agree on {agree} specs")
+        for name in false_errors:
+            print(f"Rejected by the pre-checker but accepted by EverParse: {name}")
+    return {"specs": len(specs), "rejected": rejected, "lint_time": lint_time, "everparse_time": everparse_time, "agree": agree, "false_errors": false_errors}
+
+
+declaration_start = re.compile(r"^\s*(typedef|entrypoint|casetype|#define|output|extern|\w+\s+enum)\b")
+
+
+def manual_specs(manual):
+    """
+    The 3D snippets of the manual: runs of declarations, starting at a line that opens one and ending at
+    the first line of prose after a complete declaration
+    """
+    specs, current, depth = [], [], 0
+    for line in manual.splitlines() + [""]:
+        complete = depth == 0 and (not current or current[-1].rstrip().endswith(";") or current[-1].lstrip().startswith("#define"))
+        if current and complete and line.strip() and not declaration_start.match(line):
+            specs.append("\n".join(current).strip() + "\n")
+            current = []
+        if not current and not declaration_start.match(line):
+            continue
+        current.append(line)
+        depth += line.count("{") - line.count("}")
+    return specs
+
+
+def check(manual = "3d_manuals/3d_manual.txt", example = "examples/multi_agent_example.txt"):
+    """
+    Lint every spec of the 3D manual and the examples, all of them are valid and none may have errors
+    """
+    from benchmark import example_specs
+    with open(manual, "r") as f:
+        specs = [(f"{manual}:{i}", spec) for i, spec in enumerate(manual_specs(f.read()))]
+    specs += list(example_specs(example))
+    failed = 0
+    for name, spec in specs:
+        errors, _ = lint(spec)
+        if errors:
+            failed += 1
+            print(format_diagnostics(name, errors))
+            print(spec)
+    print(f"{len(specs)} specs, {failed} with errors")
+    return failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('specs', nargs='*', help='.3d files, directories or zip archives of them')
+    parser.add_argument('--module', type=str, help='Module name (entrypoint type) the spec must define', required=False)
+    parser.add_argument('--benchmark', action='store_true', help='Only report counts and timings', required=False)
+    parser.add_argument('--everparse', type=str, help='/path/to/everparse.sh to compare verdicts and timings with (benchmark)', required=False)
+    parser.add_argument('--check', action='store_true', help='Lint the specs of the 3D manual and the examples, none may have errors', required=False)
+    args = parser.parse_args()
+
+    if args.check:
+        return 0 if check() else 1
+    if not args.specs:
+        parser.error("the following arguments are required: specs")
+
+    if args.benchmark:
+        benchmark(args.specs, args.everparse)
+        return 0
+    failed = False
+    for name, spec in read_specs(args.specs):
+        errors, warnings = lint(spec, args.module)
+        failed |= bool(errors)
+        if errors or warnings:
+            print(format_diagnostics(name, errors, warnings))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import fcntl
+import random
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import weakref
+import threading
+import contextlib
+import email.utils
+from dotenv import load_dotenv
+from manual_index import count_tokens
+from tracing import span
+
+"""
+Shared, rate-limit-aware access to the LLM endpoint.
+
+All LLM calls of a process (RFC cleaning, the Developer agent) go through one pooled client per
+endpoint, and all processes calling the same endpoint (e.g. concurrent attempts, see
+multi_agent_collab.py --parallel) share its quota through files in a state directory:
+    buckets.json  -- token buckets of requests and tokens, refilled at the deployment's RPM and TPM
+                     quotas (OPENAI_RPM, OPENAI_TPM), and the time until which the endpoint asked
+                     all callers to back off (Retry-After of a 429 response),
+    slot.N        -- OPENAI_CONCURRENCY slots held with flock while a request is in flight, released
+                     by the OS if the process dies.
+A request first waits for its estimated tokens (prompt plus max_tokens) and a slot, so calls queue up
+locally instead of being rejected by the endpoint. A 429 pauses all callers for its Retry-After and is
+retried without counting as a failed attempt. Timeouts, connection and server errors are retried
+with backoff a few times, other errors (bad request, authentication) are raised at once.
+The endpoint's x-ratelimit-remaining-* headers correct the buckets where they are lower.
+
+LLMClient.chat is synchronous, LLMClient.achat the asyncio variant for concurrent requests, and
+LLMClient.call wraps other clients' calls (autogen's) in the same limits and retries.
+
+    python llm_client.py stub --port 8000 --rpm 60 --tpm 20000
+    OPENAI_LOCAL_BASE=http://127.0.0.1:8000/v1 python llm_client.py bench --requests 200 --workers 16
+"""
+
+## (base url, api key, api version) -> client, one connection pool per endpoint and process. The connections
+## of async clients belong to an event loop, they are kept per loop.
+clients = {}
+async_clients = weakref.WeakKeyDictionary()
+clients_lock = threading.Lock()
+default = None
+
+
+def endpoint():
+    """
+    (base url, api key, api version) of the endpoint, a local OpenAI compatible one (OPENAI_LOCAL_BASE) takes precedence over Azure
+    """
+    load_dotenv()
+    if os.getenv("OPENAI_LOCAL_BASE"):
+        return os.getenv("OPENAI_LOCAL_BASE"), os.getenv("OPENAI_API_KEY", "local"), None
+    return os.getenv("OPENAI_API_BASE"), os.getenv("OPENAI_API_KEY"), "2023-08-01-preview"
+
+
+def get_client(async_client = False):
+    from openai import OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI
+    base_url, api_key, api_version = endpoint()
+    key = (base_url, api_key, api_version)
+    with clients_lock:
+        cache = async_clients.setdefault(asyncio.get_running_loop(), {}) if async_client else clients
+        if key not in cache:
+            ## Retries are ours, see LLMClient.
+            if api_version is None:
+                cache[key] = (AsyncOpenAI if async_client else OpenAI)(api_key=api_key, base_url=base_url, max_retries=0)
+            else:
+                cache[key] = (AsyncAzureOpenAI if async_client else AzureOpenAI)(api_key=api_key, azure_endpoint=base_url, api_version=api_version, max_retries=0)
+        return cache[key]
+
+
+def retry_after(error):
+    """
+    Seconds the endpoint asked to wait in the headers of an error response, None if it didn't
+    """
+    response = getattr(error, "response", None)
+    if response is None and error.__cause__ is not None:
+        ## A re-raised openai error, see error_kind.
+        response = getattr(error.__cause__, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time()) if date is not None else None
+
+
+def backoff(retries, cap = 60):
+    return min(cap, 2 ** retries) * (0.5 + random.random() / 2)
+
+
+def retry_delay(error, retries):
+    """
+    Seconds to wait before retrying after error, the endpoint's Retry-After if it sent one
+    """
+    after = retry_after(error)
+    return after if after is not None else backoff(retries)
+
+
+def error_kind(error):
+    """
+    'rate_limit', 'transient' (worth retrying) or None (raise)
+    """
+    import openai
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+        return "transient"
+    if isinstance(error, openai.APIStatusError) and error.status_code in [408, 409, 502, 503, 504]:
+        return "transient"
+    ## Callers may re-raise the openai error as another one, autogen raises a timeout as the builtin TimeoutError.
+    if isinstance(error, TimeoutError):
+        return "transient"
+    if error.__cause__ is not None and error.__cause__ is not error:
+        return error_kind(error.__cause__)
+    return None
+
+
+def estimate_tokens(messages, max_tokens = None):
+    prompt = sum(count_tokens(str(m.get("content") or "")) + count_tokens(json.dumps(m.get("function_call") or "")) + 4 for m in messages)
+    return prompt + (max_tokens or 1000)
+
+
+class RateLimiter:
+    """
+    Request and token buckets and concurrency slots shared by all processes with the same state_dir.
+    Buckets hold burst seconds of the quota, rpm or tpm of 0 disable a bucket.
+    """
+    def __init__(self, state_dir, rpm = 0, tpm = 0, concurrency = 0, burst = 10):
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        self.rates = {"requests": rpm / 60, "tokens": tpm / 60}
+        self.capacity = {name: max(rate * burst, 1) for name, rate in self.rates.items()}
+        self.concurrency = concurrency
+
+    @contextlib.contextmanager
+    def state(self):
+        with open(os.path.join(self.state_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            path = os.path.join(self.state_dir, "buckets.json")
+            now = time.time()
+            try:
+                with open(path, "r") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {"requests": self.capacity["requests"], "tokens": self.capacity["tokens"], "updated": now, "paused_until": 0}
+            for name, rate in self.rates.items():
+                state[name] = min(self.capacity[name], state[name] + rate * (now - state["updated"]))
+            state["updated"] = now
+            yield state
+            with open(path + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(path + ".tmp", path)
+
+    def reserve(self, tokens):
+        """
+        Take a request and tokens from the buckets. Returns 0 if they were taken, else the seconds to wait before trying again.
+        """
+        with self.state() as state:
+            now = state["updated"]
+            if now < state["paused_until"]:
+                return state["paused_until"] - now
+            ## A request larger than the bucket waits for a full bucket, not forever.
+            need = {"requests": 1, "tokens": min(tokens, self.capacity["tokens"])}
+            wait = max([(need[name] - state[name]) / rate for name, rate in self.rates.items() if rate > 0 and state[name] < need[name]], default=0)
+            if wait > 0:
+                return wait
+            for name, rate in self.rates.items():
+                if rate > 0:
+                    state[name] -= need[name]
+            return 0
+
+    def settle(self, estimated, actual):
+        """
+        Return the tokens a request was estimated to use but didn't, or take the ones it used in excess
+        """
+        if self.rates["tokens"] > 0:
+            with self.state() as state:
+                state["tokens"] = min(self.capacity["tokens"], state["tokens"] + estimated - actual)
+
+    def pause(self, seconds):
+        with self.state() as state:
+            state["paused_until"] = max(state["paused_until"], time.time() + seconds)
+
+    def observe(self, headers):
+        ## The endpoint knows better what is left of the quota.
+        remaining = {"requests": headers.get("x-ratelimit-remaining-requests"), "tokens": headers.get("x-ratelimit-remaining-tokens")}
+        remaining = {name: float(value) for name, value in remaining.items() if value is not None and self.rates[name] > 0}
+        if remaining:
+            with self.state() as state:
+                for name, value in remaining.items():
+                    state[name] = min(state[name], value)
+
+    def try_slot(self):
+        """
+        A free concurrency slot (open, locked file), None if all are taken
+        """
+        for i in random.sample(range(self.concurrency), self.concurrency):
+            f = open(os.path.join(self.state_dir, f"slot.{i}"), "w")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except OSError:
+                f.close()
+        return None
+
+    def release(self, slot):
+        if slot is not None:
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            slot.close()
+
+    def acquire(self, tokens):
+        """
+        Wait for the tokens and a slot. Returns (slot, seconds waited).
+        """
+        start = time.time()
+        while True:
+            wait = self.reserve(tokens)
+            if wait == 0:
+                break
+            time.sleep(min(wait, 5))
+        slot = None
+        while self.concurrency > 0 and slot is None:
+            slot = self.try_slot()
+            if slot is None:
+                time.sleep(0.05)
+        return slot, time.time() - start
+
+    async def aacquire(self, tokens):
+        ## The state and slot files are locked with flock, which blocks, so they are handled off the event loop.
+        start = time.time()
+        while True:
+            wait = await asyncio.to_thread(self.reserve, tokens)
+            if wait == 0:
+                break
+            await asyncio.sleep(min(wait, 5))
+        slot = None
+        while self.concurrency > 0 and slot is None:
+            slot = await asyncio.to_thread(self.try_slot)
+            if slot is None:
+                await asyncio.sleep(0.05)
+        return slot, time.time() - start
+
+
+def limiter_from_env():
+    """
+    The limiter of the endpoint's quota (OPENAI_RPM, OPENAI_TPM, OPENAI_CONCURRENCY), shared by all processes on this host
+    """
+    base_url, _, _ = endpoint()
+    state_dir = os.getenv("OPENAI_LIMIT_DIR") or os.path.join(tempfile.gettempdir(), f"3dgen_llm_{hashlib.sha256(str(base_url).encode('utf-8')).hexdigest()[:12]}")
+    return RateLimiter(state_dir, float(os.getenv("OPENAI_RPM", 0)), float(os.getenv("OPENAI_TPM", 0)), int(os.getenv("OPENAI_CONCURRENCY", 8)))
+
+
+class LLMClient:
+    def __init__(self, limiter = None, max_retries = 5, max_rate_limited = 50):
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.max_rate_limited = max_rate_limited
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "rate_limited": 0, "retries": 0, "waited": 0.0, "tokens": 0}
+
+    def count(self, key, value = 1):
+        with self.lock:
+            self.stats[key] += value
+
+    def release(self, slot):
+        if self.limiter is not None:
+            self.limiter.release(slot)
+
+    def failed(self, error, estimated, retries):
+        """
+        Seconds to wait before retrying the request that failed with error, raises error if it shouldn't be retried.
+        retries counts the earlier failures by kind and is updated.
+        """
+        kind = error_kind(error)
+        if self.limiter is not None:
+            self.limiter.settle(estimated, 0)
+        if kind is None or retries[kind] >= (self.max_rate_limited if kind == "rate_limit" else self.max_retries):
+            raise error
+        delay = retry_delay(error, retries[kind])
+        retries[kind] += 1
+        self.count("rate_limited" if kind == "rate_limit" else "retries")
+        if kind == "rate_limit" and self.limiter is not None:
+            ## Everybody backs off, not just this request, acquire() waits for the pause to end.
+            self.limiter.pause(delay)
+            delay = 0
+        print(f"LLM request failed ({error}), retrying in {delay:.1f}s")
+        return delay
+
+    def succeeded(self, slot, estimated, used):
+        self.release(slot)
+        self.count("tokens", used)
+        if self.limiter is not None:
+            self.limiter.settle(estimated, used)
+
+    def call(self, function, estimated, usage = None):
+        """
+        function() within the limits, retried on rate limits and transient errors. usage(result) is the number
+        of tokens the call used, the estimate is settled with it.
+        """
+        retries = {"rate_limit": 0, "transient": 0}
+        while True:
+            slot = None
+            if self.limiter is not None:
+                slot, waited = self.limiter.acquire(estimated)
+                self.count("waited", waited)
+            try:
+                self.count("requests")
+                result = function()
+            except Exception as e:
+                self.release(slot)
+                time.sleep(self.failed(e, estimated, retries))
+                continue
+            self.succeeded(slot, estimated, usage(result) if usage is not None else estimated)
+            return result
+
+    def parse(self, raw):
+        if self.limiter is not None:
+            self.limiter.observe(raw.headers)
+        return raw.parse()
+
+    def chat(self, model, messages, max_tokens = None, **kwargs):
+        estimated = estimate_tokens(messages, max_tokens)
+        with span("llm_request", model=model, estimated_tokens=estimated) as s:
+            def request():
+                raw = get_client().chat.completions.with_raw_response.create(model=model, messages=messages, max_tokens=max_tokens, **kwargs)
+                return self.parse(raw)
+            response = self.call(request, estimated, usage_tokens)
+            set_usage(s, response)
+        return response
+
+    async def achat(self, model, messages, max_tokens = None, **kwargs):
+        estimated = estimate_tokens(messages, max_tokens)
+        retries = {"rate_limit": 0, "transient": 0}
+        with span("llm_request", model=model, estimated_tokens=estimated) as s:
+            while True:
+                slot = None
+                if self.limiter is not None:
+                    slot, waited = await self.limiter.aacquire(estimated)
+                    self.count("waited", waited)
+                try:
+                    self.count("requests")
+                    raw = await get_client(async_client=True).chat.completions.with_raw_response.create(model=model, messages=messages, max_tokens=max_tokens, **kwargs)
+                    response = await asyncio.to_thread(self.parse, raw)
+                except Exception as e:
+                    self.release(slot)
+                    await asyncio.sleep(await asyncio.to_thread(self.failed, e, estimated, retries))
+                    continue
+                await asyncio.to_thread(self.succeeded, slot, estimated, usage_tokens(response))
+                set_usage(s, response)
+                return response
+
+    def report(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+def usage_tokens(response):
+    usage = getattr(response, "usage", None)
+    return usage.total_tokens if usage is not None else 0
+
+
+def set_usage(s, response):
+    if getattr(response, "usage", None) is not None:
+        s.set("prompt_tokens", response.usage.prompt_tokens)
+        s.set("completion_tokens", response.usage.completion_tokens)
+
+
+def default_client():
+    """
+    The process' LLMClient, limited by the endpoint's quota from the environment
+    """
+    global default
+    with clients_lock:
+        if default is None:
+            default = LLMClient(limiter_from_env())
+        return default
+
+
+def stub_server(port, rpm, tpm, latency, reply):
+    """
+    A local OpenAI compatible chat endpoint enforcing rpm and tpm like the real one: 429 with Retry-After beyond the quota
+    """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    limiter = RateLimiter(tempfile.mkdtemp(prefix="3dgen_stub_"), rpm, tpm, 0, burst=10)
+    counts = {"ok": 0, "rejected": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            prompt = sum(count_tokens(str(m.get("content") or "")) for m in body.get("messages", []))
+            completion = min(body.get("max_tokens") or 100, count_tokens(reply))
+            wait = limiter.reserve(prompt + completion)
+            if wait > 0:
+                counts["rejected"] += 1
+                self.respond(429, {"error": {"message": "Rate limit exceeded", "type": "rate_limit", "code": "429"}},
+                             {"retry-after-ms": str(int(1000 * wait) + 1), "retry-after": str(int(wait) + 1)})
+                return
+            time.sleep(latency)
+            counts["ok"] += 1
+            state = {}
+            with limiter.state() as s:
+                state = dict(s)
+            self.respond(200, {
+                "id": f"stub-{counts['ok']}", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", "stub"),
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": reply}}],
+                "usage": {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion},
+            }, {"x-ratelimit-remaining-requests": str(int(state["requests"])) if rpm else None,
+                "x-ratelimit-remaining-tokens": str(int(state["tokens"])) if tpm else None})
+
+        def respond(self, status, body, headers):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers.items():
+                if value is not None:
+                    self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    print(f"Stub endpoint at http://127.0.0.1:{port}/v1, {rpm} RPM, {tpm} TPM")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"{counts['ok']} requests served, {counts['rejected']} rejected")
+
+
+def bench(requests, workers, prompt_tokens, max_tokens):
+    """
+    Send requests chat requests, workers at a time, and report throughput and rate limiting
+    """
+    client = default_client()
+    messages = [{"role": "user", "content": "word " * prompt_tokens}]
+
+    async def run():
+        semaphore = asyncio.Semaphore(workers)
+        async def one():
+            async with semaphore:
+                return await client.achat("stub", messages, max_tokens)
+        return await asyncio.gather(*[one() for _ in range(requests)])
+
+    start = time.time()
+    responses = asyncio.run(run())
+    elapsed = time.time() - start
+    report = client.report()
+    print(f"{len(responses)} responses in {elapsed:.1f}s ({len(responses) / elapsed:.2f}/s, {report['tokens'] / elapsed * 60:.0f} tokens/min)")
+    print(f"{report['requests']} requests sent, {report['rate_limited']} rate limited, {report['retries']} retried, {report['waited']:.1f}s waited for the quota")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['stub', 'bench'], help='stub: run a local rate limited endpoint, bench: load the endpoint through the client')
+    parser.add_argument('--port', type=int, help='stub: port', default=8000)
+    parser.add_argument('--rpm', type=float, help='stub: requests per minute', default=60)
+    parser.add_argument('--tpm', type=float, help='stub: tokens per minute', default=20000)
+    parser.add_argument('--latency', type=float, help='stub: seconds per response', default=0.2)
+    parser.add_argument('--reply', type=str, help='stub: the reply', default='All packets accepted')
+    parser.add_argument('--requests', type=int, help='bench: number of requests', default=100)
+    parser.add_argument('--workers', type=int, help='bench: concurrent requests', default=8)
+    parser.add_argument('--prompt_tokens', type=int, help='bench: prompt size', default=200)
+    parser.add_argument('--max_tokens', type=int, help='bench: max_tokens of the requests', default=50)
+    args = parser.parse_args()
+
+    if args.command == 'stub':
+        stub_server(args.port, args.rpm, args.tpm, args.latency, args.reply)
+    else:
+        bench(args.requests, args.workers, args.prompt_tokens, args.max_tokens)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,129 @@
-import json 
+import json
+import os
+import time
+import gzip
+import zlib
+import queue
+import atexit
+import threading
+
+## Queued by AsyncMessageLogger.files(): end the live segment, writing its gzip trailer.
+end_segment = object()
+
+def segment_name(filename, index, compress):
+    name = filename if index == 0 else f"{filename}.{index}"
+    return name + ".gz" if compress else name
+
+
+def log_segments(filename):
+    """
+    Files of a log in order: the log itself, or the (compressed) segments an AsyncMessageLogger rotated it into
+    """
+    segments = []
+    for compress in [False, True]:
+        index = 0
+        while os.path.exists(segment_name(filename, index, compress)):
+            segments.append(segment_name(filename, index, compress))
+            index += 1
+        if segments:
+            break
+    if not segments and os.path.exists(filename):
+        segments = [filename]
+    return segments
+
+
+def segment_lines(segment):
+    """
+    Lines of a log segment. A compressed segment that is still being written, or was cut off by a
+    crash, has no gzip trailer; its lines up to the last flush are read.
+    """
+    if not segment.endswith(".gz"):
+        with open(segment, "r") as f:
+            yield from f
+        return
+    with gzip.open(segment, "rt") as f:
+        try:
+            yield from f
+        except EOFError:
+            return
+
+
+def read_log(filename):
+    """
+    Yield the JSON records of a log, streaming through all of its segments. A results record may
+    be appended to a line without a newline, so every line is decoded record by record.
+    """
+    decoder = json.JSONDecoder()
+    for segment in log_segments(filename):
+        for line in segment_lines(segment):
+            ## Only the last line of a segment lacks its newline, a partial record if the writer crashed.
+            complete = line.endswith("\n")
+            line = line.strip()
+            while line:
+                try:
+                    record, end = decoder.raw_decode(line)
+                except ValueError:
+                    if complete:
+                        raise
+                    break
+                yield record
+                line = line[end:].strip()
+
+
+class AttemptMetrics:
+    """
+    Per-attempt counters and outcome events, updated as agent messages arrive
+    """
+    def __init__(self, protocol, attempt, filename):
+        self.protocol = protocol
+        self.attempt = attempt
+        self.filename = filename
+        self.started = time.time()
+        self.finished = None
+        self.messages = 0
+        self.syntax_refinements = 0
+        self.packet_refinements = 0
+        self.success = False
+        self.spec_file = ""
+        self.events = []
+
+    def update(self, message, line = None):
+        ## Only the Executor reports results, the Developer's messages may quote them.
+        if message.get("sender") == "Developer":
+            return
+        self.messages += 1
+        if line is None:
+            line = json.dumps(message)
+        n = message.get("n")
+        if "All packets accepted" in line:
+            self.success = True
+            spec_file = line.split("everparse_files/")[-1].split(".3d")[0]
+            self.spec_file = os.path.abspath("everparse_files/" + spec_file + ".3d")
+            self.events.append({"n": n, "event": "accepted", "time": time.time()})
+        else:
+            ## Success is only reported by the last message of the attempt.
+            self.success = False
+        if "Processing files: everparse_files/" in line or "syntax error" in line:
+            self.syntax_refinements += 1
+            self.events.append({"n": n, "event": "syntax_error", "time": time.time()})
+        if "Packet failed" in line:
+            self.packet_refinements += 1
+            self.events.append({"n": n, "event": "packet_failed", "time": time.time()})
+
+    def results(self):
+        return {
+            "protocol": self.protocol,
+            "attempt": self.attempt,
+            "success": self.success,
+            "filename": self.filename,
+            "syntax_refinements": self.syntax_refinements,
+            "packet_refinements": self.packet_refinements,
+            "spec_file": self.spec_file,
+            "messages": self.messages,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
 
 class MessageLogger:
     """
@@ -6,14 +131,28 @@ class MessageLogger:
     """
     def __init__(self, filename):
         self.filename = filename
+        self.metrics = None
 
-    def log_message(self, message):
+    def start_attempt(self, protocol, attempt):
+        ## Counters of the messages logged from now on.
+        self.metrics = AttemptMetrics(protocol, attempt, self.filename)
+        return self.metrics
+
+    def write(self, line):
         try:
             with open(self.filename, "a") as file:
-                file.write(json.dumps(message) + "\n")
+                file.write(line + "\n")
         except IOError as e:
             print(f"Error writing to log file: {e}")
-            
+
+    def log_message(self, message):
+        line = json.dumps(message)
+        if self.metrics is not None:
+            self.metrics.update(message, line)
+        self.write(line)
+
+    def log_record(self, record):
+        self.write(json.dumps(record))
             
     def log_rag_results(self, code, context):
         #build json object
@@ -21,8 +160,107 @@ class MessageLogger:
             "code": code,
             "context": context
         }
+        self.log_record(results)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def files(self):
+        return log_segments(self.filename)
+
+
+class AsyncMessageLogger(MessageLogger):
+    """
+    Log agent message history from a background thread. Records are handed over through a bounded
+    queue and written in batches, gzip compressed by default, into segments of at most max_bytes:
+    <filename>.gz, <filename>.1.gz, ... Every batch is flushed to disk, so a crash loses at most
+    the records still queued. The queue is drained when the logger is closed or the process exits.
+    """
+    def __init__(self, filename, compress = True, max_bytes = 64 << 20, max_queue = 1024, batch = 64):
+        super().__init__(filename)
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.batch = batch
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.index = 0
+        while os.path.exists(segment_name(filename, self.index, compress)):
+            self.index += 1
+        self.raw = None
+        self.file = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def open_segment(self):
+        self.raw = open(segment_name(self.filename, self.index, self.compress), "ab")
+        self.file = gzip.GzipFile(fileobj=self.raw, mode="ab") if self.compress else self.raw
+
+    def close_segment(self):
+        if self.file is not None:
+            self.file.close()
+            if self.compress:
+                self.raw.close()
+            self.file = None
+            self.raw = None
+
+    def write_batch(self, lines):
         try:
-            with open(self.filename, "a") as file:
-                file.write(json.dumps(results) + "\n")
+            if self.file is None:
+                self.open_segment()
+            self.file.write("".join(line + "\n" for line in lines).encode("utf-8"))
+            if self.compress:
+                self.file.flush(zlib.Z_SYNC_FLUSH)
+            self.raw.flush()
+            if self.raw.tell() >= self.max_bytes:
+                self.close_segment()
+                self.index += 1
         except IOError as e:
-            print(f"Error writing to log file: {e}")
\ No newline at end of file
+            print(f"Error writing to log file: {e}")
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            items = [item]
+            while item is not None and item is not end_segment and len(items) < self.batch:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                items.append(item)
+            lines = [l for l in items if isinstance(l, str)]
+            if lines:
+                self.write_batch(lines)
+            if item is None or item is end_segment:
+                self.close_segment()
+            for _ in items:
+                self.queue.task_done()
+            if item is None:
+                return
+
+    def write(self, line):
+        if self.closed:
+            print(f"Error writing to log file: {self.filename} is closed")
+            return
+        ## Blocks if the writer falls behind by more than max_queue records.
+        self.queue.put(line)
+
+    def flush(self):
+        self.queue.join()
+        
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+
+    def files(self):
+        ## Segments are only complete gzip files once closed. Records logged later are appended to the
+        ## live segment as a new gzip member.
+        if not self.closed:
+            self.queue.put(end_segment)
+        self.flush()
+        return log_segments(self.filename)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import re
+import math
+import argparse
+
+try:
+    import tiktoken
+    encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    encoding = None
+
+"""
+Offline BM25 index over the 3D manual and the worked examples, to shrink the Developer's system message.
+
+get_developer_prompt used to embed the whole manual (3d_manuals/3d_manual.txt) and all examples
+(examples/multi_agent_example.txt), and the system message is resent with every LLM call of up to n
+refinement loops. The manual is split into its sections (headings end in '¶'), the examples into the
+blocks between '#####' lines, and a PromptRetriever selects the sections and examples most relevant to
+the RFC and the latest EverParse error, within a token budget. It also keeps count of the tokens the
+selection saved compared to the full manual and examples.
+
+    python manual_index.py --manual 3d_manuals/3d_manual.txt --query "casetype switch bitfield" --budget 3000
+"""
+
+
+def count_tokens(text):
+    ## Without tiktoken, ~4 characters per token is close enough for budgeting.
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def terms(text):
+    ## 3D identifiers and keywords such as byte-size, consume-all or UINT16BE are single terms.
+    return re.findall(r"[a-z0-9_]+(?:-[a-z0-9_]+)*", text.lower())
+
+
+def manual_sections(manual):
+    """
+    Split the manual into its sections. Manuals without '¶' headings are split into paragraphs.
+    """
+    lines = manual.splitlines(keepends=True)
+    if not any(line.rstrip().endswith("¶") for line in lines):
+        return [p for p in re.split(r"\n\s*\n", manual) if p.strip()]
+    sections, current = [], []
+    for line in lines:
+        if line.rstrip().endswith("¶") and current:
+            sections.append("".join(current))
+            current = []
+        current.append(line)
+    if current:
+        sections.append("".join(current))
+    return [s for s in sections if s.strip()]
+
+
+def example_blocks(example):
+    return [b for b in re.split(r"\n#{5,}[ \t]*\n", example) if b.strip()]
+
+
+class BM25:
+    def __init__(self, docs, k1 = 1.5, b = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = [terms(doc) for doc in docs]
+        self.lengths = [len(doc) for doc in self.docs]
+        self.avg_length = sum(self.lengths) / len(self.docs) if self.docs else 0
+        self.tf = []
+        df = {}
+        for doc in self.docs:
+            tf = {}
+            for term in doc:
+                tf[term] = tf.get(term, 0) + 1
+            self.tf.append(tf)
+            for term in tf:
+                df[term] = df.get(term, 0) + 1
+        self.idf = {term: math.log(1 + (len(self.docs) - n + 0.5) / (n + 0.5)) for term, n in df.items()}
+
+    def scores(self, query):
+        ## Every distinct query term counts once, so a long RFC doesn't drown the error message.
+        query = set(terms(query)) & self.idf.keys()
+        scores = []
+        for tf, length in zip(self.tf, self.lengths):
+            score = 0.0
+            for term in query:
+                f = tf.get(term, 0)
+                if f:
+                    score += self.idf[term] * f * (self.k1 + 1) / (f + self.k1 * (1 - self.b + self.b * length / self.avg_length))
+            scores.append(score)
+        return scores
+
+
+class PromptRetriever:
+    """
+    Selects manual sections and examples for the Developer's system message within budget tokens
+    """
+    def __init__(self, manual, example, budget):
+        self.budget = budget
+        self.docs = [("manual", s) for s in manual_sections(manual)] + [("example", e) for e in example_blocks(example)]
+        self.tokens = [count_tokens(text) for _, text in self.docs]
+        self.index = BM25([text for _, text in self.docs])
+        self.full_tokens = count_tokens(manual) + count_tokens(example)
+        self.calls = 0
+        self.selected_tokens = 0
+
+    def select(self, query):
+        """
+        (manual, example) with the best scoring sections in their original order. The best example is always
+        kept if it fits, the examples show the whole task and its output format.
+        """
+        scores = self.index.scores(query)
+        ranked = sorted(range(len(self.docs)), key=lambda i: (-scores[i], i))
+        examples = [i for i in ranked if self.docs[i][0] == "example"]
+        if examples:
+            ranked.remove(examples[0])
+            ranked.insert(0, examples[0])
+
+        selected, used = set(), 0
+        for i in ranked:
+            if used + self.tokens[i] <= self.budget:
+                selected.add(i)
+                used += self.tokens[i]
+        manual = "\n".join(text for i, (kind, text) in enumerate(self.docs) if i in selected and kind == "manual")
+        example = "\n##########\n".join(text for i, (kind, text) in enumerate(self.docs) if i in selected and kind == "example")
+        return manual, example
+
+    def count(self, manual, example):
+        ## One LLM call sent this selection instead of the full manual and examples.
+        self.calls += 1
+        self.selected_tokens += count_tokens(manual) + count_tokens(example)
+
+    def report(self):
+        full = self.full_tokens * self.calls
+        return {
+            "prompt_budget": self.budget,
+            "prompt_calls": self.calls,
+            "prompt_full_tokens": full,
+            "prompt_selected_tokens": self.selected_tokens,
+            "prompt_saved_tokens": full - self.selected_tokens,
+            "prompt_saved_percent": 100.0 * (full - self.selected_tokens) / full if full else 0.0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--manual', type=str, help='/path/to/3D manual', default='3d_manuals/3d_manual.txt')
+    parser.add_argument('--example', type=str, help='/path/to/examples', default='examples/multi_agent_example.txt')
+    parser.add_argument('--query', type=str, help='RFC text or EverParse error to select sections for', required=True)
+    parser.add_argument('--budget', type=int, help='Token budget of the manual sections and examples', default=3000)
+    args = parser.parse_args()
+
+    with open(args.manual, "r") as f:
+        manual = f.read()
+    with open(args.example, "r") as f:
+        example = f.read()
+    retriever = PromptRetriever(manual, example, args.budget)
+    scores = retriever.index.scores(args.query)
+    for i in sorted(range(len(retriever.docs)), key=lambda i: -scores[i]):
+        kind, text = retriever.docs[i]
+        print(f"{scores[i]:8.3f} {retriever.tokens[i]:6} {kind:<8} {text.strip().splitlines()[0][:70]}")
+    manual, example = retriever.select(args.query)
+    retriever.count(manual, example)
+    print(retriever.report())
+
+
+if __name__ == "__main__":
+    main()
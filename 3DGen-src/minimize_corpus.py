@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import tempfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from combine_dats_to_pcap import generate_pcap
+from validate_with_tshark import dissector_coverage
+from z3_testgen import traces_file
+from tracing import span
+
+"""
+Coverage-guided minimization of z3 test sets.
+
+Every packet of a test set (<tests>/z3/*.dat, labelled in z3_packet_labels.json) is re-checked on
+every refinement round of the agent, although many packets exercise the same code. This script
+measures what every packet covers:
+    - the lines and branches of the protocol's dissector (packet-<dissector>.c) it executes in the
+      gcov instrumented tshark, one tshark run per packet,
+    - the 3D branch trace it was generated for (witness_traces.json, written by z3_testgen.py),
+    - its polarity (POS/NEG) and the tshark verdict in z3_packet_labels.json,
+and greedily selects the smallest set of packets that still covers all of it. Polarity and verdict
+are covered per combination, so the reduced set keeps accepted and rejected packets of both kinds.
+The reduced test set is written to <out>/z3 in the same layout, with its labels, and can be passed
+to multi_agent_collab.py --tests like the original one.
+
+    python minimize_corpus.py --protocol TCP --tests tests/TCP --out tests/TCP_min
+"""
+
+
+def packet_coverage(dat_path, protocol):
+    """
+    Dissector lines and branches executed by tshark for a single packet
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        dat_dir = os.path.join(temp_dir, "dat")
+        os.mkdir(dat_dir)
+        os.symlink(os.path.abspath(dat_path), os.path.join(dat_dir, os.path.basename(dat_path)))
+        pcap_file_path = os.path.join(temp_dir, "packet.pcap")
+        generate_pcap(dat_dir, protocol, pcap_file_path)
+
+        record = dissector_coverage(pcap_file_path, protocol)
+
+    features = {f"line:{line}" for line, count in record["lines"].items() if count > 0}
+    features |= {f"branch:{line}:{i}" for (line, i), count in record["branches"].items() if count > 0}
+    return features
+
+
+def polarity(packet):
+    return "NEG" if ".NEG." in packet else "POS"
+
+
+def packet_features(z3_dir, packets, protocol, packet_labels, traces, gcov = True, workers = 1):
+    """
+    {packet: set of features} for all packets
+    """
+    features = {}
+    for packet in packets:
+        label = packet_labels.get(packet, [None])[0]
+        features[packet] = {f"label:{polarity(packet)}:{label}"}
+        if packet in traces:
+            features[packet].add(f"trace:{polarity(packet)}:{traces[packet]}")
+
+    if gcov:
+        with span("packet_coverage", packets=len(packets), workers=workers), ThreadPoolExecutor(workers) as pool:
+            for packet, covered in zip(packets, pool.map(lambda packet: packet_coverage(os.path.join(z3_dir, packet), protocol), packets)):
+                features[packet] |= covered
+    return features
+
+
+def select(features, sizes):
+    """
+    Greedy set cover: repeatedly take the packet covering the most uncovered features, the smaller (then
+    lexicographically first) packet on ties. Returns the selected packets in order of selection.
+    """
+    uncovered = set().union(*features.values()) if features else set()
+    selected = []
+    candidates = sorted(features)
+    while uncovered:
+        best = min(candidates, key=lambda p: (-len(features[p] & uncovered), sizes[p], p))
+        gain = features[best] & uncovered
+        if not gain:
+            break
+        selected.append(best)
+        uncovered -= gain
+        candidates.remove(best)
+    return selected
+
+
+def minimize(tests, protocol, out, gcov = True, workers = None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    z3_dir = os.path.join(tests, "z3")
+    with open(os.path.join(z3_dir, "z3_packet_labels.json"), "r") as f:
+        packet_labels = json.load(f)
+    traces = {}
+    if os.path.exists(os.path.join(z3_dir, traces_file)):
+        with open(os.path.join(z3_dir, traces_file), "r") as f:
+            traces = json.load(f)
+
+    packets = sorted(p for p in os.listdir(z3_dir) if p.endswith(".dat"))
+    sizes = {p: os.path.getsize(os.path.join(z3_dir, p)) for p in packets}
+    features = packet_features(z3_dir, packets, protocol, packet_labels, traces, gcov, workers)
+    selected = select(features, sizes)
+
+    out_dir = os.path.join(out, "z3")
+    os.makedirs(out_dir, exist_ok=True)
+    for packet in selected:
+        shutil.copy2(os.path.join(z3_dir, packet), out_dir)
+    with open(os.path.join(out_dir, "z3_packet_labels.json"), "w") as f:
+        json.dump({p: packet_labels[p] for p in selected if p in packet_labels}, f)
+    if traces:
+        with open(os.path.join(out_dir, traces_file), "w") as f:
+            json.dump({p: traces[p] for p in selected if p in traces}, f)
+    for pcap in [f for f in os.listdir(z3_dir) if f.endswith(".z3.pcap")]:
+        generate_pcap(out_dir, protocol, os.path.abspath(os.path.join(out_dir, pcap)))
+
+    total = set().union(*features.values()) if features else set()
+    report = {
+        "tests": os.path.abspath(tests),
+        "packets": len(packets),
+        "selected": len(selected),
+        "features": len(total),
+        "lines": len([f for f in total if f.startswith("line:")]),
+        "branches": len([f for f in total if f.startswith("branch:")]),
+        "traces": len([f for f in total if f.startswith("trace:")]),
+        "gcov": gcov,
+        "packet_features": {p: sorted(features[p]) for p in selected},
+    }
+    with open(os.path.join(out_dir, "minimize_report.json"), "w") as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--protocol', type=str, help='Protocol to test [ipv4|ipv6|tcp|udp|icmp|vxlan|...]', required=True)
+    parser.add_argument('--tests', type=str, help='Test set to minimize, the folder containing z3/', required=True)
+    parser.add_argument('--out', type=str, help='Folder to write the reduced test set to', required=True)
+    parser.add_argument('--workers', type=int, help='Number of concurrent tshark runs, all cores by default', required=False)
+    parser.add_argument('--no_gcov', action='store_true', help='Only keep branch traces and labels covered, without measuring dissector coverage', required=False)
+    args = parser.parse_args()
+
+    report = minimize(args.tests, args.protocol, args.out, not args.no_gcov, args.workers)
+    print(f"Selected {report['selected']} of {report['packets']} packets covering {report['features']} features "
+          f"({report['lines']} lines, {report['branches']} branches, {report['traces']} branch traces) in {os.path.join(args.out, 'z3')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import shutil
+import zipfile
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+from combine_dats_to_pcap import generate_pcap
+from validate_with_tshark import validate, proto_alias
+from packed_corpus import open_corpus, polarity, pack, labels_file
+from tracing import span
+
+"""
+Mutation-based generation of negative (NEG) test packets.
+
+Z3 witnesses (3dgen_tests.py) are the only other source of NEG packets and are slow to generate.
+This script starts from the POS .dat files of a protocol, from packets.zip (packets/binary_files/<PROTOCOL>/)
+or from a test set directory, and mutates them in batches of NumPy arrays, one row per packet:
+    bitflip   -- flip up to max_flips random bits,
+    truncate  -- cut the packet at a random 1, 2 or 4 byte field boundary,
+    inflate   -- overwrite an 8 or 16 bit field in the header with a length larger than the packet,
+    splice    -- the head of one packet followed by the tail of another.
+Mutants are deduplicated by content hash (against the seeds, each other and the packets already in
+the test set), labelled with tshark like the Z3 witnesses, and added to <out>/z3 as
+mutant.N.NEG.<operator>.dat with their labels in z3_packet_labels.json, so the result can be passed
+to multi_agent_collab.py --tests.
+
+    python mutate_packets.py --protocol TCP --seeds packets.zip --out tests/TCP_mutants --count 20000
+"""
+
+operators = ["bitflip", "truncate", "inflate", "splice"]
+
+
+def read_seeds(seeds, protocol):
+    """
+    The POS packets of the protocol in packets.zip, or of a test set directory (or packed corpus)
+    """
+    packets = []
+    if seeds.endswith(".zip"):
+        with zipfile.ZipFile(seeds) as z:
+            for name in sorted(z.namelist()):
+                parts = name.split("/")
+                if "__MACOSX" in parts or len(parts) < 3 or not name.endswith(".dat"):
+                    continue
+                if parts[-3] == "binary_files" and parts[-2].lower() == protocol.lower() and polarity(name) == "POS":
+                    packets.append(z.read(name))
+    else:
+        with open_corpus(seeds) as corpus:
+            packets = [bytes(corpus.read(name)) for name in corpus.names() if polarity(name) == "POS"]
+    return packets
+
+
+class Mutator:
+    """
+    Generates batches of mutants of the seed packets
+    """
+    def __init__(self, seeds, rng, ops = operators, max_flips = 8, header_bytes = 64):
+        self.rng = rng
+        self.ops = [operators.index(op) for op in ops]
+        self.max_flips = max_flips
+        self.header_bytes = header_bytes
+        self.lengths = np.array([len(s) for s in seeds], dtype=np.int64)
+        ## Room for splices of the two longest seeds.
+        self.width = max(1, 2 * int(self.lengths.max()))
+        self.seeds = np.zeros((len(seeds), self.width), dtype=np.uint8)
+        for i, s in enumerate(seeds):
+            self.seeds[i, :len(s)] = np.frombuffer(s, dtype=np.uint8)
+
+    def batch(self, size):
+        """
+        (buffer, lengths, operator) of size mutants, the i-th mutant is buffer[i, :lengths[i]]
+        """
+        rng = self.rng
+        picks = rng.integers(0, len(self.seeds), size)
+        buf = self.seeds[picks]
+        lens = self.lengths[picks].copy()
+        ops = rng.choice(self.ops, size)
+        for op, mutate in enumerate([self.bitflip, self.truncate, self.inflate, self.splice]):
+            rows = np.flatnonzero(ops == op)
+            if len(rows):
+                mutate(buf, lens, rows)
+        return buf, lens, ops
+
+    def bitflip(self, buf, lens, rows):
+        flips = self.rng.integers(1, self.max_flips + 1, len(rows))
+        pos = (self.rng.random((len(rows), self.max_flips)) * lens[rows, None]).astype(np.int64)
+        bits = self.rng.integers(0, 8, (len(rows), self.max_flips))
+        masks = np.left_shift(1, bits) * (np.arange(self.max_flips) < flips[:, None])
+        np.bitwise_xor.at(buf, (np.broadcast_to(rows[:, None], pos.shape), pos), masks.astype(np.uint8))
+
+    def truncate(self, buf, lens, rows):
+        width = self.rng.choice([1, 2, 4], len(rows))
+        lens[rows] = (self.rng.random(len(rows)) * lens[rows]).astype(np.int64) // width * width
+
+    def inflate(self, buf, lens, rows):
+        rows = rows[lens[rows] >= 2]
+        n = len(rows)
+        window = np.minimum(lens[rows], self.header_bytes)
+        wide = self.rng.random(n) < 0.5
+        ## Fields are assumed aligned to their width.
+        offset = (self.rng.random(n) * (window - wide)).astype(np.int64)
+        offset[wide] -= offset[wide] % 2
+        value = np.minimum(lens[rows] + self.rng.integers(1, 1024, n), 0xFFFF)
+        value[self.rng.random(n) < 0.25] = 0xFFFF
+        buf[rows, offset] = np.where(wide, value >> 8, np.minimum(value, 0xFF)).astype(np.uint8)
+        buf[rows[wide], offset[wide] + 1] = (value[wide] & 0xFF).astype(np.uint8)
+
+    def splice(self, buf, lens, rows):
+        other = self.rng.integers(0, len(self.seeds), len(rows))
+        head = (self.rng.random(len(rows)) * (lens[rows] + 1)).astype(np.int64)
+        tail = (self.rng.random(len(rows)) * (self.lengths[other] + 1)).astype(np.int64)
+        columns = np.arange(self.width)
+        source = np.clip(tail[:, None] + columns - head[:, None], 0, self.width - 1)
+        spliced = np.take_along_axis(self.seeds[other], source, axis=1)
+        buf[rows] = np.where(columns < head[:, None], buf[rows], spliced)
+        lens[rows] = np.minimum(head + self.lengths[other] - tail, self.width)
+
+
+def mutate(seeds, count, seen, batch = 4096, seed = None, ops = operators, max_flips = 8):
+    """
+    Up to count distinct mutants [(operator, bytes)] not in seen (sha256 hex digests, updated)
+    """
+    mutator = Mutator(seeds, np.random.default_rng(seed), ops, max_flips)
+    mutants = []
+    stale = 0
+    while len(mutants) < count:
+        buf, lens, kinds = mutator.batch(batch)
+        new = 0
+        for i in range(batch):
+            data = buf[i, :lens[i]].tobytes()
+            digest = hashlib.sha256(data).hexdigest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+            mutants.append((operators[kinds[i]], data))
+            new += 1
+            if len(mutants) == count:
+                break
+        ## Small seed sets run out of distinct mutants for some operators.
+        stale = stale + 1 if new == 0 else 0
+        if stale == 10:
+            print(f"No new mutants in {stale} batches, stopping at {len(mutants)}")
+            break
+    return mutants
+
+
+def label(dir, protocol):
+    """
+    tshark labels of the .dat files in dir, as in z3_packet_labels.json
+    """
+    pcap_file_path = os.path.abspath(os.path.join(dir, "mutants.pcap"))
+    generate_pcap(dir, protocol, pcap_file_path)
+    results, _ = validate(pcap_file_path, proto_alias[protocol.lower()])
+    os.remove(pcap_file_path)
+    return results
+
+
+def add_mutants(out, protocol, mutants, next_index, labelled = True):
+    """
+    Write the mutants to out (a test set's z3 directory), labelled with tshark, and merge their labels
+    """
+    labels = {}
+    if os.path.exists(os.path.join(out, labels_file)):
+        with open(os.path.join(out, labels_file), "r") as f:
+            labels = json.load(f)
+    with tempfile.TemporaryDirectory(dir=out) as round_dir:
+        names = []
+        for i, (op, data) in enumerate(mutants):
+            name = f"mutant.{next_index + i}.NEG.{op}.dat"
+            with open(os.path.join(round_dir, name), "wb") as f:
+                f.write(data)
+            names.append(name)
+        if labelled:
+            with span("label_mutants", protocol=protocol, packets=len(names)):
+                labels.update(label(round_dir, protocol))
+        for name in names:
+            shutil.move(os.path.join(round_dir, name), os.path.join(out, name))
+    with open(os.path.join(out, labels_file), "w") as f:
+        json.dump(labels, f)
+    return labels
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--protocol', type=str, help='Protocol to test [ipv4|ipv6|tcp|udp|icmp|vxlan|...]', required=True)
+    parser.add_argument('--seeds', type=str, help='packets.zip, or a test set directory whose POS packets are mutated', default='packets.zip')
+    parser.add_argument('--out', type=str, help='Test set to add the mutants to, the folder containing z3/', required=True)
+    parser.add_argument('--count', type=int, help='Number of distinct mutants to generate', default=10000)
+    parser.add_argument('--batch', type=int, help='Mutants per NumPy batch', default=4096)
+    parser.add_argument('--ops', type=str, help='Comma separated mutation operators', default=",".join(operators))
+    parser.add_argument('--max_flips', type=int, help='Maximum number of bits flipped by bitflip', default=8)
+    parser.add_argument('--seed', type=int, help='Random seed', required=False)
+    parser.add_argument('--no_label', action='store_true', help='Do not label the mutants with tshark', required=False)
+    parser.add_argument('--pack', action='store_true', help='Also store the test set as a packed corpus, see packed_corpus.py', required=False)
+    args = parser.parse_args()
+
+    seeds = read_seeds(args.seeds, args.protocol)
+    if not seeds:
+        print(f"No POS packets of {args.protocol} in {args.seeds}")
+        return 1
+    out = os.path.abspath(os.path.join(args.out, "z3"))
+    os.makedirs(out, exist_ok=True)
+    with open_corpus(out) as corpus:
+        existing = corpus.names()
+        seen = {corpus.sha256(name) for name in existing}
+    seen |= {hashlib.sha256(s).hexdigest() for s in seeds}
+    next_index = 1 + max([int(name.split(".")[1]) for name in existing if name.startswith("mutant.")], default=-1)
+
+    start = time.time()
+    with span("mutate", protocol=args.protocol, seeds=len(seeds)):
+        mutants = mutate(seeds, args.count, seen, args.batch, args.seed, args.ops.split(","), args.max_flips)
+    elapsed = time.time() - start
+    print(f"Generated {len(mutants)} mutants of {len(seeds)} seeds in {elapsed:.2f}s ({len(mutants) / max(elapsed, 1e-9):.0f}/s)")
+
+    start = time.time()
+    labels = add_mutants(out, args.protocol, mutants, next_index, not args.no_label)
+    elapsed = time.time() - start
+    print(f"Wrote{'' if args.no_label else ' and labelled'} {len(mutants)} mutants in {elapsed:.2f}s ({len(mutants) / max(elapsed, 1e-9):.0f}/s)")
+    if not args.no_label:
+        accepted = sum(1 for i in range(len(mutants)) if labels.get(f"mutant.{next_index + i}.NEG.{mutants[i][0]}.dat", [False])[0])
+        print(f"tshark accepts {accepted} and rejects {len(mutants) - accepted} of the mutants")
+
+    if args.pack:
+        count, size = pack(out)
+        print(f"Packed {count} packets ({size} bytes) into {out}.pack")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import mmap
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+"""
+Packed, memory-mapped packet corpora.
+
+A test set directory (e.g. tests/TCP/z3) holds thousands of tiny witness.N.POS|NEG.<module>.dat
+files and their labels (z3_packet_labels.json), and every consumer lists it and opens each file.
+A packed corpus stores the same directory as two files next to it:
+    <dir>.pack        -- the packets, concatenated
+    <dir>.pack.json   -- the index: name, offset, length, polarity, label and sha256 of every
+                         packet, plus the other (text) files of the directory, e.g. the labels
+                         of packets without .dat and the branch traces, and the size and sha256
+                         of the data file
+The data file is read through mmap, packets are zero-copy memoryview slices of it that must not
+outlive the corpus. The two files are replaced one after the other when a directory is packed again,
+so a corpus is only opened if the data file matches the size and sha256 in its index.
+
+open_corpus(dir) returns the packed corpus if it is at least as new as the directory (or the
+directory is gone), and the directory otherwise, with the same interface. check_packets,
+generate_pcap and witness generation (3dgen_tests.py) read test sets through it.
+
+    python packed_corpus.py pack tests/TCP/z3 [--remove]
+    python packed_corpus.py pack packets/tests --recursive
+    python packed_corpus.py unpack tests/TCP/z3
+    python packed_corpus.py ls tests/TCP/z3
+"""
+
+labels_file = "z3_packet_labels.json"
+pack_suffix = ".pack"
+index_suffix = ".pack.json"
+
+## (path, size, mtime) -> sha256 of a packet file, test sets don't change during a run.
+packet_hashes = {}
+
+
+def packet_hash(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in packet_hashes:
+        with open(path, "rb") as f:
+            packet_hashes[key] = hashlib.sha256(f.read()).hexdigest()
+    return packet_hashes[key]
+
+
+def polarity(name):
+    return "NEG" if ".NEG." in name else "POS"
+
+
+def scratch_dir():
+    ## Packets handed to tools that only read files are staged in memory where possible.
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+class DirCorpus:
+    """
+    A test set directory of .dat files
+    """
+    def __init__(self, dir):
+        self.dir = dir
+
+    def names(self):
+        return sorted(f for f in os.listdir(self.dir) if f.endswith(".dat"))
+
+    def read(self, name):
+        with open(os.path.join(self.dir, name), "rb") as f:
+            return f.read()
+
+    def sha256(self, name):
+        return packet_hash(os.path.join(self.dir, name))
+
+    def labels(self):
+        path = os.path.join(self.dir, labels_file)
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def stage(self, name, scratch):
+        """
+        Path of a file with the packet, for tools that read packets from files
+        """
+        return os.path.join(self.dir, name)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PackedCorpus(DirCorpus):
+    """
+    A packed test set, see pack()
+    """
+    def __init__(self, dir, attempts = 3):
+        self.dir = dir
+        for _ in range(attempts):
+            with open(dir + index_suffix, "r") as f:
+                index = json.load(f)
+            self.entries = {entry["name"]: entry for entry in index["packets"]}
+            self.files = index["files"]
+            self.file = open(dir + pack_suffix, "rb")
+            ## mmap can't map an empty file.
+            size = os.fstat(self.file.fileno()).st_size
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+            self.view = memoryview(self.map) if self.map is not None else memoryview(b"")
+            ## Indexes of version 1 don't describe the data file.
+            if "sha256" not in index or (size == index["size"] and hashlib.sha256(self.view).hexdigest() == index["sha256"]):
+                return
+            ## The index and the data file of different packs, pack() is replacing them.
+            self.close()
+            time.sleep(0.1)
+        raise ValueError(f"{dir + pack_suffix} doesn't match its index {dir + index_suffix}")
+
+    def names(self):
+        return sorted(self.entries)
+
+    def read(self, name):
+        """
+        The packet as a zero-copy memoryview of the map. It must not outlive the corpus, copy it (bytes()) to keep it.
+        """
+        entry = self.entries[name]
+        return self.view[entry["offset"]:entry["offset"] + entry["length"]]
+
+    def sha256(self, name):
+        return self.entries[name]["sha256"]
+
+    def labels(self):
+        return json.loads(self.files[labels_file]) if labels_file in self.files else {}
+
+    def stage(self, name, scratch):
+        path = os.path.join(scratch, name)
+        with open(path, "wb") as f:
+            f.write(self.read(name))
+        return path
+
+    def close(self):
+        ## Closing the map raises BufferError while a slice returned by read() is still referenced.
+        try:
+            self.view.release()
+            if self.map is not None:
+                self.map.close()
+        finally:
+            self.file.close()
+
+
+def packed_mtime(dir):
+    return min(os.path.getmtime(dir + pack_suffix), os.path.getmtime(dir + index_suffix))
+
+
+def dir_mtime(dir):
+    ## Adding or removing packets touches the directory, rewriting the labels only the labels file.
+    mtime = os.path.getmtime(dir)
+    if os.path.exists(os.path.join(dir, labels_file)):
+        mtime = max(mtime, os.path.getmtime(os.path.join(dir, labels_file)))
+    return mtime
+
+
+def is_packed(dir):
+    dir = dir.rstrip("/")
+    if not (os.path.exists(dir + pack_suffix) and os.path.exists(dir + index_suffix)):
+        return False
+    return not os.path.isdir(dir) or packed_mtime(dir) >= dir_mtime(dir)
+
+
+def open_corpus(dir):
+    dir = dir.rstrip("/")
+    return PackedCorpus(dir) if is_packed(dir) else DirCorpus(dir)
+
+
+def pack(dir, remove = False):
+    """
+    Pack the .dat files and the other text files (labels, traces) of dir into dir.pack and dir.pack.json
+    """
+    dir = dir.rstrip("/")
+    corpus = DirCorpus(dir)
+    labels = corpus.labels()
+    entries, files = [], {}
+    ## Written next to the targets and renamed, readers never see a partial file. The index describes the data
+    ## file, readers that find the index of one pack and the data of another in between the renames wait.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dir)), prefix=".tmp_")
+    digest = hashlib.sha256()
+    with os.fdopen(fd, "wb") as f:
+        offset = 0
+        for name in corpus.names():
+            data = corpus.read(name)
+            f.write(data)
+            digest.update(data)
+            entries.append({"name": name, "offset": offset, "length": len(data), "polarity": polarity(name),
+                            "label": labels.get(name), "sha256": hashlib.sha256(data).hexdigest()})
+            offset += len(data)
+    for name in sorted(os.listdir(dir)):
+        path = os.path.join(dir, name)
+        if name.endswith(".dat") or name.endswith(".pcap") or not os.path.isfile(path):
+            continue
+        try:
+            with open(path, "r") as f:
+                files[name] = f.read()
+        except UnicodeDecodeError:
+            print(f"Skipping binary file {path}")
+    index = {"version": 2, "size": offset, "sha256": digest.hexdigest(), "packets": entries, "files": files}
+    with open(tmp + ".json", "w") as f:
+        json.dump(index, f)
+    os.replace(tmp + ".json", dir + index_suffix)
+    os.replace(tmp, dir + pack_suffix)
+    if remove:
+        shutil.rmtree(dir)
+    return len(entries), offset
+
+
+def unpack(dir, out = None):
+    """
+    Write a packed corpus back to the directory layout (pcaps can be regenerated with generate_pcap)
+    """
+    dir = dir.rstrip("/")
+    out = out or dir
+    os.makedirs(out, exist_ok=True)
+    with PackedCorpus(dir) as corpus:
+        for name in corpus.names():
+            with open(os.path.join(out, name), "wb") as f:
+                f.write(corpus.read(name))
+        for name, text in corpus.files.items():
+            with open(os.path.join(out, name), "w") as f:
+                f.write(text)
+        return len(corpus.entries)
+
+
+def test_set_dirs(root):
+    for dir, _, files in sorted(os.walk(root)):
+        if any(f.endswith(".dat") for f in files):
+            yield dir
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['pack', 'unpack', 'ls'], help='pack: directory to packed corpus, unpack: packed corpus to directory, ls: list a corpus')
+    parser.add_argument('dir', type=str, help='Test set directory (without .pack), or the root of several with --recursive')
+    parser.add_argument('--out', type=str, help='Directory to unpack to, the original directory by default', required=False)
+    parser.add_argument('--recursive', action='store_true', help='Pack every directory with .dat files below dir', required=False)
+    parser.add_argument('--remove', action='store_true', help='Remove the directories after packing them', required=False)
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        for dir in (list(test_set_dirs(args.dir)) if args.recursive else [args.dir]):
+            count, size = pack(dir, args.remove)
+            print(f"Packed {count} packets ({size} bytes) of {dir} into {dir.rstrip('/')}{pack_suffix}")
+    elif args.command == 'unpack':
+        count = unpack(args.dir, args.out)
+        print(f"Unpacked {count} packets to {args.out or args.dir}")
+    else:
+        with open_corpus(args.dir) as corpus:
+            labels = corpus.labels()
+            print(f"{type(corpus).__name__} {args.dir}")
+            for name in corpus.names():
+                print(f"{name:<64}{len(corpus.read(name)):>8} {polarity(name)} {corpus.sha256(name)[:16]} {labels.get(name, [None])[0]}")
+
+
+if __name__ == "__main__":
+    main()
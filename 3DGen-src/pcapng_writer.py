@@ -0,0 +1,77 @@
+import struct
+
+"""
+Minimal streaming pcapng writer.
+
+Writes a single section with a single interface and one Enhanced Packet Block per packet,
+each carrying an opt_comment. This is all combine_dats_to_pcap.py needs to replace the
+text2pcap | editcap | mergecap pipeline. See https://www.ietf.org/archive/id/draft-ietf-opsawg-pcapng-01.html
+"""
+
+SHB_TYPE = 0x0A0D0D0A
+IDB_TYPE = 0x00000001
+EPB_TYPE = 0x00000006
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+OPT_ENDOFOPT = 0
+OPT_COMMENT = 1
+
+## Link types, see https://www.tcpdump.org/linktypes.html
+LINKTYPE_ETHERNET = 1
+LINKTYPE_WIRESHARK_UPPER_PDU = 252
+
+## Exported PDU tags, see wireshark's epan/exported_pdu.h
+EXP_PDU_TAG_END_OF_OPT = 0
+EXP_PDU_TAG_DISSECTOR_NAME = 12
+
+
+def pad4(data):
+    return data + b"\x00" * (-len(data) % 4)
+
+
+def option(code, value):
+    return struct.pack("<HH", code, len(value)) + pad4(value)
+
+
+def block(block_type, body):
+    length = 12 + len(body)
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+
+def exported_pdu(dissector, payload):
+    """
+    Prefix payload with the exported PDU header that makes tshark hand it to dissector,
+    the same header text2pcap -P <dissector> writes.
+    """
+    name = pad4(dissector.encode("ascii"))
+    ## The name is zero padded to a multiple of 4 bytes and the tag length includes the padding, Wireshark skips tag length bytes to the next tag.
+    return struct.pack(">HH", EXP_PDU_TAG_DISSECTOR_NAME, len(name)) + name + struct.pack(">HH", EXP_PDU_TAG_END_OF_OPT, 0) + payload
+
+
+class PcapngWriter:
+    """
+    Stream packets with comments into a pcapng file
+    """
+    def __init__(self, path, linktype, snaplen=262144):
+        self.file = open(path, "wb")
+        self.count = 0
+        self.file.write(block(SHB_TYPE, struct.pack("<IHHq", BYTE_ORDER_MAGIC, 1, 0, -1)))
+        self.file.write(block(IDB_TYPE, struct.pack("<HHI", linktype, 0, snaplen)))
+
+    def write(self, data, comment, timestamp_us=None):
+        if timestamp_us is None:
+            ## One packet per microsecond keeps the frames in write order.
+            timestamp_us = self.count
+        options = option(OPT_COMMENT, comment.encode("utf-8")) + option(OPT_ENDOFOPT, b"")
+        body = struct.pack("<IIIII", 0, timestamp_us >> 32, timestamp_us & 0xFFFFFFFF, len(data), len(data)) + pad4(data) + options
+        self.file.write(block(EPB_TYPE, body))
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
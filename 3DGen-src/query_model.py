@@ -1,37 +1,125 @@
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_random_exponential,
-)  
 from langchain.prompts import load_prompt
-from openai import AzureOpenAI
-from dotenv import load_dotenv
+import asyncio
 import os
+import re
+import llm_client
+from tracing import span
+
+clean_model = "gpt-4-32k"
+clean_system_prompt = "You are an expert at cleaning documents to remove unneeded information, while retaining the rest of the document."
+clean_user_prompt = "Given the following RFC, retain all infromation about the header/message specification, all ascii diagrams, and important constraints about fields in message headers. Drop things like the introduction and references. Leave the rest untouched, do not summarize or comment. \n\n {data}"
+
+def clean_messages(data):
+    return [{"role": "system", "content": clean_system_prompt},
+            {"role": "user", "content" : clean_user_prompt.format(data=data)}]
+
+def clean_text(data):
+    ## Waits for the endpoint's quota and retries rate limits and transient errors, see llm_client.py.
+    with span("clean_text", model=clean_model):
+        response = llm_client.default_client().chat(clean_model, clean_messages(data), temperature=0.0, n=1)
+    return response.choices[0].message.content
+
+async def aclean_text(data):
+    with span("clean_text", model=clean_model):
+        response = await llm_client.default_client().achat(clean_model, clean_messages(data), temperature=0.0, n=1)
+    return response.choices[0].message.content
 
-client = None
-
-def API_setup():
-    load_dotenv()
-    global client
-    client = AzureOpenAI(
-        api_key=os.getenv("OPENAI_API_KEY"),
-        azure_endpoint=os.getenv("OPENAI_API_BASE"),
-        api_version="2023-08-01-preview",
-    )
-    
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(100))
 def clean_RFC(data):
-    API_setup()
     print("Cleaning RFC...")
+    return clean_text(data)
+
+
+## A section heading starts at the first column, e.g. "3.1.  Header Format" or "Appendix A.  Examples". Its title starts with
+## a capital letter, unindented bit rulers ("0                   1", "0 1 2 3 4 5 6 7 8 9 0 1") are not headings.
+section_heading = re.compile(r"^(\d+(\.\d+)*\.?|Appendix [A-Z](\.\d+)*\.?)\s+[A-Z]")
+## Lines of ASCII header diagrams, e.g. "   +-+-+-+", "   |  Source Port  |" or the bit ruler "    0                   1".
+diagram_line = re.compile(r"^\s*([+|]|(\d\s*)+$)")
+
+def rfc_text(data):
+    if isinstance(data, str):
+        return data
+    return "\n\n".join(d.page_content if hasattr(d, "page_content") else str(d) for d in data)
+
+def split_RFC(text, max_chars = 24000):
+    """
+    Split an RFC into chunks of whole sections of at most max_chars characters. Sections longer than
+    max_chars are split at blank lines, but never inside or next to an ASCII diagram.
+    """
+    lines = text.splitlines()
+    sections = []
+    for line in lines:
+        if not sections or section_heading.match(line):
+            sections.append([])
+        sections[-1].append(line)
+
+    def split_points(section):
+        ## Blank lines whose neighboring non-blank lines are not part of a diagram.
+        points = []
+        for i, line in enumerate(section):
+            if line.strip():
+                continue
+            before = next((l for l in reversed(section[:i]) if l.strip()), "")
+            after = next((l for l in section[i+1:] if l.strip()), "")
+            if not diagram_line.match(before) and not diagram_line.match(after):
+                points.append(i)
+        return points
+
+    pieces = []
+    for section in sections:
+        if len("\n".join(section)) <= max_chars:
+            pieces.append(section)
+            continue
+        start = 0
+        last = None
+        for i in split_points(section) + [len(section)]:
+            size = len("\n".join(section[start:i]))
+            if size > max_chars and last is not None and last > start:
+                pieces.append(section[start:last])
+                start = last
+            last = i
+        pieces.append(section[start:])
+
+    chunks = []
+    for piece in pieces:
+        piece_text = "\n".join(piece)
+        if chunks and len(chunks[-1]) + len(piece_text) + 1 <= max_chars:
+            chunks[-1] += "\n" + piece_text
+        else:
+            chunks.append(piece_text)
+    return [c for c in chunks if c.strip()]
+
+def clean_RFC_stream(data, max_chars = 24000, workers = 8):
+    """
+    Clean the chunks of an RFC concurrently, at most workers at a time, over the shared async client. Yields (index, cleaned chunk) as chunks finish.
+    """
+    chunks = split_RFC(rfc_text(data), max_chars)
+    print(f"Cleaning RFC in {len(chunks)} chunks...")
+    loop = asyncio.new_event_loop()
+    semaphore = asyncio.Semaphore(workers)
+
+    async def clean(i, chunk):
+        async with semaphore:
+            return i, await aclean_text(chunk)
+
     try:
-        response = client.chat.completions.create(
-            model="gpt-4-32k",
-            messages=[{"role": "system", "content": "You are an expert at cleaning documents to remove unneeded information, while retaining the rest of the document."},
-                     {"role": "user", "content" : f"Given the following RFC, retain all infromation about the header/message specification, all ascii diagrams, and important constraints about fields in message headers. Drop things like the introduction and references. Leave the rest untouched, do not summarize or comment. \n\n {data}"}],
-            temperature=0.0,
-            n = 1
-        )
-    except Exception as e:
-        print(e)
-
-    return response.choices[0].message.content
\ No newline at end of file
+        pending = {loop.create_task(clean(i, chunk)) for i, chunk in enumerate(chunks)}
+        while pending:
+            done, pending = loop.run_until_complete(asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+def clean_RFC_chunked(data, max_chars = 24000, workers = 8):
+    """
+    Clean an RFC chunk by chunk and stitch the cleaned chunks back together in order.
+    """
+    cleaned = {}
+    for i, text in clean_RFC_stream(data, max_chars, workers):
+        print(f"Cleaned chunk {i+1} ({len(cleaned)+1} done)")
+        cleaned[i] = text
+    return "\n\n".join(cleaned[i] for i in sorted(cleaned))
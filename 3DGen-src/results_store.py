@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import sqlite3
+import argparse
+from logger import read_log, AttemptMetrics
+
+"""
+Indexed store of agent run results.
+
+multi_agent_collab.py records the counters and outcome events of every attempt (see
+logger.AttemptMetrics) in a SQLite database as the attempt finishes, so summaries are
+a query instead of a re-scan of the agent logs. Archived logs, e.g. from experiments.zip,
+are parsed once with `ingest` and can be queried like new runs afterwards.
+
+    python results_store.py ingest experiments/RFCs/TCP/*.jsonl
+    python results_store.py summary --protocol TCP
+"""
+
+schema = [
+    """
+    CREATE TABLE IF NOT EXISTS attempts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        protocol TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        attempt INTEGER NOT NULL,
+        success INTEGER NOT NULL,
+        syntax_refinements INTEGER NOT NULL,
+        packet_refinements INTEGER NOT NULL,
+        messages INTEGER NOT NULL,
+        spec_file TEXT,
+        params TEXT,
+        started REAL,
+        finished REAL,
+        UNIQUE (filename, attempt)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS attempts_protocol ON attempts (protocol)",
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        attempt_id INTEGER NOT NULL REFERENCES attempts (id),
+        n INTEGER,
+        event TEXT NOT NULL,
+        time REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS events_attempt ON events (attempt_id)",
+]
+
+
+def connect(db):
+    if os.path.dirname(db):
+        os.makedirs(os.path.dirname(db), exist_ok=True)
+    conn = sqlite3.connect(db, timeout=60)
+    conn.row_factory = sqlite3.Row
+    for statement in schema:
+        conn.execute(statement)
+    return conn
+
+
+def record(db, metrics, params = ""):
+    """
+    Store the results and events of an attempt. Returns False if the attempt was already recorded.
+    """
+    results = metrics.results()
+    conn = connect(db)
+    with conn:
+        cur = conn.execute("INSERT OR IGNORE INTO attempts (protocol, filename, attempt, success, syntax_refinements, packet_refinements, messages, spec_file, params, started, finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           (results["protocol"], results["filename"], results["attempt"], int(results["success"]), results["syntax_refinements"], results["packet_refinements"],
+                            results["messages"], results["spec_file"], params, results["started"], results["finished"]))
+        if cur.rowcount:
+            conn.executemany("INSERT INTO events (attempt_id, n, event, time) VALUES (?, ?, ?, ?)",
+                             [(cur.lastrowid, int(e["n"]) if e["n"] is not None else None, e["event"], e["time"]) for e in metrics.events])
+    conn.close()
+    return bool(cur.rowcount)
+
+
+def ingest(db, filename, protocol = None):
+    """
+    Parse an archived agent log once and record its attempts. An attempt starts with the task message (n == 1).
+    """
+    attempts = []
+    params = ""
+    for message in read_log(filename):
+        if "sender" not in message:
+            ## The results record written at the end of an attempt.
+            protocol = message.get("protocol", protocol)
+            params = message.get("params", params)
+            if attempts:
+                attempts[-1][0].protocol = protocol
+                attempts[-1][1] = params
+            continue
+        if message["n"] == "1" or not attempts:
+            attempts.append([AttemptMetrics(protocol, len(attempts), filename), params])
+        attempts[-1][0].update(message)
+
+    recorded = 0
+    for metrics, attempt_params in attempts:
+        if metrics.protocol is None:
+            ## Logs are named <proto>_<timestamp>.jsonl.
+            metrics.protocol = os.path.basename(filename).split("_")[0]
+        ## Timestamps are not recorded in archived logs.
+        metrics.started = None
+        recorded += record(db, metrics, attempt_params)
+    return len(attempts), recorded
+
+
+def summary(db, protocol = None):
+    conn = connect(db)
+    where, params = ("WHERE protocol = ?", (protocol,)) if protocol is not None else ("", ())
+    rows = conn.execute(f"""
+        SELECT protocol, COUNT(*) AS attempts, SUM(success) AS successes,
+               AVG(syntax_refinements) AS avg_syntax_refinements, AVG(packet_refinements) AS avg_packet_refinements
+        FROM attempts {where} GROUP BY protocol ORDER BY protocol""", params).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['ingest', 'summary'], help='ingest: record archived agent logs, summary: per protocol results')
+    parser.add_argument('logs', nargs='*', help='Agent logs (.jsonl) to ingest')
+    parser.add_argument('--db', type=str, help='/path/to/results database', default='experiments/results.db')
+    parser.add_argument('--protocol', type=str, help='Only this protocol', required=False)
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        for filename in args.logs:
+            found, recorded = ingest(args.db, filename, args.protocol)
+            print(f"{filename}: {found} attempts, {recorded} new")
+    else:
+        rows = summary(args.db, args.protocol)
+        print(f"{'protocol':<10}{'attempts':>10}{'successes':>10}{'syntax':>10}{'packet':>10}")
+        for row in rows:
+            print(f"{row['protocol']:<10}{row['attempts']:>10}{row['successes']:>10}{row['avg_syntax_refinements']:>10.1f}{row['avg_packet_refinements']:>10.1f}")
+
+if __name__ == "__main__":
+    main()
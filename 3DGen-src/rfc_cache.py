@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+"""
+Local cache of fetched and cleaned RFCs.
+
+Every agent run downloads its RFC with UnstructuredURLLoader and sends it to the model
+for cleaning, although neither changes between attempts or campaigns. This module keeps
+    <cache_dir>/raw/<sha256(url)>.json         -- the fetched documents of an RFC url
+    <cache_dir>/cleaned/<key>.json             -- the cleaned RFC text
+where the key of a cleaned RFC is the hash of the url, the hash of the fetched content, the
+cleaning prompts and the model. Changing the prompt or model therefore misses the cache
+instead of returning text cleaned differently.
+
+With offline=True the network is never touched: hits are served from the cache and misses
+raise an error.
+"""
+
+
+class RFCCacheMiss(Exception):
+    pass
+
+
+def sha256(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def write_json(path, obj):
+    ## Write to a temp file and rename, so concurrent runs never read a partial entry.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+    with os.fdopen(fd, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def fetch_rfc(url, cache_dir, offline = False, refresh = False):
+    """
+    Return the documents of the RFC at url and the hash of their content
+    """
+    from langchain_core.documents import Document
+    from agents.RFC_agent.query_RFC import get_context
+
+    path = os.path.join(cache_dir, "raw", f"{sha256(url)}.json")
+    entry = None if refresh else read_json(path)
+    if entry is None:
+        if offline:
+            raise RFCCacheMiss(f"RFC {url} is not in the cache at {cache_dir}")
+        docs = get_context(url)
+        entry = {
+            "url": url,
+            "fetched": time.time(),
+            "documents": [{"page_content": d.page_content, "metadata": d.metadata} for d in docs],
+            "content_hash": sha256(*[d.page_content for d in docs]),
+        }
+        write_json(path, entry)
+    else:
+        print(f"Using cached RFC {url}")
+
+    docs = [Document(page_content=d["page_content"], metadata=d["metadata"]) for d in entry["documents"]]
+    return docs, entry["content_hash"]
+
+
+def cleaned_rfc(url, cache_dir, offline = False, refresh = False, chunk_chars = 0):
+    """
+    Return the cleaned text of the RFC at url, fetching and cleaning it only on a cache miss.
+    With chunk_chars > 0 the RFC is cleaned in chunks of at most that many characters, see query_model.clean_RFC_chunked.
+    """
+    import query_model
+
+    docs, content_hash = fetch_rfc(url, cache_dir, offline, refresh)
+    key = sha256(url, content_hash, query_model.clean_system_prompt, query_model.clean_user_prompt, query_model.clean_model, f"chunks:{chunk_chars}")
+    path = os.path.join(cache_dir, "cleaned", f"{key}.json")
+    entry = None if refresh else read_json(path)
+    if entry is None:
+        if offline:
+            raise RFCCacheMiss(f"Cleaned RFC {url} ({query_model.clean_model}) is not in the cache at {cache_dir}")
+        text = query_model.clean_RFC_chunked(docs, chunk_chars) if chunk_chars > 0 else query_model.clean_RFC(docs)
+        entry = {"url": url, "content_hash": content_hash, "model": query_model.clean_model, "cleaned": time.time(), "text": text}
+        write_json(path, entry)
+    else:
+        print(f"Using cached cleaned RFC {url}")
+    return entry["text"]
@@ -1,8 +1,15 @@
 import os
 import subprocess
 from clean_response import   process_packet_results
+from batch_checker import check_dir, PacketChecker
+from compile_cache import CompileCache, everparse_version, spec_key, snapshot, changed_files
+from verdict_cache import VerdictCache
+from packed_corpus import open_corpus, scratch_dir
+from tracing import span
+from lint_3d import lint, format_diagnostics
 import json 
 import datetime
+import tempfile
 
 
 config = {}
@@ -40,26 +47,61 @@ def response_to_tmp(response, protocol, message_name):
 
 
 
-def check_packets(folder, exe_dir):
-    packet_dir = folder
-    z3_dir = os.path.join(packet_dir, "z3")
-    z3_dir = os.path.abspath(z3_dir)
-    dirs = [z3_dir]
+def packet_feedback(corpus, packet, feedback, packet_labels):
+    """
+    Feedback for the Developer agent about a packet that is unlabeled or whose label the spec contradicts
+    """
+    if packet not in packet_labels:
+        return f"No ground truth labels found for packet: {packet}. Please add ground truth labels for all packets in the test set"
 
-    packet_label_path = os.path.join(packet_dir, z3_dir, "z3_packet_labels.json")
-    packet_label_path = os.path.abspath(packet_label_path)
-    with open(packet_label_path, "r") as f:
-        packet_labels = json.load(f)
-    for dir in dirs:
+    packet_label = str(packet_labels[packet][0]).lower()
+    packet_status = "passes" if packet_label == 'true' else "fails"
+    packet_contents = bytes(corpus.read(packet))
+    if "packet malformed" in feedback:
+        feedback = "the packet is not a valid packet for this protocol"
+    
+    return f"The generated spec is incorrect. Please refer back to the RFC and modify the spec so that the packet {packet_status}. Error message: {feedback} for the following packet: \n  {packet_contents}. \n A hint about why this packet should {packet_status} :  {packet_labels[packet]}"
+
+
+def z3_corpus(folder):
+    """
+    The test set of folder: its z3 directory, or the packed corpus of it (see packed_corpus.py)
+    """
+    return open_corpus(os.path.abspath(os.path.join(folder, "z3")))
+
+
+def check_packets(folder, exe_dir, module_file=None, batch=True, spec=None, verdict_db=None):
+    """
+    Check the packets against the spec's validator until the first one whose verdict contradicts its label.
+    With a verdict_db (see verdict_cache.py) packets are checked recently and often failing first, and the
+    verdicts of a spec (its spec key) are memoized across rounds.
+    """
+    with z3_corpus(folder) as corpus:
+        packet_labels = corpus.labels()
+        dir = corpus.dir
         print('*'*50)
         print("Checking packets in: ", dir)
-        for packet in os.listdir(dir):
-            if packet.endswith(".dat"):
-                call = f"{exe_dir}/test.exe {dir}/{packet}"
-                print(call)
-                output = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                output_dump = output.stdout.read().decode("utf-8")
-                output_err = output.stderr.read().decode("utf-8")
+        packets = corpus.names()
+        cache, hashes, cached, fresh = None, {}, {}, {}
+        if verdict_db is not None:
+            cache = VerdictCache(verdict_db)
+            hashes = {packet: corpus.sha256(packet) for packet in packets}
+            packets = cache.order(packets, hashes)
+            if spec is not None:
+                cached = cache.get(spec, hashes.values())
+
+        ## Packets are validated one at a time in a single checker process (see batch_checker.py), so a broken spec stops at its first mismatch.
+        checked, failed = [], None
+        with span("check_dir", packets=len(packets), cached=len(cached)) as s, PacketChecker(exe_dir, module_file, batch) as checker, \
+                tempfile.TemporaryDirectory(dir=scratch_dir()) as scratch:
+            for packet in packets:
+                h = hashes.get(packet)
+                if h in cached:
+                    output_err, output_dump = cached[h]
+                else:
+                    output_err, output_dump = checker.check(corpus.stage(packet, scratch))
+                    fresh[h] = (output_err, output_dump)
+                checked.append(h)
                 feedback, result =  process_packet_results(output_err, output_dump)
     
 
@@ -73,24 +115,91 @@ def check_packets(folder, exe_dir):
                     
                     if packet_label == result_label:
                         print(f"Packet {packet} passes")
-
-                    else:
-                        packet_status = "passes" if packet_label == 'true' else "fails"
-                        with open(f"{dir}/{packet}", "rb") as f:
-                            packet_contents = f.read()
-                        if "packet malformed" in feedback:
-                            feedback = "the packet is not a valid packet for this protocol"
-                        
-                        return f"The generated spec is incorrect. Please refer back to the RFC and modify the spec so that the packet {packet_status}. Error message: {feedback} for the following packet: \n  {packet_contents}. \n A hint about why this packet should {packet_status} :  {packet_labels[packet]}"
-                    
+                        continue
                 else:
                     print("No ground truth labels found for packet: ", packet)
-                    return f"No ground truth labels found for packet: {packet}. Please add ground truth labels for all packets in the test set"
+                failed = (packet, feedback)
+                break
+            s.set("checked", len(checked))
+
+        if cache is not None:
+            if spec is not None:
+                cache.put(spec, fresh)
+            cache.record(checked, hashes[failed[0]] if failed is not None else None)
+            cache.close()
+        if failed is not None:
+            return packet_feedback(corpus, failed[0], failed[1], packet_labels)
             
         print(f"All packets in {dir} validated as expected")
         return "All packets accepted"
 
 
+def validate_packets(folder, exe_dir, module_file=None, workers=None, spec=None, verdict_db=None):
+    """
+    Validate every packet of the test set in parallel and report all mismatches instead of stopping at the first one.
+    Returns a report with the accepted/rejected confusion matrix (ground truth label -> spec verdict), the mismatching
+    and unlabeled packets, and the single-packet feedback string check_packets would have returned (given the same
+    verdict_db, for the same packet).
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with z3_corpus(folder) as corpus:
+        packet_labels = corpus.labels()
+        z3_dir = corpus.dir
+        packets = corpus.names()
+        cache, hashes, cached = None, {}, {}
+        if verdict_db is not None:
+            cache = VerdictCache(verdict_db)
+            hashes = {packet: corpus.sha256(packet) for packet in packets}
+            packets = cache.order(packets, hashes)
+            if spec is not None:
+                cached = cache.get(spec, hashes.values())
+        unchecked = [packet for packet in packets if hashes.get(packet) not in cached]
+        with span("check_dir", packets=len(unchecked), workers=workers), tempfile.TemporaryDirectory(dir=scratch_dir()) as scratch:
+            verdicts = check_dir(z3_dir, exe_dir, module_file, unchecked, workers, lambda packet: corpus.stage(packet, scratch)) if unchecked else {}
+        verdicts.update({packet: cached[hashes[packet]] for packet in packets if hashes.get(packet) in cached})
+
+        report = {
+            "confusion": {"accepted": {"accepted": 0, "rejected": 0}, "rejected": {"accepted": 0, "rejected": 0}},
+            "mismatches": [],
+            "unlabeled": [],
+            "feedback": "All packets accepted",
+        }
+        first = None
+        for packet in packets:
+            feedback, result = process_packet_results(*verdicts[packet])
+            result_label = str(result['accepted']).lower()
+            if packet not in packet_labels:
+                report["unlabeled"].append(packet)
+            else:
+                packet_label = str(packet_labels[packet][0]).lower()
+                expected = "accepted" if packet_label == 'true' else "rejected"
+                actual = "accepted" if result_label == 'true' else "rejected"
+                report["confusion"][expected][actual] += 1
+                if packet_label == result_label:
+                    continue
+                report["mismatches"].append({"packet": packet, "expected": expected, "actual": actual, "hint": packet_labels[packet]})
+            if first is None:
+                first = (packet, feedback)
+
+        if first is not None:
+            report["feedback"] = packet_feedback(corpus, first[0], first[1], packet_labels)
+    if cache is not None:
+        if spec is not None:
+            cache.put(spec, {hashes[packet]: verdicts[packet] for packet in unchecked})
+        cache.record(list(hashes.values()), hashes[first[0]] if first is not None else None)
+        cache.close()
+
+    confusion = report["confusion"]
+    print('*'*50)
+    print(f"Validated {len(packets)} packets in {z3_dir}")
+    print(f"{'label / spec':<16}{'accepted':>10}{'rejected':>10}")
+    for label in ["accepted", "rejected"]:
+        print(f"{label:<16}{confusion[label]['accepted']:>10}{confusion[label]['rejected']:>10}")
+    print(f"{len(report['mismatches'])} mismatches, {len(report['unlabeled'])} unlabeled packets")
+    return report
+
+
 def evaluate_code(code, module_name, protocol):
     setup()
     timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
@@ -101,26 +210,63 @@ def evaluate_code(code, module_name, protocol):
     with open(filename, "w") as f:
         f.write(code)
     
-    module = f"Tmp_{timestamp}.{module_name}"
-    call = f"bash {everparse_path} {filename} --test_checker {module} --odir ./everparse_files/{module_name}/"
-    output = subprocess.Popen(
-        call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    output_dump = output.stdout.read().decode("utf-8")
-    output_err = output.stderr.read().decode("utf-8")
+    odir = f"everparse_files/{module_name}"
+    module_file = f"Tmp_{timestamp}"
+    ## Specs breaking rules EverParse would reject anyway are reported without running it, see lint_3d.py.
+    warnings = []
+    if config.get("lint", True):
+        with span("lint", protocol=protocol, module=module_name):
+            errors, warnings = lint(code, module_name)
+        if errors:
+            print("Specification rejected by the 3D pre-checker")
+            return format_diagnostics(filename, errors, warnings), f"Processing files: {filename}\n3D pre-check failed, EverParse was not run"
+    ## Identical or whitespace-equivalent resubmissions are served from the compile cache, see compile_cache.py.
+    cache = None
+    spec = spec_key(code, module_name, everparse_version(everparse_path))
+    verdict_db = config.get("verdict_cache", "everparse_files/.cache/verdicts.db") or None
+    cache_dir = config.get("compile_cache", "everparse_files/.cache")
+    if cache_dir:
+        cache = CompileCache(cache_dir, config.get("compile_cache_max_mb", 1024) << 20)
+        key = spec
+    cached = cache.get(key, odir) if cache is not None else None
+
+    if cached is not None:
+        print("Specification found in the EverParse compile cache")
+        output_err, output_dump, module_file = cached
+    else:
+        before = snapshot(odir)
+        module = f"Tmp_{timestamp}.{module_name}"
+        call = f"bash {everparse_path} {filename} --test_checker {module} --odir ./everparse_files/{module_name}/"
+        with span("everparse", protocol=protocol, module=module_name):
+            output = subprocess.Popen(
+                call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            output_dump = output.stdout.read().decode("utf-8")
+            output_err = output.stderr.read().decode("utf-8")
+        if cache is not None:
+            cache.put(key, odir, changed_files(before, snapshot(odir)), output_err, output_dump, module_file)
 
     if "EverParse succeeded" in output_dump:
         print("Specification is syntactically valid... checking tests")
         output_err = ""
    
         if "none" not in test_path:
-            packet_result = check_packets(test_path, f"everparse_files/{module_name}/")      
+            with span("check_packets", protocol=protocol, module=module_name) as s:
+                if config.get("packet_workers") is not None:
+                    packet_result = validate_packets(test_path, f"everparse_files/{module_name}/", module_file, config["packet_workers"], spec, verdict_db)["feedback"]
+                else:
+                    packet_result = check_packets(test_path, f"everparse_files/{module_name}/", module_file, config.get("batch_checker", True), spec, verdict_db)
+                s.set("accepted", packet_result == "All packets accepted")
             output_dump = f"{packet_result} for file {filename}"
+            if packet_result != "All packets accepted" and warnings:
+                output_dump += "\n" + format_diagnostics(filename, [], warnings)
   
         
     elif "Error 168" in output_dump:
         output_dump = "Syntax error, type is a reserved keyword"
     else:
+        if warnings:
+            output_err += "\n" + format_diagnostics(filename, [], warnings)
         return output_err, output_dump
 
     return output_err, output_dump
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import atexit
+import argparse
+import threading
+import itertools
+import contextvars
+
+"""
+Per-stage tracing for the 3DGen pipeline.
+
+Stages are wrapped in nested, timed spans with attributes:
+
+    with span("everparse", protocol=protocol) as s:
+        ...
+        s.set("packets", n)
+
+Tracing is disabled unless enable() is called or TRACE_3DGEN is set to an output file. While
+disabled, span() returns a shared no-op span, so instrumented code pays for one global lookup.
+Child processes inherit TRACE_3DGEN and write their spans to <trace>.<pid>.json next to the trace
+of the process that enabled tracing. Traces are written at exit, as JSON (list of spans) or, if
+the file name ends in .trace.json, in Chrome trace-event format (chrome://tracing, Perfetto).
+
+    python tracing.py summary trace.json trace.*.json --top 10
+"""
+
+ENV_TRACE = "TRACE_3DGEN"
+ENV_TRACE_PID = "TRACE_3DGEN_PID"
+
+
+class NoSpan:
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+no_span = NoSpan()
+## The innermost open span. A context variable rather than a thread local: every asyncio task has its own
+## copy, so spans of concurrent tasks on one thread nest under the span that started the task, not under each other.
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.id = next(tracer.ids)
+        self.parent = None
+        self.start = None
+        self.end = None
+
+    def set(self, key, value):
+        self.attrs[key] = value
+
+    def __enter__(self):
+        parent = current_span.get()
+        self.parent = parent.id if parent is not None else None
+        self.token = current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.attrs["error"] = repr(exc)
+        current_span.reset(self.token)
+        self.tracer.finish(self)
+        return False
+
+
+class Tracer:
+    def __init__(self, path):
+        self.path = path
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.spans = []
+        ## perf_counter has an arbitrary origin, anchor it to the wall clock so traces of several processes line up.
+        self.origin = time.time() - time.perf_counter()
+
+    def finish(self, span):
+        record = {
+            "id": span.id,
+            "parent": span.parent,
+            "name": span.name,
+            "start": self.origin + span.start,
+            "duration": span.end - span.start,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "attrs": span.attrs,
+        }
+        with self.lock:
+            self.spans.append(record)
+
+    def write(self, path = None):
+        path = path or self.path
+        with self.lock:
+            spans = list(self.spans)
+        if path.endswith(".trace.json"):
+            data = {"traceEvents": chrome_events(spans), "displayTimeUnit": "ms"}
+        else:
+            data = spans
+        with open(path, "w") as f:
+            json.dump(data, f, default=str)
+
+
+tracer = None
+hooks = False
+
+
+def trace_path(path):
+    ## Processes that inherited tracing write next to the trace of the process that enabled it.
+    path = os.path.abspath(path)
+    if os.environ.get(ENV_TRACE_PID) in [None, str(os.getpid())]:
+        return path
+    suffix = ".trace.json" if path.endswith(".trace.json") else os.path.splitext(path)[1]
+    return f"{path[:len(path) - len(suffix)]}.{os.getpid()}{suffix}"
+
+
+def enable(path):
+    """
+    Record spans from now on and write them to path at exit
+    """
+    global tracer, hooks
+    if os.environ.get(ENV_TRACE) != os.path.abspath(path):
+        os.environ[ENV_TRACE] = os.path.abspath(path)
+        os.environ[ENV_TRACE_PID] = str(os.getpid())
+    tracer = Tracer(trace_path(path))
+    if not hooks:
+        hooks = True
+        atexit.register(write)
+        os.register_at_fork(after_in_child=after_fork)
+    return tracer
+
+
+def after_fork():
+    ## A forked child must not write (or rewrite) the spans of its parent.
+    global tracer
+    if tracer is not None:
+        tracer = Tracer(trace_path(os.environ[ENV_TRACE]))
+
+
+def write():
+    """
+    Write the trace now. Needed in processes that exit without running atexit handlers, e.g. multiprocessing workers.
+    """
+    if tracer is not None and tracer.spans:
+        tracer.write()
+
+
+def span(name, **attrs):
+    if tracer is None:
+        return no_span
+    return Span(tracer, name, attrs)
+
+
+def traced(name):
+    """
+    Decorator running the function in a span
+    """
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+
+## Trace events have no span ids, they are kept in the args so summaries of converted traces still know the nesting.
+id_arg, parent_arg = "span.id", "span.parent"
+
+
+def chrome_events(spans):
+    return [{
+        "name": s["name"],
+        "ph": "X",
+        "ts": s["start"] * 1e6,
+        "dur": s["duration"] * 1e6,
+        "pid": s["pid"],
+        "tid": s["tid"],
+        "args": {**s["attrs"], id_arg: s.get("id"), parent_arg: s.get("parent")},
+    } for s in spans]
+
+
+def load(path):
+    with open(path, "r") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        spans = []
+        for e in data["traceEvents"]:
+            if e.get("ph") != "X":
+                continue
+            attrs = dict(e.get("args", {}))
+            spans.append({"id": attrs.pop(id_arg, None), "parent": attrs.pop(parent_arg, None), "name": e["name"], "start": e["ts"] / 1e6,
+                          "duration": e["dur"] / 1e6, "pid": e["pid"], "tid": e["tid"], "attrs": attrs})
+        return spans
+    return data
+
+
+def summarize(spans):
+    """
+    Per stage count, total, mean and max duration, and self time (total minus the time spent in nested spans), slowest first
+    """
+    children = {}
+    for s in spans:
+        if s.get("parent") is not None:
+            key = (s["pid"], s["parent"])
+            children[key] = children.get(key, 0.0) + s["duration"]
+    stages = {}
+    for s in spans:
+        stage = stages.setdefault(s["name"], {"name": s["name"], "count": 0, "total": 0.0, "self": 0.0, "max": 0.0})
+        stage["count"] += 1
+        stage["total"] += s["duration"]
+        stage["self"] += s["duration"] - children.get((s["pid"], s.get("id")), 0.0)
+        stage["max"] = max(stage["max"], s["duration"])
+    for stage in stages.values():
+        stage["mean"] = stage["total"] / stage["count"]
+    return sorted(stages.values(), key=lambda stage: stage["total"], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['summary', 'chrome'], help='summary: slowest stages, chrome: convert traces to Chrome trace-event format')
+    parser.add_argument('traces', nargs='+', help='Trace files written by tracing.py')
+    parser.add_argument('--top', type=int, help='Number of stages to show', default=20)
+    parser.add_argument('--output', type=str, help='Output file (chrome)', default='trace.trace.json')
+    args = parser.parse_args()
+
+    spans = [s for path in args.traces for s in load(path)]
+    if args.command == 'chrome':
+        with open(args.output, "w") as f:
+            json.dump({"traceEvents": chrome_events(spans), "displayTimeUnit": "ms"}, f, default=str)
+        print(f"Wrote {len(spans)} spans to {args.output}")
+        return
+
+    print(f"{'stage':<32}{'count':>8}{'total s':>12}{'self s':>12}{'mean s':>12}{'max s':>12}")
+    for stage in summarize(spans)[:args.top]:
+        print(f"{stage['name']:<32}{stage['count']:>8}{stage['total']:>12.3f}{stage['self']:>12.3f}{stage['mean']:>12.3f}{stage['max']:>12.3f}")
+
+
+if os.environ.get(ENV_TRACE):
+    enable(os.environ[ENV_TRACE])
+
+if __name__ == "__main__":
+    main()
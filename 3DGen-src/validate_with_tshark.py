@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
 import os
+import json
 import tempfile
 import shutil
 import argparse
 import subprocess
 import pyshark
+from xml.etree import ElementTree
+from tracing import span
+from coverage_store import coverage_record, summarize, store
 
 
 class KeyDict(dict):
@@ -32,74 +36,195 @@ expert_info_color = {
 }
 
 
-def validate(pcap_file_path, protocol, debug = False, strict = False):
+tshark_prefs = {"dccp.check_checksum": "FALSE", "udp.check_checksum": "FALSE", "udp.ignore_ipv6_zero_checksum": "FALSE"}
 
-    ### Read the pcap file and print the icmp packet if any.
-    cap = pyshark.FileCapture(input_file=pcap_file_path, override_prefs={"dccp.check_checksum": "FALSE", "udp.check_checksum": "FALSE", "udp.ignore_ipv6_zero_checksum": "FALSE"})
-    ### Create a results json object with the packet name, whether it is valid or invalid, and the expert message if any.
-    retVal  = 0
-    results = {}
-    for packet in cap:
-        #print(packet)
 
-        frame = packet.frame_info.frame_comment if "frame_comment" in packet.frame_info.field_names else packet.number
-        if protocol in packet and (strict is False or "_WS.MALFORMED" not in packet) :
-            if len(packet[protocol].field_names) > 0 :
-                if "_ws_expert_severity" in packet[protocol].field_names :
-                    ## The protocol has been found and tshark set some ws_expert_severity. If it's less than 0x00800000, it's not an error.
-                    severity = int(packet[protocol]._ws_expert_severity)
-                    results[frame] = (severity < 0x00800000, wireshark_expert_info[severity][0], packet[protocol]._ws_expert_message, wireshark_expert_info[severity][1])
-                else :
-                    ## The protocol has been found and tshark set no ws_expert_severity. Looks like a legit packet.
-                    results[frame] = (True, "None", "", wireshark_expert_info[0][1])
+def packet_result(found, num_fields, severity, message):
+    """
+    Classify a packet given whether the expected protocol layer was found, how many fields tshark
+    dissected in it, and the (first) expert severity and message tshark set in that layer, if any.
+    """
+    if found :
+        if num_fields > 0 :
+            if severity is not None :
+                ## The protocol has been found and tshark set some ws_expert_severity. If it's less than 0x00800000, it's not an error.
+                return (severity < 0x00800000, wireshark_expert_info[severity][0], message, wireshark_expert_info[severity][1])
             else :
-                ## The protocol has been found but tshark found no fields.  This is fishy but not necessarily wrong.
-                results[frame] = (False, "Warning", "Expected protocol found in packet but protocol layer has zero fields", wireshark_expert_info[0x00600000][1])
+                ## The protocol has been found and tshark set no ws_expert_severity. Looks like a legit packet.
+                return (True, "None", "", wireshark_expert_info[0][1])
         else :
-            ## The expected protocol has not been found. The packet must be completely malformed.
-            results[frame] = (False, "Error", "Packet malformed to the point that the expected protocol is not found", wireshark_expert_info[0x00800000][1])
+            ## The protocol has been found but tshark found no fields.  This is fishy but not necessarily wrong.
+            return (False, "Warning", "Expected protocol found in packet but protocol layer has zero fields", wireshark_expert_info[0x00600000][1])
+    else :
+        ## The expected protocol has not been found. The packet must be completely malformed.
+        return (False, "Error", "Packet malformed to the point that the expected protocol is not found", wireshark_expert_info[0x00800000][1])
+
+
+def pyshark_packets(pcap_file_path, protocol, strict = False):
+    """
+    Yield (frame, result, packet) for every packet in the pcap file, dissected with pyshark.
+    """
+    cap = pyshark.FileCapture(input_file=pcap_file_path, override_prefs=tshark_prefs)
+    for packet in cap:
+        frame = packet.frame_info.frame_comment if "frame_comment" in packet.frame_info.field_names else packet.number
+        found = protocol in packet and (strict is False or "_WS.MALFORMED" not in packet)
+        num_fields = len(packet[protocol].field_names) if found else 0
+        severity, message = None, ""
+        if found and "_ws_expert_severity" in packet[protocol].field_names :
+            severity, message = int(packet[protocol]._ws_expert_severity), packet[protocol]._ws_expert_message
+        yield frame, packet_result(found, num_fields, severity, message), packet
+    cap.close()
 
-        out = results[frame]   
-        
-        retVal = max(retVal, 100 - out[3] if "NEG" in frame else out[3])
 
-        print(f'{expert_info_color[out[1]]}input: {frame}, proto: {protocol}, valid: {out[0]}, severity: {out[1]}, message: {out[2]}\033[0m')
-        if debug and out[0] == False:
-            print(id, packet)
+def tshark_packets(pcap_file_path, protocol, strict = False, env = None):
+    """
+    Yield (frame, result, packet) for every packet in the pcap file. Runs tshark once and parses its PDML
+    output as a stream, keeping only one packet in memory. The PDML is restricted (-j) to the frame,
+    the frame comment, the malformed marker and the expected protocol, whose fields carry the expert info.
+    env is the environment of tshark, e.g. to set GCOV_PREFIX per call instead of in os.environ.
+    """
+    call = ["tshark", "-r", pcap_file_path, "-T", "pdml", "-j", f"frame pkt_comment _ws.malformed {protocol}"]
+    for pref, value in tshark_prefs.items():
+        call += ["-o", f"{pref}:{value}"]
+    sp = subprocess.Popen(call, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+
+    root = None
+    number = 0
+    for event, elem in ElementTree.iterparse(sp.stdout, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            continue
+        if elem.tag != "packet":
+            continue
+
+        number += 1
+        protos = elem.findall("proto")
+        comment = next((f.get("show") for f in elem.iter("field") if f.get("name") == "frame.comment"), None)
+        frame = comment if comment is not None else str(number)
+
+        ## Like pyshark, the first layer with the protocol's name is the protocol layer.
+        layer = next((p for p in protos if p.get("name") == protocol), None)
+        malformed = any(p.get("name") == "_ws.malformed" for p in protos)
+        found = layer is not None and (strict is False or not malformed)
+        num_fields = 0
+        severity, message = None, ""
+        if found:
+            fields = list(layer.iter("field"))
+            num_fields = len(fields)
+            severity_field = next((f for f in fields if f.get("name") == "_ws.expert.severity"), None)
+            if severity_field is not None:
+                severity = int(severity_field.get("show"), 0)
+                message = next((f.get("show") for f in fields if f.get("name") == "_ws.expert.message"), "")
+        packet = {"number": number, "comment": comment, "layers": [p.get("name") for p in protos]}
+        yield frame, packet_result(found, num_fields, severity, message), packet
+
+        ## Drop the packet we are done with to keep the memory constant.
+        root.clear()
+
+    sp.stdout.close()
+    if sp.wait() != 0:
+        raise Exception(f'Subprocess {" ".join(call)} failed with error code: {sp.returncode}')
+
+
+def validate(pcap_file_path, protocol, debug = False, strict = False, backend = "tshark"):
+
+    ### Read the pcap file and create a results json object with the packet name, whether it is valid or invalid, and the expert message if any.
+    ### The tshark backend streams tshark's output, the pyshark backend builds a pyshark packet object per packet.
+    packets = tshark_packets if backend == "tshark" else pyshark_packets
+    retVal  = 0
+    results = {}
+    with span("validate", protocol=protocol, backend=backend) as s:
+        for frame, out, packet in packets(pcap_file_path, protocol, strict):
+            results[frame] = out
+            
+            retVal = max(retVal, 100 - out[3] if "NEG" in frame else out[3])
+
+            print(f'{expert_info_color[out[1]]}input: {frame}, proto: {protocol}, valid: {out[0]}, severity: {out[1]}, message: {out[2]}\033[0m')
+            if debug and out[0] == False:
+                print(frame, packet)
+        s.set("packets", len(results))
     
-    cap.close()
     return results, retVal
 
 
 ## some dissector have non-matching names such as nbns (https://github.com/wireshark/wireshark/commit/c200f1e90bf75d5f15046d97657dafd4127ad278)
 dissector_alias = KeyDict({'nbns': "nbt"})
 
-def validate_and_coverage(pcap_file_path, protocol, debug = False, strict = False):
+## Where the gcov instrumented wireshark/tshark installation keeps the dissector sources and objects, and where
+## tshark writes the *.gcda files below GCOV_PREFIX (with GCOV_PREFIX_STRIP 7).
+wireshark_dir = "/usr/include/wireshark"
+gcov_obj_dir = "epan/dissectors/CMakeFiles/dissectors.dir"
+
+def gcov_json(gcda_root, dissector):
+    """
+    Run gcov (with branch counts) on the coverage data tshark wrote below gcda_root for packet-<dissector>.c
+    and return gcov's JSON record of that file: {"file", "functions": [...], "lines": [{"line_number", "count", "branches"}, ...]}
+    """
+    obj_dir = os.path.join(gcda_root, gcov_obj_dir)
+    os.makedirs(obj_dir, exist_ok=True)
+    shutil.copy2(f"{wireshark_dir}/epan/dissectors/packet-{dissector}.c.o", obj_dir)
+    shutil.copy2(f"{wireshark_dir}/epan/dissectors/packet-{dissector}.c.gcno", obj_dir)
+    call = ["gcov", "-b", "--json-format", "--stdout", "-o", f"{obj_dir}/packet-{dissector}.c.o", f"{wireshark_dir}/epan/dissectors/packet-{dissector}.c"]
+    sp = subprocess.Popen(call, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=gcda_root)
+    out, err = sp.communicate()
+    if sp.returncode != 0:
+        raise Exception(f'Subprocess {" ".join(call)} failed with error code: {sp.returncode} and error message: {err.decode("utf-8")}')
+    for line in out.decode("utf-8").splitlines():
+        for record in json.loads(line)["files"]:
+            if os.path.basename(record["file"]) == f"packet-{dissector}.c":
+                return record
+    return {"file": f"packet-{dissector}.c", "functions": [], "lines": []}
+
+def dissector_coverage(pcap_file_path, protocol, strict = False):
+    """
+    Coverage record (see coverage_store.py) of the dissector on the packets of the pcap file. Every call gets its own
+    GCOV_PREFIX, so pcaps can be measured concurrently.
+    """
+    protocol = proto_alias[protocol.lower()]
+    dissector = dissector_alias[protocol]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = dict(os.environ, GCOV_PREFIX=temp_dir, GCOV_PREFIX_STRIP='7')
+        for _ in tshark_packets(pcap_file_path, protocol, strict, env=env):
+            pass
+        with span("gcov", protocol=protocol):
+            return coverage_record(gcov_json(temp_dir, dissector), dissector)
+
+def validate_and_coverage(pcap_file_path, protocol, debug = False, strict = False, backend = "tshark", coverage_db = None, campaign = None):
+    """
+    Validate the pcap file and measure the dissector coverage of its packets. The coverage record is
+    stored as a run in coverage_db (see coverage_store.py), if given.
+    """
     protocol = proto_alias[protocol.lower()]
+    dissector = dissector_alias[protocol]
 
     with tempfile.TemporaryDirectory() as temp_dir:
         ## Make sure tshark writes gcov's (coverage) *.gcda files to temp_dir.
         os.environ['GCOV_PREFIX'] = temp_dir
         os.environ['GCOV_PREFIX_STRIP'] = '7'
 
-        results, retVal = validate(pcap_file_path, protocol, debug, strict)
+        results, retVal = validate(pcap_file_path, protocol, debug, strict, backend)
+
+        failed = False
+        with span("gcov", protocol=protocol):
+            try:
+                record = coverage_record(gcov_json(temp_dir, dissector), dissector)
+            except Exception as e:
+                ## Coverage is a by-product, a missing .gcno/.o or a gcov error must not cost the caller the labels.
+                print(f"Coverage of packet-{dissector}.c failed: {e}")
+                record = coverage_record({}, dissector)
+                failed = True
+
+    s = summarize(record)
+    print(f"File 'packet-{dissector}.c'")
+    print(f"Lines executed:{100.0 * s['lines_covered'] / max(s['lines'], 1):.2f}% of {s['lines']}, "
+          f"branches taken:{100.0 * s['branches_covered'] / max(s['branches'], 1):.2f}% of {s['branches']}, "
+          f"functions called:{s['functions_covered']} of {s['functions']}")
+    if coverage_db is not None and not failed:
+        run_id = store(coverage_db, record, protocol, os.path.abspath(pcap_file_path), campaign)
+        print(f"Coverage stored as run {run_id} in {coverage_db}")
 
-        dissector = dissector_alias[protocol]
-
-        ## Copy .gcno and .o files from the wireshark/tshark installation to temp_dir for gcov to find them.
-        shutil.copy2(f"/usr/include/wireshark/epan/dissectors/packet-{dissector}.c.o", temp_dir + f"/epan/dissectors/CMakeFiles/dissectors.dir/")
-        shutil.copy2(f"/usr/include/wireshark/epan/dissectors/packet-{dissector}.c.gcno", temp_dir + f"/epan/dissectors/CMakeFiles/dissectors.dir/")
-        
-        ## With everything in place, create the gcov report.
-        call = f"gcov -o {temp_dir}/epan/dissectors/CMakeFiles/dissectors.dir/packet-{dissector}.c.o /usr/include/wireshark/epan/dissectors/packet-{dissector}.c -f | grep -A1 \"packet-{dissector}.c'\""
-        sp = subprocess.Popen(call, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=temp_dir)
-        out, err = sp.communicate()
-        if err:
-            print(err.decode("utf-8"))
-        if out:
-            print(out.decode("utf-8"))
-
-        return results, retVal
+    return results, retVal
 
 
 def main():
@@ -108,9 +233,12 @@ def main():
     parser.add_argument('--input', type=str, help='/absolute/or/relative/path/to/folder/with/.dat files', required=True)
     parser.add_argument('--debug', action='store_true', help='Print layers', required=False)
     parser.add_argument('--strict', action='store_true', help='Cross-layer validation', required=False)
+    parser.add_argument('--backend', type=str, choices=['tshark', 'pyshark'], default='tshark', help='Stream tshark output or dissect with pyshark', required=False)
+    parser.add_argument('--coverage_db', type=str, help='Store the coverage of this run in /path/to/coverage database, see coverage_store.py', required=False)
+    parser.add_argument('--campaign', type=str, help='Campaign to record the coverage run under', required=False)
     args = parser.parse_args()
 
-    _, retVal = validate_and_coverage(args.input, args.protocol, args.debug, args.strict)
+    _, retVal = validate_and_coverage(args.input, args.protocol, args.debug, args.strict, args.backend, args.coverage_db, args.campaign)
     return retVal
 
 if __name__ == "__main__":
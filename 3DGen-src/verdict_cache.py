@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import sqlite3
+import argparse
+
+"""
+Memoized packet verdicts and fail-fast packet ordering across refinement rounds.
+
+check_packets validates the test set against every spec the Developer submits and reports the
+first packet whose verdict contradicts its label. Between rounds the spec often comes back
+unchanged (or changed only in whitespace), and a spec that is still broken usually fails on a
+packet that failed before. This store keeps, in a SQLite database shared by concurrent attempts,
+    verdicts  -- (output_err, output_dump) of a packet, keyed by the spec key (see
+                 compile_cache.spec_key) and the content hash of the packet,
+    packets   -- per packet content hash: how often it was checked, how often its verdict
+                 contradicted its label, and when that last happened.
+order() puts the packets that failed most recently first, then the ones that failed most often,
+so a broken spec is caught by one of the first checks. The feedback to the Developer is unchanged:
+the first mismatch in check order, or "All packets accepted".
+
+    python verdict_cache.py stats --db everparse_files/.cache/verdicts.db
+"""
+
+schema = [
+    """
+    CREATE TABLE IF NOT EXISTS verdicts (
+        spec TEXT NOT NULL,
+        packet TEXT NOT NULL,
+        output_err TEXT NOT NULL,
+        output_dump TEXT NOT NULL,
+        PRIMARY KEY (spec, packet)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS packets (
+        packet TEXT PRIMARY KEY,
+        checks INTEGER NOT NULL DEFAULT 0,
+        mismatches INTEGER NOT NULL DEFAULT 0,
+        last_mismatch REAL
+    )
+    """,
+]
+
+class VerdictCache:
+    def __init__(self, db):
+        if os.path.dirname(db):
+            os.makedirs(os.path.dirname(db), exist_ok=True)
+        self.conn = sqlite3.connect(db, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        for statement in schema:
+            self.conn.execute(statement)
+        self.hits = 0
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, spec, hashes):
+        """
+        {packet hash: (output_err, output_dump)} of the packets already checked against the spec
+        """
+        verdicts = {}
+        hashes = list(hashes)
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            rows = self.conn.execute(f"SELECT packet, output_err, output_dump FROM verdicts WHERE spec = ? AND packet IN ({', '.join('?' * len(chunk))})", [spec] + chunk)
+            verdicts.update({row["packet"]: (row["output_err"], row["output_dump"]) for row in rows})
+        self.hits += len(verdicts)
+        return verdicts
+
+    def put(self, spec, verdicts):
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO verdicts (spec, packet, output_err, output_dump) VALUES (?, ?, ?, ?)",
+                                  [(spec, packet, err, dump) for packet, (err, dump) in verdicts.items()])
+
+    def order(self, packets, hashes):
+        """
+        packets (names) in check order: recently failing first, then often failing, then by name
+        """
+        stats = {}
+        unique = list(set(hashes.values()))
+        for i in range(0, len(unique), 500):
+            chunk = unique[i:i + 500]
+            for row in self.conn.execute(f"SELECT * FROM packets WHERE packet IN ({', '.join('?' * len(chunk))})", chunk):
+                stats[row["packet"]] = row
+
+        def key(packet):
+            row = stats.get(hashes[packet])
+            if row is None:
+                return (0, 0.0, packet)
+            return (-(row["last_mismatch"] or 0), -row["mismatches"] / (row["checks"] + 1), packet)
+        return sorted(packets, key=key)
+
+    def record(self, checked, mismatch = None):
+        """
+        Count the checks of the packet hashes in checked, and the mismatch (a packet hash) if the spec failed on one
+        """
+        with self.conn:
+            self.conn.executemany("INSERT INTO packets (packet, checks) VALUES (?, 1) ON CONFLICT (packet) DO UPDATE SET checks = checks + 1", [(h,) for h in checked])
+            if mismatch is not None:
+                self.conn.execute("UPDATE packets SET mismatches = mismatches + 1, last_mismatch = ? WHERE packet = ?", (time.time(), mismatch))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['stats', 'clear'], help='stats: cached verdicts and the packets failing most, clear: drop all verdicts and statistics')
+    parser.add_argument('--db', type=str, help='/path/to/verdict database', default='everparse_files/.cache/verdicts.db')
+    parser.add_argument('--top', type=int, help='Number of packets to show', default=10)
+    args = parser.parse_args()
+
+    with VerdictCache(args.db) as cache:
+        if args.command == 'clear':
+            with cache.conn:
+                cache.conn.execute("DELETE FROM verdicts")
+                cache.conn.execute("DELETE FROM packets")
+            print(f"Cleared {args.db}")
+            return
+        specs, verdicts = cache.conn.execute("SELECT COUNT(DISTINCT spec), COUNT(*) FROM verdicts").fetchone()
+        print(f"{verdicts} verdicts of {specs} specs")
+        for row in cache.conn.execute("SELECT * FROM packets ORDER BY mismatches DESC, last_mismatch DESC LIMIT ?", (args.top,)):
+            print(f"{row['packet'][:16]}  checks {row['checks']:<8}mismatches {row['mismatches']:<8}last {time.ctime(row['last_mismatch']) if row['last_mismatch'] else '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from tracing import span
+
+"""
+Parallel branch-trace enumeration and witness generation with Z3.
+
+EverParse's 3DTestGen (3d.exe --z3_test) encodes the parser of the entrypoint in SMT2 and walks
+the branch traces up to --z3_branch_depth depth first, asking Z3 for --z3_witnesses positive and
+negative witnesses at every trace prefix, one query after another (see test1.smt2 and the README).
+Every trace prefix is an independent `branch-trace` assertion, so this module splits the trace
+tree at a shallow split depth and hands the subtrees to a pool of Z3 processes. Each worker
+solves its subtrees incrementally with push/pop, exactly like 3DTestGen does for the whole tree.
+
+The parser encoding is read from a transcript saved with `3d.exe ... --save_z3_transcript <file>`:
+everything in front of the first (push) is the encoding, the commands up to the second (push)
+define state-witness. Witnesses are written as witness.<i>.<POS|NEG>.<module>.dat, the layout
+3dgen_tests.z3_gen and test_utils.check_packets expect.
+
+    python z3_testgen.py --smt2 test1.smt2 --depth 2 --witnesses 3 --workers 8 --out tests/z3 --module TestMessageValidateMessage
+"""
+
+## Trace prefix of every witness, {witness file: "0.1"}.
+traces_file = "witness_traces.json"
+
+## Outcome of the validator on positive (consume all input) and negative (genuinely fail) witnesses.
+polarities = {
+    "POS": "(assert (= (input-size state-witness) 0))",
+    "NEG": "(assert (= state-witness-input-size -1))",
+}
+
+
+def load_encoding(smt2_file):
+    """
+    Split a 3DTestGen transcript into the parser encoding and the state-witness definitions
+    """
+    ## The responses of Z3 are recorded in the transcript as comments.
+    with open(smt2_file, "r") as f:
+        lines = [line for line in f.read().splitlines() if not line.lstrip().startswith(";")]
+    pushes = [i for i, line in enumerate(lines) if line.strip() == "(push)"]
+    if len(pushes) < 2 or "state-witness" not in "\n".join(lines[pushes[0]:pushes[1]]):
+        raise Exception(f"{smt2_file} is not a transcript of 3d.exe --z3_test --save_z3_transcript")
+    return "\n".join(lines[:pushes[0]]), "\n".join(lines[pushes[0] + 1:pushes[1]])
+
+
+class Z3:
+    """
+    Incremental Z3 process driven with SMT-LIB2 commands over stdin/stdout
+    """
+    def __init__(self, encoding, state_witness, z3 = "z3"):
+        self.proc = subprocess.Popen([z3, "-in", "-smt2"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+        self.queries = 0
+        self.send(encoding)
+        self.send("(push)")
+        self.send(state_witness)
+        self.sync()
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.write("(exit)\n")
+                self.proc.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+            self.proc.wait()
+            self.proc = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, command):
+        self.proc.stdin.write(command + "\n")
+        self.proc.stdin.flush()
+
+    def read(self):
+        line = self.proc.stdout.readline()
+        if not line:
+            raise Exception(f"Z3 exited with error code: {self.proc.wait()}")
+        line = line.strip()
+        if line.startswith("(error"):
+            raise Exception(f"Z3 {line}")
+        return line
+
+    def sync(self):
+        ## Commands without a response only report errors, echo a marker to know they all went through.
+        self.send('(echo "ready")')
+        while self.read() != "ready":
+            pass
+
+    def push(self):
+        self.send("(push)")
+
+    def pop(self):
+        self.send("(pop)")
+
+    def check(self, *assertions):
+        for assertion in assertions:
+            self.send(assertion)
+        self.send("(check-sat)")
+        self.queries += 1
+        return self.read() == "sat"
+
+    def witness(self):
+        """
+        Bytes of the current model, the input consumed by the validator
+        """
+        self.send("(get-value (state-witness-size))")
+        size = int(re.search(r"state-witness-size\s+(\d+)", self.read()).group(1))
+        data = []
+        for i in range(size):
+            self.send(f"(eval (choose {i}))")
+            data.append(int(self.read()))
+        data = bytes(data)
+        ## Ask for a different witness next time, like 3DTestGen does.
+        self.block(data)
+        return data
+
+    def block(self, data):
+        block = " ".join(f"(= (choose {i}) {b})" for i, b in enumerate(data))
+        self.send(f"(assert (not (and {block} (= (choice-index state-witness) {len(data)}))))")
+
+
+def assert_branch(z3, index, choice):
+    ## Take at least index + 1 branches, the branch at index being choice.
+    z3.send(f"(assert (> (branch-index state-witness) {index}))")
+    z3.send(f"(assert (= (branch-trace {index}) {choice}))")
+
+
+def assert_prefix(z3, prefix):
+    for index, choice in enumerate(prefix):
+        assert_branch(z3, index, choice)
+
+
+def children(z3, prefix):
+    """
+    Branches that can be taken after the trace prefix, which must be asserted already
+    """
+    choices = []
+    z3.push()
+    if z3.check(f"(assert (> (branch-index state-witness) {len(prefix)}))"):
+        choice = 0
+        while True:
+            z3.push()
+            feasible = z3.check(f"(assert (= (branch-trace {len(prefix)}) {choice}))")
+            if feasible:
+                ## The branch must lead to an outcome of the validator, success or failure.
+                z3.push()
+                feasible = z3.check("(assert (or (= state-witness-input-size -1) (= state-witness-input-size 0)))")
+                z3.pop()
+            z3.pop()
+            if not feasible:
+                break
+            choices.append(choice)
+            choice += 1
+    z3.pop()
+    return choices
+
+
+def trace_tree(z3, prefix, depth):
+    """
+    Branch traces below the asserted prefix up to depth, as {choice: subtree}
+    """
+    tree = {}
+    if len(prefix) >= depth:
+        return tree
+    for choice in children(z3, prefix):
+        z3.push()
+        assert_branch(z3, len(prefix), choice)
+        tree[choice] = trace_tree(z3, prefix + [choice], depth)
+        z3.pop()
+    return tree
+
+
+def generate(z3, prefix, tree, witnesses, deadline = None):
+    """
+    Generate witnesses at the asserted prefix and, depth first, at every trace in tree.
+    Returns (trace prefix, witness) pairs, the trace prefix written as e.g. "0.1".
+    """
+    found = []
+    for _ in range(witnesses):
+        if (deadline is not None and time.time() > deadline) or not z3.check():
+            break
+        found.append((".".join(map(str, prefix)), z3.witness()))
+    for choice, subtree in tree.items():
+        z3.push()
+        assert_branch(z3, len(prefix), choice)
+        found += generate(z3, prefix + [choice], subtree, witnesses, deadline)
+        z3.pop()
+    return found
+
+
+def split(encoding, state_witness, depth, witnesses, min_units, deadline = None, z3_path = "z3"):
+    """
+    Expand the trace tree breadth first until there are at least min_units prefixes or depth is reached.
+    The witnesses of the expanded (shallow) prefixes are generated here. Returns them, and the work units
+    (prefix, ancestor witnesses): each unit generates the witnesses of its whole subtree, excluding the
+    witnesses of its ancestors, like 3DTestGen's depth first walk does.
+    """
+    found = []
+    ancestors = {(): {polarity: [] for polarity in polarities}}
+    frontier = [[]]
+    with Z3(encoding, state_witness, z3_path) as z3:
+        while len(frontier) < min_units and frontier and len(frontier[0]) < depth:
+            next_frontier = []
+            for prefix in frontier:
+                z3.push()
+                assert_prefix(z3, prefix)
+                node = {}
+                for polarity, assertion in polarities.items():
+                    z3.push()
+                    z3.send(assertion)
+                    for _, data in ancestors[tuple(prefix)][polarity]:
+                        z3.block(data)
+                    node[polarity] = generate(z3, prefix, {}, witnesses, deadline)
+                    z3.pop()
+                found.append(node)
+                for choice in children(z3, prefix):
+                    ancestors[tuple(prefix + [choice])] = {polarity: ancestors[tuple(prefix)][polarity] + node[polarity] for polarity in polarities}
+                    next_frontier.append(prefix + [choice])
+                z3.pop()
+            frontier = next_frontier
+    return found, [(prefix, ancestors[tuple(prefix)]) for prefix in frontier]
+
+
+def run_unit(encoding, state_witness, prefix, blocked, depth, witnesses, deadline = None, z3_path = "z3"):
+    """
+    Generate the POS and NEG witnesses of the subtree below prefix in its own Z3 process
+    """
+    with span("z3_unit", prefix=".".join(map(str, prefix))) as s, Z3(encoding, state_witness, z3_path) as z3:
+        assert_prefix(z3, prefix)
+        tree = trace_tree(z3, prefix, depth)
+        found = {}
+        for polarity, assertion in polarities.items():
+            z3.push()
+            z3.send(assertion)
+            for _, data in blocked[polarity]:
+                z3.block(data)
+            found[polarity] = generate(z3, prefix, tree, witnesses, deadline)
+            z3.pop()
+        s.set("queries", z3.queries)
+    return found
+
+
+def witness_module(entrypoint):
+    """
+    Module part of 3DTestGen's witness file names, e.g. Tmp_20240318220419._ARP_HEADER -> Tmp20240318220419ValidateArpHeader
+    """
+    module, _, type_name = entrypoint.rpartition(".")
+    return module.replace("_", "") + "Validate" + "".join(part.capitalize() for part in type_name.split("_"))
+
+
+def write_witnesses(results, out, module, start = 0):
+    """
+    Write the witnesses of all units, POS first like 3DTestGen, dropping byte-identical duplicates
+    found in different subtrees. The trace prefix of every witness is recorded in witness_traces.json.
+    Returns the number of POS and NEG witnesses written.
+    """
+    if not os.path.exists(out):
+        os.makedirs(out)
+    seen = set()
+    counts = {}
+    traces = {}
+    index = start
+    for polarity in polarities:
+        counts[polarity] = 0
+        for found in results:
+            for trace, data in found[polarity]:
+                digest = hashlib.sha256(data).hexdigest()
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                name = f"witness.{index}.{polarity}.{module}.dat"
+                with open(os.path.join(out, name), "wb") as f:
+                    f.write(data)
+                traces[name] = trace
+                index += 1
+                counts[polarity] += 1
+    with open(os.path.join(out, traces_file), "w") as f:
+        json.dump(traces, f)
+    return counts
+
+
+def generate_witnesses(smt2_file, out, module, depth, witnesses, workers = None, split_units = None, timeout = None, z3_path = "z3"):
+    """
+    Generate the witnesses of the parser encoded in smt2_file into out. Returns the POS/NEG counts and
+    whether generation finished within timeout seconds.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    deadline = time.time() + timeout if timeout is not None else None
+    encoding, state_witness = load_encoding(smt2_file)
+
+    with span("z3_testgen", depth=depth, witnesses=witnesses, workers=workers) as s:
+        ## Several units per worker, subtrees differ in size a lot.
+        results, units = split(encoding, state_witness, depth, witnesses, split_units or 4 * workers, deadline, z3_path)
+        print(f"Generating witnesses for {len(units)} trace prefixes on {workers} Z3 processes")
+        with ThreadPoolExecutor(workers) as pool:
+            results += pool.map(lambda unit: run_unit(encoding, state_witness, unit[0], unit[1], depth, witnesses, deadline, z3_path), units)
+        counts = write_witnesses(results, out, module)
+        s.set("units", len(units))
+        s.set("witnesses", sum(counts.values()))
+
+    finished = deadline is None or time.time() <= deadline
+    print(f"Wrote {counts['POS']} POS and {counts['NEG']} NEG witnesses to {out}")
+    return counts, finished
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--smt2', type=str, help='Transcript saved with 3d.exe --z3_test ... --save_z3_transcript', required=True)
+    parser.add_argument('--out', type=str, help='Output directory of the .dat witnesses', required=True)
+    parser.add_argument('--module', type=str, help='Module part of the witness file names, e.g. Tmp20240318220419ValidateArpHeader', required=False, default="Witness")
+    parser.add_argument('--depth', type=int, help='Z3 branch depth', required=False, default=0)
+    parser.add_argument('--witnesses', type=int, help='Number of witnesses per trace prefix and polarity', required=False, default=10)
+    parser.add_argument('--workers', type=int, help='Number of Z3 processes, all cores by default', required=False)
+    parser.add_argument('--split_units', type=int, help='Minimum number of work units to split the trace tree into, 4 per worker by default', required=False)
+    parser.add_argument('--z3', type=str, help='Path to the z3 executable', required=False, default="z3")
+    args = parser.parse_args()
+
+    start = time.time()
+    generate_witnesses(args.smt2, args.out, args.module, args.depth, args.witnesses, args.workers, args.split_units, None, args.z3)
+    print(f"Witness generation took {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()